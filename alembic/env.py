@@ -23,6 +23,11 @@ from orm import Base
 target_metadata = Base.metadata
 
 
+def include_object(object, name, type_, reflected, compare_to):
+    # views are created by hand-written migrations, autogenerate must not treat them as tables
+    return not (type_ == 'table' and object.info.get('is_view', False))
+
+
 def run_migrations_offline() -> None:
     """Run migrations in 'offline' mode.
 
@@ -39,6 +44,7 @@ def run_migrations_offline() -> None:
     context.configure(
         url=url,
         target_metadata=target_metadata,
+        include_object=include_object,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
     )
@@ -69,7 +75,8 @@ def run_migrations_online() -> None:
         )
 
     with engine.begin() as connection:
-        context.configure(connection=connection, target_metadata=target_metadata)
+        context.configure(connection=connection, target_metadata=target_metadata,
+                          include_object=include_object)
         with context.begin_transaction():  # mysql doesn't support DDL transactions anyway =(
             context.run_migrations()
 
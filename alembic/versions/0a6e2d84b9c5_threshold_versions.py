@@ -0,0 +1,36 @@
+"""Versioned thresholds
+
+Revision ID: 0a6e2d84b9c5
+Revises: e5d7f19b3c80
+Create Date: 2026-10-19 20:15:38.224561
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '0a6e2d84b9c5'
+down_revision = 'e5d7f19b3c80'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('threshold',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('version', sa.Integer(), nullable=False),
+                    sa.Column('measurement_type', sa.VARCHAR(length=2), nullable=False,
+                              comment='iv or cv'),
+                    sa.Column('chip_type', sa.CHAR(length=1), nullable=False),
+                    sa.Column('voltage_key', sa.Integer(), nullable=False),
+                    sa.Column('value', sa.Float(), nullable=False),
+                    sa.Column('record_created_at', sa.DATETIME(),
+                              server_default=sa.func.current_timestamp(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('version', 'measurement_type', 'chip_type', 'voltage_key',
+                                        name='unique_threshold')
+                    )
+
+
+def downgrade() -> None:
+    op.drop_table('threshold')
@@ -0,0 +1,45 @@
+"""Latest measurement views
+
+Revision ID: 3f9c1d7a2b64
+Revises: 110b185fbc52
+Create Date: 2026-10-19 10:12:41.305118
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '3f9c1d7a2b64'
+down_revision = '110b185fbc52'
+branch_labels = None
+depends_on = None
+
+# an anti-join instead of a window function lets chip and wafer filters reach iv_data and cv_data
+# through indexes instead of ranking whole tables
+LATEST_VIEW = """
+    CREATE VIEW {table}_latest AS
+    SELECT {columns}
+    FROM {table} AS measurement
+    WHERE NOT EXISTS (SELECT 1
+                      FROM {table} AS newer
+                      WHERE newer.chip_id = measurement.chip_id
+                        AND newer.chip_state_id = measurement.chip_state_id
+                        AND newer.voltage_input = measurement.voltage_input
+                        AND (newer.datetime > measurement.datetime
+                             OR newer.datetime = measurement.datetime AND newer.id > measurement.id))
+"""
+VIEW_COLUMNS = {
+    'iv_data': ['id', 'chip_id', 'chip_state_id', 'int_time', 'temperature', 'voltage_input',
+                'anode_current', 'cathode_current', 'anode_current_corrected', 'datetime'],
+    'cv_data': ['id', 'chip_id', 'chip_state_id', 'voltage_input', 'capacitance', 'datetime'],
+}
+
+
+def upgrade() -> None:
+    for table, columns in VIEW_COLUMNS.items():
+        op.execute(LATEST_VIEW.format(
+            table=table, columns=', '.join(f'measurement.{column}' for column in columns)))
+
+
+def downgrade() -> None:
+    op.execute("DROP VIEW cv_data_latest")
+    op.execute("DROP VIEW iv_data_latest")
@@ -0,0 +1,33 @@
+"""Composite measurement indexes and stored chip type
+
+Revision ID: 7c2e5a9d41f3
+Revises: 3f9c1d7a2b64
+Create Date: 2026-10-19 14:02:17.518243
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '7c2e5a9d41f3'
+down_revision = '3f9c1d7a2b64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_iv_data_chip_state_voltage_datetime', 'iv_data',
+                    ['chip_id', 'chip_state_id', 'voltage_input', 'datetime'], unique=False)
+    op.create_index('ix_cv_data_chip_state_voltage_datetime', 'cv_data',
+                    ['chip_id', 'chip_state_id', 'voltage_input', 'datetime'], unique=False)
+    # a virtual generated column can't be altered to a stored one in place
+    op.execute("ALTER TABLE chip DROP COLUMN type, "
+               "ADD COLUMN type CHAR(1) GENERATED ALWAYS AS (SUBSTR(`name`,1,1)) STORED")
+    op.create_index('ix_chip_wafer_id_type', 'chip', ['wafer_id', 'type'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_chip_wafer_id_type', table_name='chip')
+    op.execute("ALTER TABLE chip DROP COLUMN type, "
+               "ADD COLUMN type CHAR(1) GENERATED ALWAYS AS (SUBSTR(`name`,1,1)) VIRTUAL")
+    op.drop_index('ix_cv_data_chip_state_voltage_datetime', table_name='cv_data')
+    op.drop_index('ix_iv_data_chip_state_voltage_datetime', table_name='iv_data')
@@ -0,0 +1,39 @@
+"""Archived measurements partitions
+
+Revision ID: 9d3b7e1c5a42
+Revises: 0a6e2d84b9c5
+Create Date: 2026-10-19 21:02:11.408317
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '9d3b7e1c5a42'
+down_revision = '0a6e2d84b9c5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('archive_partition',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('wafer_id', sa.Integer(), nullable=False),
+                    sa.Column('measurement_type', sa.VARCHAR(length=2), nullable=False,
+                              comment='iv or cv'),
+                    sa.Column('path', sa.VARCHAR(length=255), nullable=False,
+                              comment='Parquet file with measurements'),
+                    sa.Column('rows', sa.Integer(), nullable=False),
+                    sa.Column('archived_at', sa.DATETIME(),
+                              server_default=sa.func.current_timestamp(), nullable=False),
+                    sa.ForeignKeyConstraint(['wafer_id'], ['wafer.id'],
+                                            name='archive_partition__wafer', onupdate='CASCADE',
+                                            ondelete='RESTRICT'),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('wafer_id', 'measurement_type',
+                                        name='unique_archive_partition')
+                    )
+
+
+def downgrade() -> None:
+    op.drop_table('archive_partition')
@@ -0,0 +1,38 @@
+"""Uploads of buffered measurements
+
+Revision ID: b7f4c2a91d06
+Revises: 9d3b7e1c5a42
+Create Date: 2026-10-19 23:14:52.630184
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'b7f4c2a91d06'
+down_revision = '9d3b7e1c5a42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('measurement_upload',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('uid', sa.VARCHAR(length=36), nullable=False,
+                              comment='Id of the batch in the local buffer of a measurement '
+                                      'station'),
+                    sa.Column('wafer_id', sa.Integer(), nullable=False),
+                    sa.Column('rows', sa.Integer(), nullable=False),
+                    sa.Column('measured_at', sa.DATETIME(), nullable=False),
+                    sa.Column('uploaded_at', sa.DATETIME(),
+                              server_default=sa.func.current_timestamp(), nullable=False),
+                    sa.ForeignKeyConstraint(['wafer_id'], ['wafer.id'],
+                                            name='measurement_upload__wafer', onupdate='CASCADE',
+                                            ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('uid')
+                    )
+
+
+def downgrade() -> None:
+    op.drop_table('measurement_upload')
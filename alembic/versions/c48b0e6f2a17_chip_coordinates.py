@@ -0,0 +1,32 @@
+"""Stored chip coordinates
+
+Revision ID: c48b0e6f2a17
+Revises: 7c2e5a9d41f3
+Create Date: 2026-10-19 16:27:45.091372
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c48b0e6f2a17'
+down_revision = '7c2e5a9d41f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('chip', sa.Column('x_coordinate', sa.SmallInteger(), sa.Computed(
+        'CAST(SUBSTR(`name`,2,2) AS UNSIGNED)', persisted=True), nullable=True))
+    op.add_column('chip', sa.Column('y_coordinate', sa.SmallInteger(), sa.Computed(
+        'CAST(SUBSTR(`name`,4,2) AS UNSIGNED)', persisted=True), nullable=True))
+    op.create_index('ix_chip_wafer_id_type_coordinates', 'chip',
+                    ['wafer_id', 'type', 'x_coordinate', 'y_coordinate'], unique=False)
+    op.drop_index('ix_chip_wafer_id_type', table_name='chip')
+
+
+def downgrade() -> None:
+    op.create_index('ix_chip_wafer_id_type', 'chip', ['wafer_id', 'type'], unique=False)
+    op.drop_index('ix_chip_wafer_id_type_coordinates', table_name='chip')
+    op.drop_column('chip', 'y_coordinate')
+    op.drop_column('chip', 'x_coordinate')
@@ -0,0 +1,56 @@
+"""Measurement jobs shared by stations
+
+Revision ID: e3a85c2d7f19
+Revises: b7f4c2a91d06
+Create Date: 2026-10-20 10:21:37.094512
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'e3a85c2d7f19'
+down_revision = 'b7f4c2a91d06'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('measurement_job',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('wafer_name', sa.VARCHAR(length=20), nullable=False),
+                    sa.Column('chip_names', sa.TEXT(), nullable=False,
+                              comment='Comma separated chip names'),
+                    sa.Column('chip_state_id', sa.Integer(), nullable=False),
+                    sa.Column('measurement_type', sa.VARCHAR(length=2), nullable=False,
+                              comment='iv or cv'),
+                    sa.Column('config', sa.VARCHAR(length=100), nullable=False,
+                              comment='File name of the measure config, e.g. '
+                                      'single-innopoli.yaml'),
+                    sa.Column('priority', sa.Integer(), server_default='0', nullable=False,
+                              comment='Higher runs first'),
+                    sa.Column('status', sa.VARCHAR(length=10), server_default='queued',
+                              nullable=False,
+                              comment='queued, running, done, failed or cancelled'),
+                    sa.Column('station', sa.VARCHAR(length=100),
+                              comment='Station which claimed the job'),
+                    sa.Column('attempts', sa.Integer(), server_default='0', nullable=False),
+                    sa.Column('error', sa.TEXT()),
+                    sa.Column('created_at', sa.DATETIME(),
+                              server_default=sa.func.current_timestamp(), nullable=False),
+                    sa.Column('claimed_at', sa.DATETIME()),
+                    sa.Column('heartbeat_at', sa.DATETIME(),
+                              comment='Lease of the station, renewed while it measures'),
+                    sa.Column('finished_at', sa.DATETIME()),
+                    sa.ForeignKeyConstraint(['chip_state_id'], ['chip_state.id'],
+                                            name='measurement_job__chip_state',
+                                            onupdate='CASCADE', ondelete='RESTRICT'),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index('ix_measurement_job_status_config_priority', 'measurement_job',
+                    ['status', 'config', 'priority'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_measurement_job_status_config_priority', table_name='measurement_job')
+    op.drop_table('measurement_job')
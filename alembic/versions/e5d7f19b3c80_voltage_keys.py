@@ -0,0 +1,67 @@
+"""Canonical integer voltage keys
+
+Revision ID: e5d7f19b3c80
+Revises: c48b0e6f2a17
+Create Date: 2026-10-19 18:41:03.672915
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'e5d7f19b3c80'
+down_revision = 'c48b0e6f2a17'
+branch_labels = None
+depends_on = None
+
+# same policy as utils.voltage_grid: snap to 1 mV grid within 0.2 mV, otherwise keep 10 uV
+SNAPPED_KEY = """
+    CASE WHEN ABS(voltage_input * 1000000 - ROUND(voltage_input * 1000) * 1000) <= 200
+         THEN ROUND(voltage_input * 1000) * 1000
+         ELSE ROUND(voltage_input * 100000) * 10
+    END
+"""
+LATEST_VIEW = """
+    CREATE OR REPLACE VIEW {table}_latest AS
+    SELECT {columns}
+    FROM {table} AS measurement
+    WHERE NOT EXISTS (SELECT 1
+                      FROM {table} AS newer
+                      WHERE newer.chip_id = measurement.chip_id
+                        AND newer.chip_state_id = measurement.chip_state_id
+                        AND newer.{voltage} = measurement.{voltage}
+                        AND (newer.datetime > measurement.datetime
+                             OR newer.datetime = measurement.datetime AND newer.id > measurement.id))
+"""
+VIEW_COLUMNS = {
+    'iv_data': ['id', 'chip_id', 'chip_state_id', 'int_time', 'temperature', 'voltage_input',
+                'anode_current', 'cathode_current', 'anode_current_corrected', 'datetime'],
+    'cv_data': ['id', 'chip_id', 'chip_state_id', 'voltage_input', 'capacitance', 'datetime'],
+}
+
+
+def create_latest_views(voltage: str, extra_columns: list[str]):
+    for table, columns in VIEW_COLUMNS.items():
+        op.execute(LATEST_VIEW.format(
+            table=table, voltage=voltage,
+            columns=', '.join(f'measurement.{column}' for column in columns + extra_columns)))
+
+
+def upgrade() -> None:
+    for table in VIEW_COLUMNS:
+        op.add_column(table, sa.Column('voltage_key', sa.Integer(), nullable=True))
+        op.execute(f"UPDATE {table} SET voltage_key = {SNAPPED_KEY}")
+        op.alter_column(table, 'voltage_key', existing_type=sa.Integer(), nullable=False)
+        op.create_index(f'ix_{table}_chip_state_voltage_key_datetime', table,
+                        ['chip_id', 'chip_state_id', 'voltage_key', 'datetime'], unique=False)
+        op.drop_index(f'ix_{table}_chip_state_voltage_datetime', table_name=table)
+    create_latest_views('voltage_key', ['voltage_key'])
+
+
+def downgrade() -> None:
+    create_latest_views('voltage_input', [])
+    for table in VIEW_COLUMNS:
+        op.create_index(f'ix_{table}_chip_state_voltage_datetime', table,
+                        ['chip_id', 'chip_state_id', 'voltage_input', 'datetime'], unique=False)
+        op.drop_index(f'ix_{table}_chip_state_voltage_key_datetime', table_name=table)
+        op.drop_column(table, 'voltage_key')
@@ -9,22 +9,32 @@ from sqlalchemy import create_engine, desc
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session
 
-from orm import Wafer, ChipState
-from utils import logger, get_db_url, CsvChoice
+from orm import Base, Wafer, ChipState
+from utils import logger, get_db_url, CsvChoice, QueryPlanChecker
+from .archive import archive
+from .bundle import export_group, import_group
 from .compare_wafers import compare_wafers
 from .parse import parse
 from .db import db_group, set_db
+from .jobs import jobs
 from .show import show
 from .summary import summary_iv, summary_cv
+from .sweep import sweep_thresholds
+from .thresholds import thresholds
+from .trend import trend
 
 
-@click.group(commands=[summary_iv, summary_cv, db_group, show, parse, compare_wafers])
+@click.group(commands=[summary_iv, summary_cv, db_group, show, parse, compare_wafers, trend,
+                         thresholds, sweep_thresholds, export_group, import_group, archive, jobs])
 @click.pass_context
 @click.option("--log-level", default="INFO", help="Log level.", show_default=True,
               type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
                                 case_sensitive=False))
 @click.option("--db-url", help="Database URL.")
-def analyzing(ctx: click.Context, log_level: str, db_url: Union[str, None]):
+@click.option("--explain", is_flag=True, default=False,
+              help="Log EXPLAIN output of every query the command runs and fail if any of them "
+                   "scans a whole measurements or chips table.")
+def analyzing(ctx: click.Context, log_level: str, db_url: Union[str, None], explain: bool):
     logger.setLevel(log_level)
     ctx.obj = dict()
     active_command = analyzing.commands[ctx.invoked_subcommand]
@@ -36,6 +46,9 @@ def analyzing(ctx: click.Context, log_level: str, db_url: Union[str, None]):
             engine = create_engine(db_url,
                                    echo="debug" if logger.getEffectiveLevel() == logging.DEBUG else False)
             engine.connect()
+            if explain:
+                checker = QueryPlanChecker(engine, Base.metadata.tables)
+                ctx.call_on_close(lambda: check_query_plans(checker))
             session = ctx.with_resource(Session(bind=engine, autoflush=False, autocommit=False))
             ctx.obj['session'] = session
         except OperationalError as e:
@@ -47,7 +60,7 @@ def analyzing(ctx: click.Context, log_level: str, db_url: Union[str, None]):
                 sentry_sdk.capture_exception(e)
             ctx.exit()
 
-        if active_command in (summary_iv, summary_cv, compare_wafers):
+        if active_command in (summary_iv, summary_cv, compare_wafers, trend, sweep_thresholds):
             chip_states = session.query(ChipState).all()
             ctx.obj['chip_states'] = chip_states
             chip_state_option = next((o for o in active_command.params if o.name == 'chip_state_ids'))
@@ -62,3 +75,9 @@ def analyzing(ctx: click.Context, log_level: str, db_url: Union[str, None]):
             wafer_option = next((o for o in active_command.params if o.name == 'wafer_name'))
             wafer_option.default = default_wafer_name
             ctx.obj['default_wafer'] = last_wafer
+
+
+def check_query_plans(checker: QueryPlanChecker):
+    checker.close()
+    if not checker.report():
+        raise click.ClickException('Some queries scan whole tables, see the plans above.')
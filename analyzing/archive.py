@@ -0,0 +1,43 @@
+from datetime import datetime
+
+import click
+from sqlalchemy.orm import Session
+
+from orm import Wafer
+from utils import logger, flatten_options
+from .archive_store import ARCHIVED_MODELS, archive_wafer, archive_dir_option
+from .summary import date_formats, date_formats_help
+
+
+@click.command(name='archive', help="Move measurements of old wafers from database to compressed "
+                                    "Parquet files partitioned by wafer.")
+@click.pass_context
+@click.option("--before", type=click.DateTime(formats=date_formats), required=True,
+              help=f"Archive wafers created before (exclusive) provided date and time. "
+                   f"{date_formats_help}")
+@click.option("-m", "--measurements", "measurement_types", default=['iv,cv'], multiple=True,
+              callback=flatten_options, show_default=True,
+              help="Types of measurements to archive (iv, cv).")
+@archive_dir_option
+@click.option("--page-size", default=50000, show_default=True, type=click.IntRange(min=1),
+              help="Number of rows fetched from database and written as one row group.")
+def archive(ctx: click.Context, before: datetime, measurement_types: set[str], archive_dir: str,
+            page_size: int):
+    session: Session = ctx.obj['session']
+    unknown_types = measurement_types - ARCHIVED_MODELS.keys()
+    if unknown_types:
+        raise click.BadParameter(f"Unknown measurements types: {', '.join(unknown_types)}",
+                                 param_hint='--measurements')
+    wafers = session.query(Wafer.id, Wafer.name) \
+        .filter(Wafer.record_created_at < before) \
+        .order_by(Wafer.record_created_at) \
+        .all()
+    for wafer in wafers:
+        for measurement_type in sorted(measurement_types):
+            rows_count = archive_wafer(session, wafer.id, measurement_type, archive_dir,
+                                       page_size)
+            if rows_count:
+                logger.info(f'{wafer.name}: {rows_count} {measurement_type.upper()} '
+                            f'measurements are archived')
+    logger.info(f'Measurements of {len(wafers)} wafers created before {before} are archived '
+                f'to {archive_dir}')
@@ -0,0 +1,227 @@
+import os
+import posixpath
+from datetime import datetime
+from typing import Iterable, Iterator, Optional
+
+import click
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from sqlalchemy import select, delete
+from sqlalchemy.orm import Session, Query
+from sqlalchemy.sql import ColumnElement
+
+from orm import (
+    Chip,
+    ArchivePartition,
+    IVMeasurement,
+    CVMeasurement,
+    LatestIVMeasurement,
+    LatestCVMeasurement,
+)
+from utils import logger, get_arrow_schema, rows_to_arrow
+from .bundle import iter_table_pages
+from .dump import get_dump_columns
+
+ARCHIVED_MODELS = {'iv': IVMeasurement, 'cv': CVMeasurement}
+MEASUREMENT_TYPES = {
+    IVMeasurement: 'iv',
+    LatestIVMeasurement: 'iv',
+    CVMeasurement: 'cv',
+    LatestCVMeasurement: 'cv',
+}
+KEY_FIELDS = ['chip_id', 'chip_state_id', 'voltage_key']
+CHIP_FIELDS = ['chip_id', 'chip_name', 'wafer_id', 'type']
+
+
+def archive_dir_option(command):
+    return click.option("-d", "--archive-dir", "archive_dir", envvar='ELFYS_ARCHIVE_DIR',
+                        default='archive', show_default=True,
+                        help="Directory of archived partitions, ELFYS_ARCHIVE_DIR environment "
+                             "variable by default.")(command)
+
+
+def get_archive_path(measurement_type: str, wafer_id: int) -> str:
+    """Path of the wafer partition relative to the archive directory, the same on every host."""
+    table_name = ARCHIVED_MODELS[measurement_type].__tablename__
+    return posixpath.join(table_name, f'wafer_id={wafer_id}', 'part-0.parquet')
+
+
+def archive_wafer(session: Session, wafer_id: int, measurement_type: str, directory: str,
+                  page_size: int) -> int:
+    """
+    Moves measurements of the wafer to a Parquet partition. Rows already archived for the wafer are
+    kept in the partition. The new file replaces the old one only after the rows are deleted and
+    the partition is committed, so an interrupted run never leaves rows both in the file and the
+    table. Returns the number of moved rows.
+    """
+    table = ARCHIVED_MODELS[measurement_type].__table__
+    condition = table.c.chip_id.in_(
+        select(Chip.id).where(Chip.wafer_id == wafer_id).scalar_subquery())
+    partition = session.query(ArchivePartition) \
+        .filter(ArchivePartition.wafer_id == wafer_id,
+                ArchivePartition.measurement_type == measurement_type) \
+        .one_or_none()
+    path = os.path.join(directory, partition.path if partition is not None else
+                        get_archive_path(measurement_type, wafer_id))
+    schema = get_arrow_schema(get_dump_columns(table))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if partition is not None:
+        finish_partition(partition, directory)
+    rows_count = 0
+    with pq.ParquetWriter(path + '.part', schema, compression='zstd') as writer:
+        if partition is not None:
+            archived_file = pq.ParquetFile(path, memory_map=True)
+            for index in range(archived_file.num_row_groups):
+                writer.write_table(archived_file.read_row_group(index))
+        for rows in iter_table_pages(session.connection(), table, condition, page_size):
+            writer.write_table(rows_to_arrow(rows, schema))
+            rows_count += len(rows)
+    if rows_count == 0:
+        os.remove(path + '.part')
+        return 0
+
+    total_rows = pq.ParquetFile(path + '.part').metadata.num_rows
+    if partition is None:
+        session.add(ArchivePartition(wafer_id=wafer_id, measurement_type=measurement_type,
+                                     path=get_archive_path(measurement_type, wafer_id),
+                                     rows=total_rows))
+    else:
+        partition.rows = total_rows
+        partition.archived_at = datetime.now()
+    session.execute(delete(table).where(condition).execution_options(synchronize_session=False))
+    session.commit()
+    os.replace(path + '.part', path)
+    return rows_count
+
+
+def finish_partition(partition: ArchivePartition, directory: str):
+    """Replaces the partition file by the new one of a run interrupted after its commit."""
+    path = os.path.join(directory, partition.path)
+    if os.path.exists(path + '.part') and \
+            pq.ParquetFile(path + '.part').metadata.num_rows == partition.rows:
+        os.replace(path + '.part', path)
+
+
+class ArchivedMeasurements:
+    """
+    Archived measurements of the wafers with the same fields as `query` rows, so they can be merged
+    with the results of the query over the live tables. Measurements are filtered like the query:
+    chips by `chip_conditions` evaluated in the database, the rest in the Parquet scanner.
+    Partitions are read record batch by record batch.
+    """
+
+    def __init__(self, session: Session, query: Query, model, wafer_ids: Iterable[int],
+                 directory: str, chip_conditions: Iterable[ColumnElement] = (),
+                 chip_state_ids: Iterable[str] = ('all',),
+                 voltage_keys: Optional[Iterable[int]] = None,
+                 after: Optional[datetime] = None, before: Optional[datetime] = None,
+                 chunk_size: int = 10000):
+        self.fields = [column['name'] for column in query.column_descriptions]
+        self.is_view = model.__table__.info.get('is_view', False)
+        self.chunk_size = chunk_size
+        self.partitions = session.query(ArchivePartition) \
+            .filter(ArchivePartition.wafer_id.in_(list(wafer_ids)),
+                    ArchivePartition.measurement_type == MEASUREMENT_TYPES[model]) \
+            .all()
+        self.paths = {}
+        for partition in self.partitions:
+            finish_partition(partition, directory)
+            self.paths[partition.wafer_id] = os.path.join(directory, partition.path)
+        self.chips = pd.DataFrame(
+            session.query(Chip.id, Chip.name, Chip.wafer_id, Chip.type)
+            .filter(Chip.wafer_id.in_(list(self.paths)))
+            .filter(*chip_conditions)
+            .all() if self.paths else [],
+            columns=CHIP_FIELDS)
+
+        self.filter = None
+        if voltage_keys is not None:
+            self.add_filter(ds.field('voltage_key').isin(list(voltage_keys)))
+        if 'all' not in chip_state_ids:
+            self.add_filter(ds.field('chip_state_id').isin(list(map(int, chip_state_ids))))
+        if after is not None:
+            self.add_filter(ds.field('datetime') >= pa.scalar(after, type=pa.timestamp('us')))
+        if before is not None:
+            self.add_filter(ds.field('datetime') <= pa.scalar(before, type=pa.timestamp('us')))
+
+    def add_filter(self, expression: ds.Expression):
+        self.filter = expression if self.filter is None else self.filter & expression
+
+    def iter_batches(self, wafer_id: int, fields: Iterable[str]) -> Iterator[pa.RecordBatch]:
+        dataset = ds.dataset(self.paths[wafer_id], format='parquet')
+        wafer_chips = self.chips.loc[self.chips['wafer_id'] == wafer_id, 'chip_id'].tolist()
+        expression = ds.field('chip_id').isin(wafer_chips)
+        if self.filter is not None:
+            expression = expression & self.filter
+        columns = [field for field in dict.fromkeys([*KEY_FIELDS, *fields])
+                   if field in dataset.schema.names]
+        return dataset.to_batches(columns=columns, filter=expression, batch_size=self.chunk_size)
+
+    def get_newest_keys(self) -> dict[tuple, tuple]:
+        """(datetime, id) of the newest archived measurement of every chip, state and voltage."""
+        newest = {}
+        for wafer_id in self.paths:
+            for batch in self.iter_batches(wafer_id, ['datetime', 'id']):
+                values = batch.to_pydict()
+                for *key, measured_at, measurement_id in zip(
+                        *(values[field] for field in [*KEY_FIELDS, 'datetime', 'id'])):
+                    key = tuple(key)
+                    if key not in newest or (measured_at, measurement_id) > newest[key]:
+                        newest[key] = (measured_at, measurement_id)
+        return newest
+
+    def iter_chunks(self, newest: Optional[dict[tuple, tuple]] = None) -> Iterator[list]:
+        """
+        Yields chunks of archived rows in the order they were archived. With `newest` keys only the
+        measurements they point to are yielded.
+        """
+        for wafer_id, path in self.paths.items():
+            rows_count = 0
+            for batch in self.iter_batches(wafer_id, self.fields):
+                data = batch.to_pandas()
+                if newest is not None:
+                    values = batch.to_pydict()
+                    keys = zip(*(values[field] for field in KEY_FIELDS))
+                    versions = zip(values['datetime'], values['id'])
+                    data = data[[newest.get(key) == version
+                                 for key, version in zip(keys, versions)]]
+                data = data.merge(self.chips, on='chip_id')
+                rows_count += len(data)
+                yield list(data[self.fields].astype(object)
+                           .where(data[self.fields].notna(), None)
+                           .itertuples(index=False, name='Row'))
+            logger.debug(f'{rows_count} measurements are read from {path}')
+
+
+def merge_archived_chunks(live_chunks: Iterator[list],
+                          archived: ArchivedMeasurements) -> Iterator[list]:
+    """
+    Merges chunks of a query over the live tables with archived chunks. Live chunks are passed
+    through as they stream. A wafer can get new measurements after it is archived, so for the
+    latest measurements views only the newest measurement of every chip, state and voltage is kept:
+    live rows are checked against the keys of archived rows, which are yielded last. Otherwise the
+    archived rows come first, as they are older. Rows must have `id` and `datetime` fields.
+    """
+    if not archived.paths:
+        yield from live_chunks
+        return
+    if not archived.is_view:
+        yield from archived.iter_chunks()
+        yield from live_chunks
+        return
+
+    newest = archived.get_newest_keys()
+    for chunk in live_chunks:
+        rows = []
+        for row in chunk:
+            key = (row.chip_id, row.chip_state_id, row.voltage_key)
+            archived_version = newest.get(key)
+            if archived_version is None or (row.datetime, row.id) > archived_version:
+                rows.append(row)
+                if key in newest:
+                    newest[key] = None
+        yield rows
+    yield from archived.iter_chunks(newest)
@@ -0,0 +1,221 @@
+from time import strftime
+from typing import Iterator, Optional
+
+import click
+import pyarrow as pa
+import pyarrow.compute as pc
+from sqlalchemy import Table, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import ColumnElement
+
+from orm import Base, Wafer, Chip, EqeSession, EqeConditions
+from utils import (
+    logger,
+    flatten_options,
+    WaferBundle,
+    WaferBundleWriter,
+    BUNDLE_TABLES,
+    get_arrow_schema,
+)
+from .dump import get_dump_columns, get_subset_condition
+
+# tables matched by natural key on import instead of being inserted again: key column
+LOOKUP_TABLES = {'chip_state': 'name', 'instrument': 'name', 'carrier': 'name',
+                 'eqe_session': 'date'}
+# foreign key column: referenced table, ids of referenced rows are remapped on import
+REMAPPED_COLUMNS = {
+    'chip': {'wafer_id': 'wafer'},
+    'iv_data': {'chip_id': 'chip', 'chip_state_id': 'chip_state'},
+    'cv_data': {'chip_id': 'chip', 'chip_state_id': 'chip_state'},
+    'eqe_conditions': {'chip_id': 'chip', 'chip_state_id': 'chip_state',
+                       'session_id': 'eqe_session', 'instrument_id': 'instrument',
+                       'carrier_id': 'carrier'},
+    'eqe_data': {'conditions_id': 'eqe_conditions'},
+}
+# tables referenced by later tables of the bundle, their new ids are needed for remapping
+REFERENCED_TABLES = {'wafer', 'chip', 'eqe_conditions'}
+
+
+def get_bundle_conditions(wafer_ids: list[int]) -> dict[str, Optional[ColumnElement]]:
+    conditions = {name: get_subset_condition(Base.metadata.tables[name], wafer_ids)
+                  for name in BUNDLE_TABLES}
+    conditions['eqe_session'] = EqeSession.id.in_(
+        select(EqeConditions.session_id).where(conditions['eqe_conditions']).scalar_subquery())
+    return conditions
+
+
+def iter_table_pages(connection: Connection, table: Table, condition: Optional[ColumnElement],
+                     page_size: int) -> Iterator[list]:
+    query = select(*get_dump_columns(table)).order_by(table.c.id).limit(page_size)
+    if condition is not None:
+        query = query.where(condition)
+    last_id = None
+    while True:
+        rows = connection.execute(
+            query if last_id is None else query.where(table.c.id > last_id)).all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1].id
+
+
+@click.command(name='wafer', help="Export wafers with their chips and measurements to a bundle "
+                                  "of Parquet files.")
+@click.pass_context
+@click.option("-w", "--wafers", "wafer_names", type=str, multiple=True, required=True,
+              callback=flatten_options, help="Wafers to export.")
+@click.option("-o", "--output", "directory",
+              default=lambda: f"wafers-{strftime('%y%m%d-%H%M%S')}.bundle",
+              help="Output directory.", show_default="wafers-{datetime}.bundle")
+@click.option("--page-size", default=50000, show_default=True, type=click.IntRange(min=1),
+              help="Number of rows fetched from database and written as one row group.")
+def export_wafer(ctx: click.Context, wafer_names: set[str], directory: str, page_size: int):
+    session: Session = ctx.obj['session']
+    wafers = session.query(Wafer.id, Wafer.name).filter(Wafer.name.in_(wafer_names)).all()
+    not_found_wafers = wafer_names - {wafer.name for wafer in wafers}
+    if not_found_wafers:
+        logger.warning(f"Wafers not found: {', '.join(not_found_wafers)}")
+    if not wafers:
+        return
+
+    conditions = get_bundle_conditions([wafer.id for wafer in wafers])
+    writer = WaferBundleWriter(directory)
+    connection = session.connection()
+    for table_name in BUNDLE_TABLES:
+        table = Base.metadata.tables[table_name]
+        schema = get_arrow_schema(get_dump_columns(table))
+        writer.write(table_name, schema, [])
+        for rows in iter_table_pages(connection, table, conditions[table_name], page_size):
+            writer.write(table_name, schema, rows)
+        logger.info(f'{table_name}: {writer.rows[table_name]} rows exported')
+    writer.close([wafer.name for wafer in wafers])
+    logger.info(f'Wafers are exported to {directory}')
+
+
+def import_bundle(session: Session, bundle: WaferBundle, batch_size: int) -> dict[str, int]:
+    """
+    Inserts rows of a bundle with new ids, references are remapped to the ids of inserted rows and
+    lookup rows are matched by natural key. Wafers existing in the database are skipped with their
+    rows, lookup rows only they reference are not inserted.
+    """
+    models = {mapper.local_table.name: mapper.class_ for mapper in Base.registry.mappers}
+    id_maps: dict[str, dict] = {}
+    counts = {}
+
+    existing_wafers = {name for name, in session.query(Wafer.name)
+                       .filter(Wafer.name.in_(bundle.wafers))}
+    if existing_wafers:
+        logger.warning(f"Wafers already exist and are skipped: {', '.join(existing_wafers)}")
+    wafer_ids = pa.array([wafer['id'] for wafer in bundle.read('wafer', ['id', 'name']).to_pylist()
+                          if wafer['name'] not in existing_wafers], pa.int64())
+    chips = bundle.read('chip', ['id', 'wafer_id'])
+    chip_ids = chips.filter(pc.is_in(chips['wafer_id'], wafer_ids))['id']
+    referenced_ids = get_referenced_lookup_ids(bundle, chip_ids, batch_size)
+
+    for table_name, key in LOOKUP_TABLES.items():
+        model = models[table_name]
+        key_column = getattr(model, key)
+        rows = [row for row in bundle.read(table_name).to_pylist()
+                if row['id'] in referenced_ids[table_name]]
+        existing = dict(session.query(key_column, model.id))
+        new_rows = {row[key]: {column: value for column, value in row.items() if column != 'id'}
+                    for row in rows if row[key] not in existing}
+        if new_rows:
+            session.bulk_insert_mappings(model, list(new_rows.values()))
+            existing = dict(session.query(key_column, model.id))
+        id_maps[table_name] = {row['id']: existing[row[key]] for row in rows}
+        counts[table_name] = len(new_rows)
+        logger.info(f'{table_name}: {counts[table_name]} rows imported')
+
+    for table_name in BUNDLE_TABLES:
+        if table_name in LOOKUP_TABLES:
+            continue
+        remapped_columns = REMAPPED_COLUMNS.get(table_name, {})
+        required_columns = [column for column in remapped_columns
+                            if not Base.metadata.tables[table_name].c[column].nullable]
+        id_map = id_maps.setdefault(table_name, {})
+        counts[table_name] = 0
+        for batch in bundle.iter_batches(table_name, batch_size):
+            mappings = []
+            for row in batch.to_pylist():
+                if table_name == 'wafer' and row['name'] in existing_wafers:
+                    continue
+                for column, referenced_table in remapped_columns.items():
+                    if row[column] is not None:
+                        row[column] = id_maps[referenced_table].get(row[column])
+                if any(row[column] is None for column in required_columns):
+                    continue  # row of a skipped wafer
+                mappings.append(row)
+            if not mappings:
+                continue
+            old_ids = [mapping.pop('id') for mapping in mappings]
+            session.bulk_insert_mappings(models[table_name], mappings)
+            if table_name in REFERENCED_TABLES:
+                id_map.update(zip(old_ids, get_inserted_ids(session, table_name, mappings,
+                                                            set(id_map.values()))))
+            counts[table_name] += len(mappings)
+        logger.info(f'{table_name}: {counts[table_name]} rows imported')
+    return counts
+
+
+def get_referenced_lookup_ids(bundle: WaferBundle, chip_ids: pa.Array,
+                              batch_size: int) -> dict[str, set]:
+    """Bundle ids of lookup rows referenced by the rows of the chips."""
+    referenced_ids = {table_name: set() for table_name in LOOKUP_TABLES}
+    for table_name, remapped_columns in REMAPPED_COLUMNS.items():
+        lookup_columns = {column: referenced_table
+                          for column, referenced_table in remapped_columns.items()
+                          if referenced_table in LOOKUP_TABLES}
+        if not lookup_columns:
+            continue
+        for batch in bundle.iter_batches(table_name, batch_size, ['chip_id', *lookup_columns]):
+            batch = batch.filter(pc.is_in(batch.column('chip_id'), chip_ids))
+            for column, referenced_table in lookup_columns.items():
+                referenced_ids[referenced_table].update(pc.unique(batch.column(column)).to_pylist())
+    return referenced_ids
+
+
+def get_inserted_ids(session: Session, table_name: str, mappings: list[dict],
+                     known_ids: set[int]) -> list[int]:
+    """
+    Ids of just inserted rows in the order of mappings, fetched with one query. Wafers and chips are
+    found by natural key. EQE conditions have none, but they belong to chips inserted by the import,
+    so rows of the chips not known yet are the inserted ones in the order of their ids.
+    """
+    if table_name == 'wafer':
+        ids = dict(session.query(Wafer.name, Wafer.id)
+                   .filter(Wafer.name.in_([mapping['name'] for mapping in mappings])))
+        return [ids[mapping['name']] for mapping in mappings]
+    if table_name == 'chip':
+        ids = {(wafer_id, name): chip_id for chip_id, wafer_id, name
+               in session.query(Chip.id, Chip.wafer_id, Chip.name)
+               .filter(Chip.wafer_id.in_({mapping['wafer_id'] for mapping in mappings}))}
+        return [ids[mapping['wafer_id'], mapping['name']] for mapping in mappings]
+    return [conditions_id for conditions_id, in session.query(EqeConditions.id)
+            .filter(EqeConditions.chip_id.in_({mapping['chip_id'] for mapping in mappings}))
+            .order_by(EqeConditions.id)
+            if conditions_id not in known_ids]
+
+
+@click.command(name='wafer', help="Import wafers from a bundle made by export wafer command.")
+@click.pass_context
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option("--batch-size", default=50000, show_default=True, type=click.IntRange(min=1),
+              help="Number of rows read from the bundle and inserted at once.")
+def import_wafer(ctx: click.Context, directory: str, batch_size: int):
+    session: Session = ctx.obj['session']
+    bundle = WaferBundle(directory)
+    import_bundle(session, bundle, batch_size)
+    session.commit()
+    logger.info(f"Bundle {directory} is imported")
+
+
+@click.group(name='export', commands=[export_wafer], help="Export data from database")
+def export_group():
+    pass
+
+
+@click.group(name='import', commands=[import_wafer], help="Import data to database")
+def import_group():
+    pass
@@ -1,15 +1,27 @@
 from decimal import Decimal
 from itertools import product
 from time import strftime
-from typing import Iterable
+from typing import Iterable, Optional
 
 import click
 import numpy as np
 import pandas as pd
-from sqlalchemy.orm import Session, contains_eager
-
-from orm import Wafer, Chip, IVMeasurement
-from utils import logger, flatten_options, iv_thresholds, IV_VOLTAGE_PRESETS, VoltagesOption
+from sqlalchemy.orm import Session
+
+from orm import Wafer, Chip, LatestIVMeasurement
+from utils import (
+    logger,
+    flatten_options,
+    IV_VOLTAGE_PRESETS,
+    VoltagesOption,
+    MeasurementTable,
+    to_voltage_key,
+    from_voltage_key,
+)
+from .archive_store import ArchivedMeasurements, merge_archived_chunks, archive_dir_option
+from .region import RegionType, Region, REGION_HELP, filter_region
+from .stream import iter_query_chunks
+from .thresholds import get_threshold_table, thresholds_version_option
 
 
 @click.command(name="compare-wafers", help='Compare wafers')
@@ -24,12 +36,23 @@ from utils import logger, flatten_options, iv_thresholds, IV_VOLTAGE_PRESETS, Vo
 @click.option("--voltages", "compare_voltages", default=IV_VOLTAGE_PRESETS['sm'],
               cls=VoltagesOption, presets=IV_VOLTAGE_PRESETS,
               help="List of voltages to include in comparison.")
+@click.option("--region", type=RegionType(), help=REGION_HELP)
+@thresholds_version_option
+@archive_dir_option
+@click.option("--stream", is_flag=True, default=False,
+              help="Fetch measurements in chunks with a server-side cursor to reduce memory usage.")
+@click.option("--chunk-size", default=10000, show_default=True,
+              help="Number of rows fetched from database at once in stream mode.")
 def compare_wafers(ctx: click.Context, wafer_names: set[str], chip_state_ids: tuple[str],
-                   file_name: str, compare_voltages: Iterable[Decimal]):
+                   file_name: str, compare_voltages: Iterable[Decimal], region: Optional[Region],
+                   thresholds_version: Optional[int], archive_dir: str, stream: bool,
+                   chunk_size: int):
     session: Session = ctx.obj['session']
 
+    threshold_table = get_threshold_table(session, 'iv', thresholds_version)
     compare_voltages = set(compare_voltages)
-    threshold_voltages = set(map(Decimal, {v for x in iv_thresholds.values() for v in x}))
+    threshold_voltages = {key: from_voltage_key(key)
+                          for key in threshold_table.voltage_keys.tolist()}
 
     wafers_query = session.query(Wafer).filter(Wafer.name.in_(wafer_names))
     wafers = wafers_query.all()
@@ -39,95 +62,105 @@ def compare_wafers(ctx: click.Context, wafer_names: set[str], chip_state_ids: tu
         logger.warning(f"Wafers not found: {', '.join(not_found_wafers)}")
         wafer_names -= not_found_wafers
 
-    chips_query = session.query(Chip).join(Chip.iv_measurements) \
-        .options(contains_eager(Chip.iv_measurements)) \
+    query = session.query(Chip.wafer_id, LatestIVMeasurement.chip_id,
+                          Chip.name.label('chip_name'), LatestIVMeasurement.chip_state_id,
+                          LatestIVMeasurement.voltage_key,
+                          LatestIVMeasurement.anode_current,
+                          LatestIVMeasurement.anode_current_corrected,
+                          LatestIVMeasurement.id, LatestIVMeasurement.datetime) \
+        .select_from(LatestIVMeasurement) \
+        .join(LatestIVMeasurement.chip) \
         .filter(Chip.wafer_id.in_({wafer.id for wafer in wafers})) \
-        .filter(IVMeasurement.voltage_input.in_(compare_voltages | threshold_voltages))
+        .filter(LatestIVMeasurement.voltage_key.in_(
+            {*map(to_voltage_key, compare_voltages), *threshold_voltages}))
+    query = filter_region(query, region)
 
     if 'all' not in chip_state_ids:
-        chips_query = chips_query.filter(IVMeasurement.chip_state_id.in_(chip_state_ids))
+        query = query.filter(LatestIVMeasurement.chip_state_id.in_(chip_state_ids))
         chip_states = [state for state in ctx.obj['chip_states'] if str(state.id) in chip_state_ids]
     else:
         chip_states = ctx.obj['chip_states']
 
+    archived = ArchivedMeasurements(
+        session, query, LatestIVMeasurement, [wafer.id for wafer in wafers], archive_dir,
+        [region.condition()] if region is not None else [], chip_state_ids,
+        voltage_keys=[*map(to_voltage_key, compare_voltages), *threshold_voltages],
+        chunk_size=chunk_size)
+
     logger.info('Querying wafers data from DB...')
-    chips = chips_query.all()
-    if not chips:
+    measurements = MeasurementTable.from_chunks(merge_archived_chunks(
+        iter_query_chunks(query, stream, chunk_size), archived))
+    if not len(measurements):
         logger.warn('Chips for given filters are not found.')
         return
 
-    chip_state_names = [chip_state.name for chip_state in chip_states]
-    chip_types = sorted(set(chip.type for chip in chips), key=lambda t: Chip.get_area(t))
+    data = measurements.to_frame()
+    data['type'] = measurements.chip_types
+    data['voltage'] = measurements.voltages
+    # stored corrections of 0 are compared as raw currents too
+    data['value'] = np.where(measurements.anode_values == 0, measurements.anode_currents,
+                             measurements.anode_values)
+
+    # group values chip by chip so that sums (and therefore std) are accumulated in the same order
+    data = data.iloc[np.argsort(pd.factorize(data['chip_id'])[0], kind='stable')]
+    data['wafer'] = data['wafer_id'].map({wafer.id: wafer.name for wafer in wafers})
+    data['chip'] = data['chip_state_id'].map({state.id: state.name for state in chip_states})
+
+    chip_types = sorted(data['type'].unique(), key=lambda t: Chip.get_area(t))
     chip_perimeter_areas = [Chip.get_perimeter(chip_type) / Chip.get_area(chip_type) for chip_type
                             in chip_types]
+    iteration_orders = {
+        'wafer': [wafer.name for wafer in wafers],
+        'type': chip_types,
+        'chip': [chip_state.name for chip_state in chip_states],
+    }
 
-    index = pd.MultiIndex(levels=[wafer_names, chip_state_names], codes=[[], []],
-                          names=['wafer', 'chip'])
     codes = list(zip(*product(range(len(compare_voltages)), range(len(chip_types)))))
     columns = pd.MultiIndex(levels=[sorted(compare_voltages), chip_types, chip_perimeter_areas],
                             codes=[*codes, codes[1]],
                             names=['voltage, V', 'type', 'perimeter/area, mm^-1'])
-
-    leakage_df = pd.DataFrame(index=index, columns=columns)
-    leak_density_df = pd.DataFrame(index=index, columns=columns)
-    std_df = pd.DataFrame(index=index, columns=columns)
-
-    yield_columns = pd.MultiIndex.from_product([sorted(threshold_voltages), chip_types],
+    yield_columns = pd.MultiIndex.from_product([sorted(threshold_voltages.values()), chip_types],
                                                names=['voltage, V', 'type'])
-    yield_df = pd.DataFrame(index=index, columns=yield_columns)
 
     logger.info('Compiling data into excel sheets sheets...')
-    for wafer, chip_type in product(wafers, chip_types):
-        target_chips = [chip for chip in chips if chip.wafer == wafer and chip.type == chip_type]
-
-        for (voltage, chip_state) in product(compare_voltages, chip_states):
-            target_values = get_target_values(chip_state, target_chips, voltage)
-            if not target_values:
-                continue
-
-            target_values = [value * -1e12 for value in target_values]
-            area = Chip.get_area(chip_type)
-            perimeter = Chip.get_perimeter(chip_type)
-            location = (wafer.name, chip_state.name), (voltage, chip_type, perimeter / area)
-
-            median = np.median(target_values)
-            leakage_df.loc[location] = median
-            leak_density_df.loc[location] = median / area
-            std = np.std(target_values)
-            std_df.loc[location] = std
-
-        for (voltage, chip_state) in product(threshold_voltages, chip_states):
-            leakage_threshold = iv_thresholds[chip_type].get(str(voltage))
-            if leakage_threshold is None:
-                continue
-
-            target_values = get_target_values(chip_state, target_chips, voltage)
-            if not target_values:
-                continue
-            location = (wafer.name, chip_state.name), (voltage, chip_type)
-            yield_value = np.mean([value > leakage_threshold for value in target_values])
-            yield_df.loc[location] = "{:.2%}".format(yield_value)
+    compare_data = data.assign(
+        voltage=data['voltage'].map({float(v): v for v in compare_voltages}),
+        value=data['value'] * -1e12,
+    ).dropna(subset=['voltage'])
+    stats = compare_data.groupby(['wafer', 'chip', 'voltage', 'type'])['value'] \
+        .agg(median='median', std=lambda values: np.std(values.to_numpy())).reset_index()
+    stats['density'] = stats['median'] / stats['type'].map(Chip.get_area)
+    index = get_sheet_index(stats, {**iteration_orders, 'voltage': list(compare_voltages)})
+
+    leakage_df = to_sheet(stats, 'median', index, columns)
+    leak_density_df = to_sheet(stats, 'density', index, columns)
+    std_df = to_sheet(stats, 'std', index, columns)
+
+    chip_types_column = data['type'].to_numpy()
+    voltage_keys = data['voltage_key'].to_numpy()
+    values = data['value'].to_numpy()
+    checked, passed = threshold_table.evaluate(chip_types_column, voltage_keys, values)
+    checked_data = data[checked].assign(
+        voltage=data.loc[checked, 'voltage_key'].map(threshold_voltages),
+        passed=passed[checked])
+    yields = checked_data.groupby(['wafer', 'chip', 'voltage', 'type'])['passed'].mean() \
+        .map("{:.2%}".format).rename('yield').reset_index()
+    yield_index = get_sheet_index(
+        yields, {**iteration_orders, 'voltage': list(threshold_voltages.values())})
+    yield_df = to_sheet(yields, 'yield', yield_index, yield_columns)
 
     logger.info('Computing total yields...')
-    total_yield_series = pd.Series(index=index, name='Total yield', dtype='str')
-    for wafer, chip_state in product(wafers, chip_states):
-        target_chips = [chip for chip in chips if chip.wafer == wafer]
-        passes = []
-        for chip in target_chips:
-            chip_passed = True
-            for voltage, threshold in iv_thresholds[chip.type].items():
-                newest_first = sorted(chip.iv_measurements, key=lambda m: m.datetime, reverse=True)
-                target_measurement = next((m for m in newest_first if
-                                           m.voltage_input == Decimal(
-                                               voltage) and m.chip_state == chip_state), None)
-                if target_measurement is None:
-                    continue
-                value = target_measurement.anode_current_corrected or target_measurement.anode_current
-                if value < threshold:
-                    chip_passed = False
-                    break
-            passes.append(chip_passed)
-        total_yield_series[wafer.name, chip_state.name] = "{:.2%}".format(np.mean(passes))
+    chip_codes, chip_keys = pd.factorize(pd.MultiIndex.from_arrays(
+        [data['chip_id'], data['chip_state_id']]))
+    checked_bits, passed_bits = threshold_table.get_chip_bitmaps(
+        chip_codes, len(chip_keys), chip_types_column, voltage_keys, values)
+    _, first_rows = np.unique(chip_codes, return_index=True)
+    failed_chips = data.iloc[first_rows][(checked_bits & ~passed_bits) != 0] \
+        .groupby(['wafer', 'chip'])['chip_id'].nunique()
+    wafer_chips = data.groupby('wafer')['chip_id'].nunique()
+    total_yield_series = pd.Series(
+        [1 - failed_chips.get((wafer, chip), 0) / wafer_chips[wafer] for wafer, chip in yield_index],
+        index=yield_index, name='Total yield').map("{:.2%}".format)
 
     yield_df.dropna(how="all", axis=0, inplace=True)
     yield_df.dropna(how="all", axis=1, inplace=True)
@@ -148,11 +181,23 @@ def compare_wafers(ctx: click.Context, wafer_names: set[str], chip_state_ids: tu
     logger.info(f'Wafers comparison is saved to {file_name}')
 
 
-def get_target_values(chip_state, target_chips, voltage):
-    return [
-        iv_measurement.anode_current_corrected or iv_measurement.anode_current
-        for chip in target_chips
-        for iv_measurement in chip.iv_measurements
-        if iv_measurement.voltage_input == voltage
-        and iv_measurement.chip_state_id == chip_state.id
-    ]
+def get_sheet_index(groups: pd.DataFrame, iteration_orders: dict[str, list]) -> pd.MultiIndex:
+    """
+    Returns (wafer, chip state) rows in the order they are first met when iterating over wafers,
+    chip types, voltages and chip states, which keeps the sheets layout stable.
+    """
+    positions = pd.DataFrame({
+        key: groups[key].map({value: i for i, value in enumerate(order)})
+        for key, order in iteration_orders.items()
+    })
+    first_met = groups.loc[positions.sort_values(['wafer', 'type', 'voltage', 'chip']).index] \
+        .drop_duplicates(['wafer', 'chip'])
+    return pd.MultiIndex.from_frame(first_met[['wafer', 'chip']])
+
+
+def to_sheet(groups: pd.DataFrame, value_column: str, index: pd.MultiIndex,
+             columns: pd.MultiIndex) -> pd.DataFrame:
+    pivot = groups.pivot(index=['wafer', 'chip'], columns=['voltage', 'type'], values=value_column)
+    voltages_and_types = pd.MultiIndex.from_arrays(
+        [columns.get_level_values(0), columns.get_level_values(1)])
+    return pivot.reindex(index=index, columns=voltages_and_types).set_axis(columns, axis=1)
@@ -1,5 +1,3 @@
-import os
-import subprocess
 import time
 from typing import Optional
 
@@ -7,9 +5,10 @@ import click
 import keyring
 import sqlalchemy.engine as engine
 from sqlalchemy import create_engine
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import OperationalError, DBAPIError
 
 from utils import get_db_url, logger
+from .dump import dump_database, load_dump
 
 
 @click.command(name='set', help='Set database credentials.')
@@ -29,58 +28,82 @@ def set_db():
             'Cannot connect to the database with given credentials. Saving credentials is rejected.')
 
 
-@click.command(name='dump', help='Dump database to .sql.gz file.')
-@click.pass_context
-@click.option('--limit', '-l', type=int, help='Limit number of rows in each table.')
-def dump_db(ctx: click.Context, limit: Optional[int]):
+def get_command_db_url(ctx: click.Context) -> engine.URL:
     try:
-        db_url = engine.create_engine(ctx.parent.parent.params['db_url']).url
+        return engine.create_engine(ctx.parent.parent.params['db_url']).url
     except (KeyError, AttributeError):
-        db_url = get_db_url(username=keyring.get_password("ELFYS_DB", "USER"),
-                            password=keyring.get_password("ELFYS_DB", "PASSWORD"))
+        return get_db_url(username=keyring.get_password("ELFYS_DB", "USER"),
+                          password=keyring.get_password("ELFYS_DB", "PASSWORD"))
+
 
+@click.command(name='dump', help='Dump database to a directory of zstd-compressed chunks.')
+@click.pass_context
+@click.option('--limit', '-l', type=click.IntRange(min=1),
+              help='Dump only the latest wafers and rows related to them.')
+@click.option('-o', '--output', 'directory',
+              default=lambda: f'dump_{time.strftime("%Y%m%d_%H%M%S")}',
+              help='Output directory.', show_default='dump_{datetime}')
+@click.option('-j', '--jobs', default=4, show_default=True, type=click.IntRange(min=1),
+              help='Number of tables dumped in parallel.')
+@click.option('--chunk-rows', default=100000, show_default=True, type=click.IntRange(min=1),
+              help='Number of rows in every compressed chunk.')
+@click.option('--compression-level', default=3, show_default=True, type=click.IntRange(1, 22),
+              help='Zstandard compression level.')
+@click.option('--since', 'base_directory', type=click.Path(exists=True, file_okay=False),
+              help='Previous dump directory. Only measurements added after it are dumped.')
+@click.option('--resume', is_flag=True, default=False,
+              help='Continue an interrupted dump in the output directory.')
+def dump_db(ctx: click.Context, limit: Optional[int], directory: str, jobs: int, chunk_rows: int,
+            compression_level: int, base_directory: Optional[str], resume: bool):
+    db_url = get_command_db_url(ctx)
     logger.info("Saving database dump... This may take a while.")
+    started_at = time.perf_counter()
+    try:
+        manifest = dump_database(create_engine(db_url), directory, jobs, chunk_rows,
+                                 compression_level, limit, base_directory, resume)
+    except (DBAPIError, OSError, ValueError) as e:
+        logger.error(f'Error while dumping database: {e}')
+        ctx.exit(1)
 
-    dump_file = f'dump_{time.strftime("%Y%m%d_%H%M%S")}.sql.gz'
-    command = f'docker run --rm -i mysql:latest \
-        mysqldump --no-tablespaces --host={db_url.host} --port={db_url.port} \
-        --user={db_url.username} -p {db_url.database}'
-    if limit:
-        command = f'{command} --where="1 limit {limit}"'
-    mysqldump = subprocess.Popen(
-        command,
-        shell=True, text=True,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-    mysqldump.stdin.write(db_url.password + os.linesep)
-    mysqldump.stdin.flush()
-
-    gzip = subprocess.Popen(f'gzip -9 > {dump_file}', shell=True, text=True,
-                            stdin=mysqldump.stdout,
-                            stderr=subprocess.PIPE)
-
-    mysqldump.wait()
-    output, error = mysqldump.communicate()
-    error = error.replace('Enter password: ', '')
-    if error:
-        logger.warning(error)
-    if mysqldump.returncode != 0:
-        logger.error(f'Error while dumping database')
-        ctx.exit(mysqldump.returncode)
-
-    output, error = gzip.communicate()
-    if error:
-        logger.warning(error)
-    if gzip.returncode != 0:
-        logger.error(f'Error while compressing dump')
-        ctx.exit(gzip.returncode)
-
-    logger.info(f"Database dumped to {dump_file}")
+    rows_count = sum(table['rows'] for table in manifest.tables.values())
+    logger.info(f"Database dumped to {directory}: {rows_count} rows "
+                f"in {time.perf_counter() - started_at:.1f}s")
     return db_url
 
 
+@click.command(name='load', help='Load a dump made by the dump command into database.')
+@click.pass_context
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('-j', '--jobs', default=4, show_default=True, type=click.IntRange(min=1),
+              help='Number of tables loaded in parallel.')
+@click.option('--method', default='load-data', show_default=True,
+              type=click.Choice(['load-data', 'insert']),
+              help='Load chunks with LOAD DATA LOCAL INFILE (MySQL with local_infile enabled) or '
+                   'with multi-row inserts.')
+@click.option('-y', '--yes', is_flag=True, default=False,
+              help='Replace rows of the database without confirmation.')
+def load_db(ctx: click.Context, directory: str, jobs: int, method: str, yes: bool):
+    db_url = get_command_db_url(ctx)
+    load_data = method == 'load-data' and db_url.get_backend_name() == 'mysql'
+    db_engine = create_engine(db_url, connect_args={'local_infile': 1} if load_data else {})
+    if not yes:
+        click.confirm(f'Tables of {db_url.database} are replaced by the dump. Continue?',
+                      abort=True)
+
+    logger.info(f"Loading {directory} into database... This may take a while.")
+    started_at = time.perf_counter()
+    try:
+        rows_count = load_dump(db_engine, directory, jobs, load_data)
+    except (DBAPIError, OSError, ValueError) as e:
+        logger.error(f'Error while loading dump: {e}')
+        ctx.exit(1)
+
+    elapsed = time.perf_counter() - started_at
+    logger.info(f"{rows_count} rows loaded in {elapsed:.1f}s "
+                f"({rows_count / max(elapsed, 1e-9):.0f} rows/s)")
+
+
 @click.group(name="db", help="Set of commands to manage related database",
-             commands=[set_db, dump_db])
+             commands=[set_db, dump_db, load_db])
 def db_group():
     ...
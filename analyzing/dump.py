@@ -0,0 +1,457 @@
+import json
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Any, Iterable, Optional
+
+import zstandard
+from sqlalchemy import Table, Column, select, func, inspect, text, and_
+from sqlalchemy.engine import Engine, Connection
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql import ColumnElement
+
+from orm import Base, Wafer
+from utils import logger
+
+DUMP_FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+CHUNK_EXTENSION = '.tsv.zst'
+# rows of these tables are never updated, incremental dumps only contain rows added since the base
+APPEND_ONLY_TABLES = {'iv_data', 'cv_data', 'eqe_conditions', 'eqe_data'}
+
+
+def get_dump_tables() -> list[Table]:
+    return [table for table in Base.metadata.sorted_tables if not table.info.get('is_view', False)]
+
+
+def get_dump_columns(table: Table) -> list[Column]:
+    # generated columns are computed again by the database on load
+    return [column for column in table.columns if column.computed is None]
+
+
+def encode_value(value: Any) -> str:
+    """Encodes a value in the default format of MySQL LOAD DATA: tab separated, \\N for NULL."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n') \
+        .replace('\r', '\\r').replace('\0', '\\0')
+
+
+def encode_rows(rows: Iterable[tuple]) -> bytes:
+    return ''.join('\t'.join(map(encode_value, row)) + '\n' for row in rows).encode()
+
+
+class DumpManifest:
+    """
+    Description of a dump directory: schema, primary key watermarks and written chunks of every
+    table. It is saved after every chunk, so an interrupted dump can be resumed.
+    """
+
+    def __init__(self, directory: str, data: dict):
+        self.directory = directory
+        self.data = data
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, directory: str) -> 'DumpManifest':
+        with open(os.path.join(directory, MANIFEST_FILE)) as file:
+            data = json.load(file)
+        if data['format_version'] != DUMP_FORMAT_VERSION:
+            raise ValueError(f"Unsupported dump format version {data['format_version']}")
+        return cls(directory, data)
+
+    @property
+    def tables(self) -> dict[str, dict]:
+        return self.data['tables']
+
+    def save(self):
+        path = os.path.join(self.directory, MANIFEST_FILE)
+        with self.lock:
+            with open(path + '.part', 'w') as file:
+                json.dump(self.data, file, indent=2)
+            os.replace(path + '.part', path)
+
+    def add_chunk(self, table_name: str, chunk: dict):
+        with self.lock:
+            self.tables[table_name]['chunks'].append(chunk)
+            self.tables[table_name]['rows'] += chunk['rows']
+        self.save()
+
+    def complete_table(self, table_name: str):
+        with self.lock:
+            self.tables[table_name]['done'] = True
+        self.save()
+
+
+def get_create_statements(connection: Connection, names: Iterable[str]) -> dict[str, str]:
+    """DDL of tables and views as the database reports it."""
+    statements = {}
+    for name in names:
+        if connection.dialect.name == 'sqlite':
+            statements[name] = connection.execute(
+                text("SELECT sql FROM sqlite_master WHERE name = :name"), {'name': name}).scalar()
+        else:
+            statements[name] = connection.exec_driver_sql(f'SHOW CREATE TABLE `{name}`').first()[1]
+    return statements
+
+
+def get_alembic_revision(connection: Connection) -> Optional[str]:
+    if not inspect(connection).has_table('alembic_version'):
+        return None
+    return connection.execute(text('SELECT version_num FROM alembic_version')).scalar()
+
+
+def get_subset_condition(table: Table, wafer_ids: Optional[list[int]]) -> Optional[ColumnElement]:
+    """
+    Condition selecting rows of the given wafers: rows of the wafer table itself and rows
+    referencing them through foreign keys (chips, their measurements, etc.). Tables not related to
+    wafers are dumped completely.
+    """
+    if wafer_ids is None:
+        return None
+    if table.name == Wafer.__tablename__:
+        return table.c.id.in_(wafer_ids)
+    conditions = []
+    for foreign_key in table.foreign_keys:
+        parent = foreign_key.column.table
+        parent_condition = get_subset_condition(parent, wafer_ids)
+        if parent_condition is not None:
+            conditions.append(foreign_key.parent.in_(
+                select(foreign_key.column).where(parent_condition).scalar_subquery()))
+    return and_(*conditions) if conditions else None
+
+
+def begin_snapshot(connection: Connection):
+    # every connection of a dump sees the same data if snapshots are started under the global lock
+    if connection.dialect.name == 'mysql':
+        connection.exec_driver_sql('SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        connection.exec_driver_sql('START TRANSACTION WITH CONSISTENT SNAPSHOT')
+
+
+def lock_tables(connection: Connection) -> bool:
+    if connection.dialect.name != 'mysql':
+        return False
+    try:
+        connection.exec_driver_sql('FLUSH TABLES WITH READ LOCK')
+        return True
+    except DBAPIError as e:
+        logger.warning(f'Cannot lock tables ({e.orig}), workers may see different snapshots. '
+                       f'Rows added during the dump are still excluded by primary key watermarks.')
+        return False
+
+
+def create_manifest(connection: Connection, directory: str, tables: list[Table],
+                    limit: Optional[int], base: Optional[DumpManifest]) -> DumpManifest:
+    """Captures schema and primary key watermarks of all tables inside the snapshot."""
+    wafer_ids = None
+    if limit is not None:
+        wafer_ids = connection.execute(
+            select(Wafer.id).order_by(Wafer.record_created_at.desc(), Wafer.id.desc()).limit(limit)
+        ).scalars().all()
+
+    create_statements = get_create_statements(connection, [table.name for table in tables])
+    views = get_create_statements(connection, inspect(connection).get_view_names())
+    tables_data = {}
+    for table in tables:
+        start_after = None
+        if base is not None and table.name in APPEND_ONLY_TABLES:
+            start_after = base.tables[table.name]['watermark']
+        tables_data[table.name] = {
+            'create': create_statements[table.name],
+            'columns': [column.name for column in get_dump_columns(table)],
+            'watermark': connection.execute(select(func.max(table.c.id))).scalar(),
+            'start_after': start_after,
+            'incremental': start_after is not None,
+            'chunks': [],
+            'rows': 0,
+            'done': False,
+        }
+    return DumpManifest(directory, {
+        'format_version': DUMP_FORMAT_VERSION,
+        'created_at': datetime.now().isoformat(sep=' ', timespec='seconds'),
+        'dialect': connection.dialect.name,
+        'alembic_revision': get_alembic_revision(connection),
+        'base': os.path.relpath(base.directory, directory) if base is not None else None,
+        'wafer_ids': wafer_ids,
+        'views': views,
+        'tables': tables_data,
+    })
+
+
+def dump_table(connection: Connection, table: Table, manifest: DumpManifest, chunk_rows: int,
+               compressor: zstandard.ZstdCompressor):
+    """Streams rows of the table in primary key order to chunk files up to the watermark."""
+    table_data = manifest.tables[table.name]
+    watermark = table_data['watermark']
+    chunks = table_data['chunks']
+    last_key = chunks[-1]['last_key'] if chunks else table_data['start_after']
+    query = select(*get_dump_columns(table)).order_by(table.c.id).limit(chunk_rows)
+    subset_condition = get_subset_condition(table, manifest.data['wafer_ids'])
+    if subset_condition is not None:
+        query = query.where(subset_condition)
+    table_directory = os.path.join(manifest.directory, table.name)
+    os.makedirs(table_directory, exist_ok=True)
+
+    started_at = time.perf_counter()
+    rows_count = 0
+    while watermark is not None and (last_key is None or last_key < watermark):
+        chunk_query = query.where(table.c.id <= watermark)
+        if last_key is not None:
+            chunk_query = chunk_query.where(table.c.id > last_key)
+        rows = connection.execute(chunk_query).all()
+        if not rows:
+            break
+        file_name = f'{len(chunks):06d}{CHUNK_EXTENSION}'
+        path = os.path.join(table_directory, file_name)
+        with open(path + '.part', 'wb') as file:
+            file.write(compressor.compress(encode_rows(rows)))
+        os.replace(path + '.part', path)
+        last_key = rows[-1].id
+        manifest.add_chunk(table.name, {'file': f'{table.name}/{file_name}', 'rows': len(rows),
+                                        'first_key': rows[0].id, 'last_key': last_key})
+        rows_count += len(rows)
+        logger.debug(f'{table.name}: {table_data["rows"]} rows dumped')
+    manifest.complete_table(table.name)
+
+    elapsed = time.perf_counter() - started_at
+    logger.info(f'{table.name}: {rows_count} rows dumped in {elapsed:.1f}s '
+                f'({rows_count / max(elapsed, 1e-9):.0f} rows/s)')
+
+
+def dump_database(engine: Engine, directory: str, jobs: int, chunk_rows: int,
+                  compression_level: int, limit: Optional[int] = None,
+                  base_directory: Optional[str] = None, resume: bool = False) -> DumpManifest:
+    """
+    Dumps tables to zstd-compressed chunks of tab separated rows, one worker thread per table.
+    Workers read inside consistent snapshots started under a global read lock (MySQL), and rows
+    of every table are bounded by the primary key watermark taken in the same snapshot.
+    """
+    tables = get_dump_tables()
+    lock_connection = engine.connect()
+    try:
+        locked = lock_tables(lock_connection)
+        with lock_connection.begin():
+            begin_snapshot(lock_connection)
+            if resume:
+                manifest = DumpManifest.load(directory)
+                logger.info(f'Resuming dump {directory}')
+            else:
+                base = DumpManifest.load(base_directory) if base_directory is not None else None
+                os.makedirs(directory)
+                manifest = create_manifest(lock_connection, directory, tables, limit, base)
+                manifest.save()
+
+        pending_tables = queue.Queue()
+        for table in tables:
+            if not manifest.tables[table.name]['done']:
+                pending_tables.put(table)
+        workers_count = max(1, min(jobs, pending_tables.qsize()))
+        snapshots_started = threading.Barrier(workers_count + 1)
+        errors = []
+
+        def work():
+            connection = engine.connect()
+            try:
+                with connection.begin():
+                    begin_snapshot(connection)
+                    snapshots_started.wait()
+                    compressor = zstandard.ZstdCompressor(level=compression_level)
+                    while not errors:
+                        try:
+                            table = pending_tables.get_nowait()
+                        except queue.Empty:
+                            break
+                        dump_table(connection, table, manifest, chunk_rows, compressor)
+            except Exception as e:
+                errors.append(e)
+                snapshots_started.abort()
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=work, name=f'dump-{i}') for i in range(workers_count)]
+        for worker in workers:
+            worker.start()
+        try:
+            snapshots_started.wait()
+        except threading.BrokenBarrierError:
+            pass
+        if locked:
+            lock_connection.exec_driver_sql('UNLOCK TABLES')
+        for worker in workers:
+            worker.join()
+    finally:
+        lock_connection.close()
+
+    if errors:
+        raise errors[0]
+    return manifest
+
+
+ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', '0': '\0'}
+
+
+def decode_value(value: str) -> Optional[str]:
+    if value == '\\N':
+        return None
+    return re.sub(r'\\(.)', lambda match: ESCAPES.get(match[1], match[1]), value)
+
+
+def decode_rows(data: bytes) -> list[tuple]:
+    return [tuple(map(decode_value, line.split('\t'))) for line in data.decode().split('\n')[:-1]]
+
+
+def get_dump_chain(directory: str) -> list[DumpManifest]:
+    """Manifests of the dump and its bases, the full dump first."""
+    chain = [DumpManifest.load(directory)]
+    while chain[0].data['base'] is not None:
+        chain.insert(0, DumpManifest.load(
+            os.path.normpath(os.path.join(chain[0].directory, chain[0].data['base']))))
+    return chain
+
+
+def set_checks(connection: Connection, enabled: bool):
+    if connection.dialect.name == 'mysql':
+        connection.exec_driver_sql(f'SET FOREIGN_KEY_CHECKS = {int(enabled)}')
+        connection.exec_driver_sql(f'SET UNIQUE_CHECKS = {int(enabled)}')
+    else:
+        connection.exec_driver_sql(f'PRAGMA foreign_keys = {int(enabled)}')
+
+
+def create_schema(connection: Connection, manifest: DumpManifest):
+    """Creates tables and views of the dump missing in the database."""
+    existing_tables = set(inspect(connection).get_table_names())
+    same_dialect = manifest.data['dialect'] == connection.dialect.name
+    for table in get_dump_tables():
+        if table.name in existing_tables:
+            continue
+        if same_dialect:
+            connection.exec_driver_sql(manifest.tables[table.name]['create'])
+        else:
+            table.create(connection)
+    if not same_dialect:
+        logger.warning(f"Views are not created, the dump is made from {manifest.data['dialect']}")
+        return
+    existing_views = set(inspect(connection).get_view_names())
+    for name, statement in manifest.data['views'].items():
+        if name not in existing_views:
+            # the definer of the source database may not exist in the target one
+            connection.exec_driver_sql(re.sub(r'DEFINER=\S+ (SQL SECURITY DEFINER )?', '',
+                                              statement))
+
+
+def set_alembic_revision(connection: Connection, revision: Optional[str]):
+    if revision is None:
+        return
+    connection.exec_driver_sql('CREATE TABLE IF NOT EXISTS alembic_version '
+                               '(version_num VARCHAR(32) NOT NULL PRIMARY KEY)')
+    connection.execute(text('DELETE FROM alembic_version'))
+    connection.execute(text('INSERT INTO alembic_version VALUES (:revision)'),
+                       {'revision': revision})
+
+
+def load_chunk(connection: Connection, table_name: str, columns: list[str], data: bytes,
+               load_data: bool) -> int:
+    """Loads one decompressed chunk with LOAD DATA LOCAL INFILE or multi-row inserts."""
+    if load_data:
+        with tempfile.NamedTemporaryFile(suffix='.tsv', delete=False) as file:
+            file.write(data)
+        try:
+            path = file.name.replace('\\', '/')
+            return connection.exec_driver_sql(
+                f"LOAD DATA LOCAL INFILE '{path}' INTO TABLE `{table_name}` "
+                f"({', '.join(f'`{column}`' for column in columns)})").rowcount
+        finally:
+            os.remove(file.name)
+    rows = decode_rows(data)
+    placeholder = '%s' if connection.dialect.paramstyle == 'format' else '?'
+    quote = connection.dialect.identifier_preparer.quote
+    connection.exec_driver_sql(
+        f"INSERT INTO {quote(table_name)} ({', '.join(map(quote, columns))}) "
+        f"VALUES ({', '.join([placeholder] * len(columns))})", rows)
+    return len(rows)
+
+
+def load_table(connection: Connection, manifest: DumpManifest, table_name: str, load_data: bool):
+    table_data = manifest.tables[table_name]
+    decompressor = zstandard.ZstdDecompressor()
+    quoted_name = connection.dialect.identifier_preparer.quote(table_name)
+    started_at = time.perf_counter()
+    rows_count = 0
+    set_checks(connection, False)
+    try:
+        if not table_data['incremental']:
+            # TRUNCATE recreates the table instead of deleting its rows one by one
+            clear = 'TRUNCATE TABLE' if connection.dialect.name == 'mysql' else 'DELETE FROM'
+            with connection.begin():
+                connection.exec_driver_sql(f'{clear} {quoted_name}')
+        for chunk in table_data['chunks']:
+            with open(os.path.join(manifest.directory, chunk['file']), 'rb') as file:
+                data = decompressor.decompress(file.read())
+            with connection.begin():
+                rows_count += load_chunk(connection, table_name, table_data['columns'], data,
+                                         load_data)
+    finally:
+        set_checks(connection, True)
+
+    elapsed = time.perf_counter() - started_at
+    logger.info(f'{table_name}: {rows_count} rows loaded in {elapsed:.1f}s '
+                f'({rows_count / max(elapsed, 1e-9):.0f} rows/s)')
+    return rows_count
+
+
+def load_dump(engine: Engine, directory: str, jobs: int, load_data: bool) -> int:
+    """
+    Loads a dump and its bases into the database, tables of every dump in parallel. Full tables
+    replace rows of the database, tables of incremental dumps are appended. Returns the number of
+    loaded rows.
+    """
+    chain = get_dump_chain(directory)
+    if any(not table['done'] for manifest in chain for table in manifest.tables.values()):
+        raise ValueError(f'Dump {directory} is not complete, resume it first')
+    with engine.begin() as connection:
+        create_schema(connection, chain[0])
+
+    rows_count = 0
+    for manifest in chain:
+        logger.info(f'Loading {manifest.directory}...')
+        pending_tables = queue.Queue()
+        for table_name, table_data in manifest.tables.items():
+            pending_tables.put(table_name)
+        counts = []
+        errors = []
+
+        def work():
+            try:
+                with engine.connect() as connection:
+                    while not errors:
+                        try:
+                            table_name = pending_tables.get_nowait()
+                        except queue.Empty:
+                            break
+                        counts.append(load_table(connection, manifest, table_name, load_data))
+            except Exception as e:
+                errors.append(e)
+
+        workers = [threading.Thread(target=work, name=f'load-{i}')
+                   for i in range(max(1, min(jobs, pending_tables.qsize())))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+        rows_count += sum(counts)
+
+    with engine.begin() as connection:
+        set_alembic_revision(connection, chain[-1].data['alembic_revision'])
+    return rows_count
@@ -0,0 +1,103 @@
+from datetime import timedelta
+from typing import Optional
+
+import click
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from orm import MeasurementJob, ChipState
+from utils import logger, validate_chip_names, validate_wafer_name, read_wafer_map
+
+JOB_STATUSES = ('queued', 'running', 'done', 'failed', 'cancelled')
+
+
+@click.command(name='add', help="Queue a measurement job for stations running `measure worker` "
+                                "with the config.")
+@click.pass_context
+@click.option("-w", "--wafer", "wafer_name", required=True, callback=validate_wafer_name,
+              help="Wafer name.")
+@click.option("-n", "--chip-name", "chip_names", help="Chip name. Can be repeated.",
+              callback=validate_chip_names, multiple=True, default=[])
+@click.option("-m", "--wafer-map", "wafer_map_path", type=click.Path(exists=True, dir_okay=False),
+              help="Text file with chip names in measurement order, separated by commas or "
+                   "whitespace.")
+@click.option("-s", "--chip-state", "chip_state_id", required=True, type=int,
+              help="State of the chips.")
+@click.option("-c", "--config", "config", required=True,
+              help="File name of the measure config, e.g. single-innopoli.yaml.")
+@click.option("-t", "--type", "measurement_type", type=click.Choice(['iv', 'cv']), default='iv',
+              show_default=True, help="Type of measurements of the config.")
+@click.option("-p", "--priority", default=0, show_default=True, type=int,
+              help="Jobs with higher priority are measured first.")
+def add_job(ctx: click.Context, wafer_name: str, chip_names: list[str],
+            wafer_map_path: Optional[str], chip_state_id: int, config: str, measurement_type: str,
+            priority: int):
+    session: Session = ctx.obj['session']
+    if wafer_map_path is not None:
+        chip_names = chip_names + validate_chip_names(ctx, ..., read_wafer_map(wafer_map_path))
+    if not chip_names:
+        raise click.BadParameter('No chips are given', param_hint='--chip-name')
+    if session.get(ChipState, chip_state_id) is None:
+        raise click.BadParameter(f'Chip state {chip_state_id} is not found',
+                                 param_hint='--chip-state')
+    job = MeasurementJob(wafer_name=wafer_name, chip_names=','.join(dict.fromkeys(chip_names)),
+                         chip_state_id=chip_state_id, measurement_type=measurement_type,
+                         config=config, priority=priority)
+    session.add(job)
+    session.commit()
+    logger.info(f'Job {job.id} of {len(chip_names)} chips is queued for {config}')
+
+
+@click.command(name='list', help="List measurement jobs.")
+@click.pass_context
+@click.option("--status", "statuses", type=click.Choice(JOB_STATUSES), multiple=True,
+              default=['queued', 'running'], show_default=True, help="Status of jobs.")
+def list_jobs(ctx: click.Context, statuses: tuple[str]):
+    session: Session = ctx.obj['session']
+    jobs = session.query(MeasurementJob) \
+        .filter(MeasurementJob.status.in_(statuses)) \
+        .order_by(MeasurementJob.priority.desc(), MeasurementJob.id) \
+        .all()
+    for job in jobs:
+        click.echo(f'{job.id:<6} {job.priority:>4} {job.status:<10} {job.wafer_name:<10} '
+                   f'{len(job.get_chip_names()):>4} chips  {job.measurement_type} '
+                   f'{job.config:<24} {job.station or "":<16} {job.error or ""}')
+
+
+@click.command(name='cancel', help="Cancel queued measurement jobs.")
+@click.pass_context
+@click.argument("job_ids", type=int, nargs=-1, required=True)
+def cancel_jobs(ctx: click.Context, job_ids: tuple[int]):
+    session: Session = ctx.obj['session']
+    cancelled = session.query(MeasurementJob) \
+        .filter(MeasurementJob.id.in_(job_ids), MeasurementJob.status == 'queued') \
+        .update({MeasurementJob.status: 'cancelled'}, synchronize_session=False)
+    session.commit()
+    logger.info(f'{cancelled} of {len(job_ids)} jobs are cancelled')
+
+
+@click.command(name='stations', help="Show how long jobs of every station waited in queue and "
+                                     "how many jobs wait now.")
+@click.pass_context
+def show_stations(ctx: click.Context):
+    session: Session = ctx.obj['session']
+    waits: dict[str, list[timedelta]] = {}
+    for station, created_at, claimed_at in session.query(
+            MeasurementJob.station, MeasurementJob.created_at, MeasurementJob.claimed_at) \
+            .filter(MeasurementJob.station.isnot(None), MeasurementJob.claimed_at.isnot(None)):
+        waits.setdefault(station, []).append(claimed_at - created_at)
+    for station, station_waits in sorted(waits.items()):
+        mean_wait = sum(station_waits, timedelta()) / len(station_waits)
+        click.echo(f'{station:<20} {len(station_waits):>5} jobs, wait in queue mean '
+                   f'{timedelta(seconds=round(mean_wait.total_seconds()))}, max '
+                   f'{max(station_waits)}')
+    for config, count in session.query(MeasurementJob.config, func.count(MeasurementJob.id)) \
+            .filter(MeasurementJob.status == 'queued') \
+            .group_by(MeasurementJob.config):
+        click.echo(f'{config:<20} {count:>5} jobs queued')
+
+
+@click.group(name='jobs', help="Manage measurement jobs shared by stations",
+             commands=[add_job, list_jobs, cancel_jobs, show_stations])
+def jobs():
+    pass
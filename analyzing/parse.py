@@ -20,7 +20,8 @@ from orm import (
     EqeSession,
     Carrier
 )
-from utils import logger, validate_wafer_name, remember_choice, validate_files_glob
+from utils import logger, validate_wafer_name, remember_choice, validate_files_glob, \
+    snap_voltage_keys
 
 
 @click.command(name='parse-iv', help="Parse IV measurements")
@@ -271,12 +272,14 @@ def parse_epg_dat_file(file_path: Path) -> dict[str, Union[datetime, pd.DataFram
 
 def create_iv_measurements(data: pd.DataFrame, timestamp: datetime, chip: Chip,
                            chip_state: ChipState) -> Generator[IVMeasurement, None, None]:
-    for idx, row in data.iterrows():
+    voltage_keys = snap_voltage_keys(data['VCA'])
+    for voltage_key, (idx, row) in zip(voltage_keys, data.iterrows()):
         yield IVMeasurement(
             chip=chip,
             int_time='MED',
             chip_state=chip_state,
             voltage_input=row['VCA'],
+            voltage_key=int(voltage_key),
             anode_current=row['IAN'],
             cathode_current=row['ICA'],
             datetime=timestamp)
@@ -284,11 +287,13 @@ def create_iv_measurements(data: pd.DataFrame, timestamp: datetime, chip: Chip,
 
 def create_cv_measurements(data: pd.DataFrame, timestamp: datetime, chip: Chip,
                            chip_state: ChipState) -> Generator[CVMeasurement, None, None]:
-    for idx, row in data.iterrows():
+    voltage_keys = snap_voltage_keys(data['BIAS'])
+    for voltage_key, (idx, row) in zip(voltage_keys, data.iterrows()):
         yield CVMeasurement(
             chip=chip,
             chip_state=chip_state,
             voltage_input=row['BIAS'],
+            voltage_key=int(voltage_key),
             capacitance=row['C'],
             datetime=timestamp)
 
@@ -0,0 +1,94 @@
+from typing import Any, Optional, Union
+
+import click
+from sqlalchemy import select, func, and_
+from sqlalchemy.orm import Query, aliased
+from sqlalchemy.sql import ColumnElement
+
+from orm import Chip
+
+REGION_HELP = """Region of the wafer in coordinates of every chip type.
+
+\b
+rect:X1,Y1,X2,Y2 - inside the rectangle;
+ring:R1,R2 - R1 to R2 chips from the center;
+edge:N - at least N chips away from the edge."""
+
+
+def grid_bound(aggregate, coordinate: str) -> ColumnElement:
+    """Minimal or maximal coordinate among the chips of the same wafer and type."""
+    other = aliased(Chip)
+    return select(aggregate(getattr(other, coordinate))) \
+        .where(other.wafer_id == Chip.wafer_id, other.type == Chip.type) \
+        .scalar_subquery()
+
+
+class Rectangle:
+    def __init__(self, x1: int, y1: int, x2: int, y2: int):
+        self.x1, self.x2 = sorted((x1, x2))
+        self.y1, self.y2 = sorted((y1, y2))
+
+    def condition(self) -> ColumnElement:
+        return and_(Chip.x_coordinate.between(self.x1, self.x2),
+                    Chip.y_coordinate.between(self.y1, self.y2))
+
+
+class Ring:
+    def __init__(self, inner_radius: float, outer_radius: float):
+        self.inner_radius, self.outer_radius = sorted((inner_radius, outer_radius))
+
+    def condition(self) -> ColumnElement:
+        # doubled distance to the center avoids halves and the square root
+        dx = 2 * Chip.x_coordinate - grid_bound(func.min, 'x_coordinate') \
+            - grid_bound(func.max, 'x_coordinate')
+        dy = 2 * Chip.y_coordinate - grid_bound(func.min, 'y_coordinate') \
+            - grid_bound(func.max, 'y_coordinate')
+        return (dx * dx + dy * dy).between(4 * self.inner_radius ** 2,
+                                           4 * self.outer_radius ** 2)
+
+
+class EdgeExclusion:
+    def __init__(self, width: int):
+        self.width = width
+
+    def condition(self) -> ColumnElement:
+        return and_(*(
+            column.between(grid_bound(func.min, column.key) + self.width,
+                           grid_bound(func.max, column.key) - self.width)
+            for column in (Chip.x_coordinate, Chip.y_coordinate)
+        ))
+
+
+Region = Union[Rectangle, Ring, EdgeExclusion]
+
+
+class RegionType(click.ParamType):
+    name = 'region'
+    shapes = {
+        'rect': (Rectangle, int, 4),
+        'ring': (Ring, float, 2),
+        'edge': (EdgeExclusion, int, 1),
+    }
+
+    def convert(self, value: Any, param: Optional[click.Parameter],
+                ctx: Optional[click.Context]) -> Any:
+        if not isinstance(value, str):
+            return value
+        shape, _, arguments = value.partition(':')
+        if shape not in self.shapes:
+            self.fail(f"Unknown region {shape}. Use one of: {', '.join(self.shapes)}.", param, ctx)
+        region_class, argument_type, arguments_count = self.shapes[shape]
+        try:
+            arguments = [argument_type(argument) for argument in arguments.split(',')]
+        except ValueError:
+            self.fail(f"Invalid {shape} region arguments: {arguments}.", param, ctx)
+        if len(arguments) != arguments_count:
+            self.fail(f"{shape} region expects {arguments_count} arguments.", param, ctx)
+        return region_class(*arguments)
+
+
+def filter_region(query: Query, region: Optional[Region]) -> Query:
+    """Filters a query joined with chips by a region, the region is evaluated in the database."""
+    if region is None:
+        return query
+    return query.filter(region.condition())
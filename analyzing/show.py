@@ -1,12 +1,75 @@
+import csv
+from datetime import datetime
+from typing import Iterable, Optional, Union
+
 import click
-import pandas as pd
-from IPython.display import display
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import func
+from sqlalchemy.orm import Session, Query
 
 from orm import Wafer, Chip
+from utils import flatten_options
+from .stream import iter_keyset_pages
+from .summary import date_formats, date_formats_help
+
+
+def filter_options(command):
+    options = [
+        click.option("-w", "--wafer", "wafer_pattern",
+                     help="Wafer name pattern, * matches any characters (e.g. AB*)."),
+        click.option("-b", "--batch", "batch_pattern",
+                     help="Batch id pattern, * matches any characters (e.g. S*22*)."),
+        click.option("--before", type=click.DateTime(formats=date_formats),
+                     help=f"Include wafers created before (exclusive) provided date and time. "
+                          f"{date_formats_help}"),
+        click.option("--after", type=click.DateTime(formats=date_formats),
+                     help=f"Include wafers created after (inclusive) provided date and time. "
+                          f"{date_formats_help}"),
+        click.option("-n", "--limit", type=click.IntRange(min=1),
+                     help="Maximum number of rows to show. All rows are shown by default."),
+        click.option("--page-size", default=1000, show_default=True, type=click.IntRange(min=1),
+                     help="Number of rows fetched from database at once."),
+        click.option("-o", "--output", "file_name",
+                     help="Write rows to csv file instead of the terminal."),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def apply_wafer_filters(query: Query, wafer_pattern: Optional[str], batch_pattern: Optional[str],
+                        before: Optional[datetime], after: Optional[datetime]) -> Query:
+    if wafer_pattern is not None:
+        query = query.filter(Wafer.name.like(wafer_pattern.replace('*', '%')))
+    if batch_pattern is not None:
+        query = query.filter(Wafer.batch_id.like(batch_pattern.replace('*', '%')))
+    if before is not None:
+        query = query.filter(Wafer.record_created_at < before)
+    if after is not None:
+        query = query.filter(Wafer.record_created_at >= after)
+    return query
+
 
+def write_rows(pages: Iterable[list], header: list[str], widths: list[int],
+               file_name: Optional[str]):
+    """Writes rows page by page to the terminal or to a csv file, so only one page is in memory."""
+    if file_name is not None:
+        with open(file_name, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(header)
+            for page in pages:
+                writer.writerows(page)
+        return
 
-@click.command(name='wafers', help="""Show all wafers.
+    def format_row(values) -> str:
+        return '  '.join(f'{"" if value is None else value!s:<{width}}'
+                         for value, width in zip(values, widths)).rstrip()
+
+    click.echo(format_row(header))
+    for page in pages:
+        click.echo('\n'.join(map(format_row, page)))
+
+
+@click.command(name='wafers', help="""Show wafers.
 
 \b Batch id is a unique identifier decoding the batch production information.
 
@@ -17,27 +80,47 @@ from orm import Wafer, Chip
 (>1200ohm-cm), 22 - year, 36 - week, B - split batch (if applicable)
 """)
 @click.pass_context
-def wafers(ctx: click.Context):
+@filter_options
+def wafers(ctx: click.Context, wafer_pattern: Optional[str], batch_pattern: Optional[str],
+           before: Union[datetime, None], after: Union[datetime, None], limit: Optional[int],
+           page_size: int, file_name: Optional[str]):
     session: Session = ctx.obj['session']
-    wafer_entities = session.query(Wafer).order_by(Wafer.record_created_at).options(
-        joinedload(Wafer.chips)).all()
-    data = pd.DataFrame([wafer.to_series() for wafer in wafer_entities])
-    display(data.to_string(col_space=[10, 25, 10, 8]))
+    # counted per wafer of the page through the chip.wafer_id index
+    chips_count = session.query(func.count(Chip.id)) \
+        .filter(Chip.wafer_id == Wafer.id) \
+        .correlate(Wafer) \
+        .scalar_subquery()
+    query = session.query(Wafer.name, Wafer.record_created_at, Wafer.batch_id, chips_count,
+                          Wafer.id)
+    query = apply_wafer_filters(query, wafer_pattern, batch_pattern, before, after)
 
+    pages = iter_keyset_pages(query, [Wafer.record_created_at, Wafer.id], page_size, limit)
+    write_rows((map(lambda row: row[:-1], page) for page in pages),
+               header=['Name', 'Created at', 'Batch', 'Number of chips'],
+               widths=[10, 19, 10, 8], file_name=file_name)
 
-@click.command(name='chips', help="Show all chips")
+
+@click.command(name='chips', help="Show chips")
 @click.pass_context
-def chips(ctx: click.Context):
+@filter_options
+@click.option("-t", "--chips-type", "chip_types", multiple=True, callback=flatten_options,
+              help="Types of the chips to show.")
+def chips(ctx: click.Context, wafer_pattern: Optional[str], batch_pattern: Optional[str],
+          before: Union[datetime, None], after: Union[datetime, None], limit: Optional[int],
+          page_size: int, file_name: Optional[str], chip_types: set[str]):
     session: Session = ctx.obj['session']
-    chip_entities = session.query(Chip).order_by(Chip.id).options(
-        joinedload(Chip.wafer)).all()
-    data = pd.DataFrame([chip.to_series() for chip in chip_entities])
-    display(data.to_string(col_space=[10, 10]))
+    wafer_id = Wafer.id.label('wafer_id')
+    query = session.query(Chip.name, Wafer.name.label('wafer'), wafer_id, Chip.id) \
+        .join(Chip.wafer)
+    query = apply_wafer_filters(query, wafer_pattern, batch_pattern, before, after)
+    if chip_types:
+        query = query.filter(Chip.type.in_(chip_types))
+
+    pages = iter_keyset_pages(query, [wafer_id, Chip.id], page_size, limit)
+    write_rows((map(lambda row: row[:-2], page) for page in pages),
+               header=['Name', 'Wafer'], widths=[10, 10], file_name=file_name)
 
 
 @click.group(commands=[wafers, chips], help="Show data from database")
 def show():
-    pd.set_option('display.max_columns', None)
-    pd.set_option('display.max_rows', None)
-    pd.set_option('styler.format.formatter', lambda: print('called'))
     pass
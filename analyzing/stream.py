@@ -0,0 +1,52 @@
+from itertools import islice
+from typing import Iterator, Any, Optional
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Query
+
+
+def iter_query_chunks(query: Query, stream: bool, chunk_size: int) -> Iterator[list[Any]]:
+    """
+    Yields query results in chunks. In stream mode rows are read from a server-side cursor chunk
+    by chunk, so processing of a chunk overlaps fetching of the next one and the whole result is
+    never buffered on the client side. Otherwise the result is fetched at once as a single chunk.
+    """
+    if not stream:
+        yield query.all()
+        return
+    rows = iter(query.yield_per(chunk_size))
+    while chunk := list(islice(rows, chunk_size)):
+        yield chunk
+
+
+def after_key(key_columns: list, key: list):
+    """
+    Condition of rows ordered after `key`, expanded to `a > x OR a = x AND b > y` because MySQL
+    can't use an index range for a row constructor comparison.
+    """
+    return or_(*(and_(*(column == value for column, value in zip(key_columns[:i], key)),
+                      key_columns[i] > key[i])
+                 for i in range(len(key_columns))))
+
+
+def iter_keyset_pages(query: Query, key_columns: list, page_size: int,
+                      limit: Optional[int] = None) -> Iterator[list[Any]]:
+    """
+    Yields query results page by page using keyset pagination: every page is a separate query
+    ordered by `key_columns` that continues after the key of the last row of the previous page,
+    so every page costs the same regardless of how deep into the result it is.
+    `key_columns` must uniquely identify a row and be present among the query columns.
+    """
+    key_names = [column.key for column in key_columns]
+    query = query.order_by(*key_columns)
+    last_key = None
+    while limit is None or limit > 0:
+        page_query = query if last_key is None else \
+            query.filter(after_key(key_columns, last_key))
+        page = page_query.limit(page_size if limit is None else min(page_size, limit)).all()
+        if not page:
+            return
+        yield page
+        if limit is not None:
+            limit -= len(page)
+        last_key = [getattr(page[-1], name) for name in key_names]
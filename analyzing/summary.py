@@ -2,7 +2,7 @@ from datetime import datetime, date
 from decimal import Decimal
 from os.path import exists as file_exists
 from time import strftime, localtime
-from typing import Union, Any, TypeVar, Generic, Callable, Iterable
+from typing import Union, Any, Callable, Iterable, Optional
 
 import click
 import numpy as np
@@ -15,17 +15,30 @@ from numpy import ndarray
 from openpyxl.formatting.rule import CellIsRule
 from openpyxl.styles import PatternFill, Fill
 from openpyxl.worksheet.worksheet import Worksheet
-from sqlalchemy.orm import Session, joinedload
-
-from orm import IVMeasurement, CVMeasurement, Wafer, Chip
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import ColumnElement
+
+from orm import (
+    IVMeasurement,
+    CVMeasurement,
+    LatestIVMeasurement,
+    LatestCVMeasurement,
+    Wafer,
+    Chip,
+)
 from utils import (
     logger,
     flatten_options,
-    iv_thresholds,
-    cv_thresholds,
     IV_VOLTAGE_PRESETS,
     VoltagesOption,
+    MeasurementTable,
+    to_voltage_key,
+    ThresholdTable,
 )
+from .archive_store import ArchivedMeasurements, merge_archived_chunks, archive_dir_option
+from .region import RegionType, Region, REGION_HELP, filter_region
+from .stream import iter_query_chunks
+from .thresholds import get_threshold_table, thresholds_version_option
 
 date_formats = ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d']
 date_formats_help = f"Supported formats are: {', '.join((strftime(f) for f in date_formats))}."
@@ -50,41 +63,67 @@ date_formats_help = f"Supported formats are: {', '.join((strftime(f) for f in da
 @click.option("--voltages", "voltages", default=IV_VOLTAGE_PRESETS['sm'],
               cls=VoltagesOption, presets=IV_VOLTAGE_PRESETS,
               help="List of voltages to include in summary.")
+@click.option("--region", type=RegionType(), help=REGION_HELP)
+@thresholds_version_option
+@archive_dir_option
+@click.option("--stream", is_flag=True, default=False,
+              help="Fetch measurements in chunks with a server-side cursor to reduce memory usage.")
+@click.option("--chunk-size", default=10000, show_default=True,
+              help="Number of rows fetched from database at once in stream mode.")
 def summary_iv(ctx: click.Context, chips_type: Union[str, None], wafer_name: str, file_name: str,
                chip_state_ids: tuple[str], outliers_coefficient: float,
                before: Union[datetime, None],
                after: Union[datetime, None],
-               voltages: Iterable[Decimal]):
+               voltages: Iterable[Decimal], region: Optional[Region],
+               thresholds_version: Optional[int], archive_dir: str, stream: bool,
+               chunk_size: int):
     session: Session = ctx.obj['session']
+    threshold_table = get_threshold_table(session, 'iv', thresholds_version)
     if ctx.obj['default_wafer'].name != wafer_name:
         wafer = session.query(Wafer).filter(Wafer.name == wafer_name).first()
     else:
         wafer = ctx.obj['default_wafer']
-    query = session.query(IVMeasurement) \
-        .filter(IVMeasurement.chip.has(Chip.wafer.__eq__(wafer))) \
-        .options(joinedload(IVMeasurement.chip))
+    # measurements history is only needed to respect the date range, otherwise the newest
+    # measurement of every chip, state and voltage is fetched
+    model = IVMeasurement if before is not None or after is not None else LatestIVMeasurement
+    query = session.query(model.id, model.chip_id, Chip.name.label('chip_name'),
+                          model.chip_state_id, model.voltage_key, model.anode_current,
+                          model.cathode_current, model.anode_current_corrected, model.datetime) \
+        .join(model.chip) \
+        .filter(Chip.wafer_id == wafer.id)
 
     if chips_type is not None:
-        query = query.filter(IVMeasurement.chip.has(Chip.type.__eq__(chips_type)))
+        query = query.filter(Chip.type == chips_type)
     else:
         logger.info('Chips type (-t or --chips-type) is not specified. Analyzing all chip types.')
+    query = filter_region(query, region)
 
     if 'all' not in chip_state_ids:
-        query = query.filter(IVMeasurement.chip_state_id.in_(chip_state_ids))
+        query = query.filter(model.chip_state_id.in_(chip_state_ids))
+    archived = ArchivedMeasurements(session, query, model, [wafer.id], archive_dir,
+                                    get_chip_conditions(chips_type, region), chip_state_ids,
+                                    after=after, before=before, chunk_size=chunk_size)
 
     if before is not None or after is not None:
         after = after if after is not None else date.min
         before = before if before is not None else date.max
-        query = query.filter(IVMeasurement.datetime.between(after, before))
+        # the newest measurement is written last to the sheets
+        query = query.filter(model.datetime.between(after, before)).order_by(model.datetime)
 
-    measurements = query.all()
+    measurements = MeasurementTable.from_chunks(merge_archived_chunks(
+        iter_query_chunks(query, stream, chunk_size), archived))
 
-    if not measurements:
+    if not len(measurements):
         logger.warn('No measurements found.')
         return
+    if model is IVMeasurement:
+        # archived measurements come first in the order they were archived
+        measurements = measurements[np.argsort(measurements.timestamps, kind='stable')]
 
     sheets_data = get_sheets_data(measurements)
-    value_extractor = lambda m: m.anode_current_corrected or m.anode_current
+    # stored corrections of 0 are plotted as raw currents too
+    value_extractor = lambda table: np.where(table.anode_values == 0, table.anode_currents,
+                                             table.anode_values)
     fig, axes = plot_data(measurements, voltages, outliers_coefficient,
                           value_extractor)
     for [ax, _] in axes:
@@ -98,7 +137,7 @@ def summary_iv(ctx: click.Context, chips_type: Union[str, None], wafer_name: str
     exel_file_name = file_name + '.xlsx'
     check_file_exists(exel_file_name)
     info = get_info(ctx, wafer=wafer, chip_state_ids=chip_state_ids, measurements=measurements)
-    save_iv_summary_to_excel(sheets_data, info, exel_file_name, voltages)
+    save_iv_summary_to_excel(sheets_data, info, exel_file_name, voltages, threshold_table)
 
     logger.info(f'Summary data is saved to {exel_file_name}')
 
@@ -122,41 +161,64 @@ def summary_iv(ctx: click.Context, chips_type: Union[str, None], wafer_name: str
 @click.option("--voltages", "voltages", default=["-5", "0", "-35"], multiple=True,
               show_default=True, callback=flatten_options,
               help="List of voltages to include in summary.")
+@click.option("--region", type=RegionType(), help=REGION_HELP)
+@thresholds_version_option
+@archive_dir_option
+@click.option("--stream", is_flag=True, default=False,
+              help="Fetch measurements in chunks with a server-side cursor to reduce memory usage.")
+@click.option("--chunk-size", default=10000, show_default=True,
+              help="Number of rows fetched from database at once in stream mode.")
 def summary_cv(ctx: click.Context, chips_type: Union[str, None], wafer_name: str, file_name: str,
                chip_state_ids: list[str], outliers_coefficient: float,
                before: Union[datetime, None],
                after: Union[datetime, None],
-               voltages: set[str]):
+               voltages: set[str], region: Optional[Region], thresholds_version: Optional[int],
+               archive_dir: str, stream: bool, chunk_size: int):
     session: Session = ctx.obj['session']
+    threshold_table = get_threshold_table(session, 'cv', thresholds_version)
     if ctx.obj['default_wafer'].name != wafer_name:
         wafer = session.query(Wafer).filter(Wafer.name == wafer_name).first()
     else:
         wafer = ctx.obj['default_wafer']
-    query = session.query(CVMeasurement) \
-        .filter(CVMeasurement.chip.has(Chip.wafer.__eq__(wafer))) \
-        .options(joinedload(CVMeasurement.chip))
+    # measurements history is only needed to respect the date range, otherwise the newest
+    # measurement of every chip, state and voltage is fetched
+    model = CVMeasurement if before is not None or after is not None else LatestCVMeasurement
+    query = session.query(model.id, model.chip_id, Chip.name.label('chip_name'),
+                          model.chip_state_id, model.voltage_key, model.capacitance,
+                          model.datetime) \
+        .join(model.chip) \
+        .filter(Chip.wafer_id == wafer.id)
 
     if chips_type is not None:
-        query = query.filter(CVMeasurement.chip.has(Chip.type.__eq__(chips_type)))
+        query = query.filter(Chip.type == chips_type)
     else:
         logger.info('Chips type (-t or --chips-type) is not specified. Analyzing all chip types.')
+    query = filter_region(query, region)
 
     if 'all' not in chip_state_ids:
-        query = query.filter(CVMeasurement.chip_state_id.in_(chip_state_ids))
+        query = query.filter(model.chip_state_id.in_(chip_state_ids))
+    archived = ArchivedMeasurements(session, query, model, [wafer.id], archive_dir,
+                                    get_chip_conditions(chips_type, region), chip_state_ids,
+                                    after=after, before=before, chunk_size=chunk_size)
 
     if before is not None or after is not None:
         after = after if after is not None else date.min
         before = before if before is not None else date.max
-        query = query.filter(CVMeasurement.datetime.between(after, before))
+        # the newest measurement is written last to the sheets
+        query = query.filter(model.datetime.between(after, before)).order_by(model.datetime)
 
-    measurements = query.all()
+    measurements = MeasurementTable.from_chunks(merge_archived_chunks(
+        iter_query_chunks(query, stream, chunk_size), archived))
 
-    if not measurements:
+    if not len(measurements):
         logger.warn('No measurements found.')
         return
+    if model is CVMeasurement:
+        # archived measurements come first in the order they were archived
+        measurements = measurements[np.argsort(measurements.timestamps, kind='stable')]
 
     sheets_data = get_sheets_cv_data(measurements)
-    value_extractor = lambda m: m.capacitance
+    value_extractor = lambda table: table.capacitances
     voltages = sorted(Decimal(v) for v in voltages)
     fig, axes = plot_data(measurements, voltages, outliers_coefficient,
                           value_extractor)
@@ -171,13 +233,23 @@ def summary_cv(ctx: click.Context, chips_type: Union[str, None], wafer_name: str
     exel_file_name = file_name + '.xlsx'
     check_file_exists(exel_file_name)
     info = get_info(ctx, wafer=wafer, chip_state_ids=chip_state_ids, measurements=measurements)
-    save_cv_summary_to_excel(sheets_data, info, exel_file_name, voltages)
+    save_cv_summary_to_excel(sheets_data, info, exel_file_name, voltages, threshold_table)
 
     logger.info(f'Summary data is saved to {exel_file_name}')
 
 
+def get_chip_conditions(chips_type: Optional[str], region: Optional[Region]) \
+        -> list[ColumnElement]:
+    conditions = []
+    if chips_type is not None:
+        conditions.append(Chip.type == chips_type)
+    if region is not None:
+        conditions.append(region.condition())
+    return conditions
+
+
 def save_iv_summary_to_excel(sheets_data: dict, info: pd.Series, file_name: str,
-                             voltages: Iterable[Decimal]):
+                             voltages: Iterable[Decimal], threshold_table: ThresholdTable):
     summary_df = get_slice_by_voltages(sheets_data['anode'], voltages)
     rules = {
         'lessThan': PatternFill(bgColor='ee9090', fill_type='solid'),
@@ -187,7 +259,7 @@ def save_iv_summary_to_excel(sheets_data: dict, info: pd.Series, file_name: str,
     with pd.ExcelWriter(file_name) as writer:
         summary_df.rename(columns=float).to_excel(writer, sheet_name='Summary')
         apply_conditional_formatting(writer.book["Summary"], sheets_data['chip_types'], rules,
-                                     iv_thresholds)
+                                     threshold_table)
 
         sheets_data['anode'].rename(columns=float).to_excel(writer, sheet_name='I1 anode')
         sheets_data['cathode'].rename(columns=float).to_excel(writer, sheet_name='I3 cathode')
@@ -195,7 +267,7 @@ def save_iv_summary_to_excel(sheets_data: dict, info: pd.Series, file_name: str,
 
 
 def save_cv_summary_to_excel(sheets_data: dict, info: pd.Series, file_name: str,
-                             voltages: Iterable[Decimal]):
+                             voltages: Iterable[Decimal], threshold_table: ThresholdTable):
     summary_df = get_slice_by_voltages(sheets_data['capacitance'], voltages)
     rules = {
         'greaterThanOrEqual': PatternFill(bgColor='ee9090', fill_type='solid'),
@@ -205,14 +277,14 @@ def save_cv_summary_to_excel(sheets_data: dict, info: pd.Series, file_name: str,
     with pd.ExcelWriter(file_name) as writer:
         summary_df.to_excel(writer, sheet_name='Summary')
         apply_conditional_formatting(writer.book["Summary"], sheets_data['chip_types'], rules,
-                                     cv_thresholds)
+                                     threshold_table)
 
         sheets_data['capacitance'].rename(columns=float).to_excel(writer, sheet_name='All data')
         info.to_excel(writer, sheet_name='Info')
 
 
 def get_slice_by_voltages(df: pd.DataFrame, voltages: Iterable[Decimal]) -> pd.DataFrame:
-    columns = sorted(voltages)
+    columns = sorted(map(float, voltages))
     slice_df = pd.DataFrame(columns=columns)
     slice_df = pd.concat((slice_df, df[df.columns.intersection(columns)]), copy=False)
 
@@ -230,22 +302,22 @@ def get_slice_by_voltages(df: pd.DataFrame, voltages: Iterable[Decimal]) -> pd.D
 
 
 def apply_conditional_formatting(sheet: Worksheet, chip_types: list[str], rules: dict[str, Fill],
-                                 thresholds: dict[str, dict[str, float]]):
+                                 threshold_table: ThresholdTable):
     chip_row_index = [(i + 1, cell.value) for i, cell in enumerate(sheet['A']) if cell.value]
+    column_cells = {to_voltage_key(cell.value): cell for cell in sheet['1']
+                    if isinstance(cell.value, (int, float, Decimal))}
 
     for chip_type in chip_types:
         def is_current_type(chip_name: str) -> bool:
             return chip_name.startswith(chip_type)
 
-        for voltage, threshold in thresholds[chip_type].items():
-            voltage = Decimal(voltage)
+        for _, voltage_key, threshold in threshold_table.entries(chip_type):
+            column_cell = column_cells.get(voltage_key)
+            if column_cell is None:
+                continue
             try:
-                column_cell = next((cell for cell in sheet['1'] if
-                                    cell.value is not None and Decimal(str(cell.value)) == voltage))
                 first_row_index = next(i for i, v in chip_row_index if is_current_type(v))
                 last_row_index = next(i for i, v in reversed(chip_row_index) if is_current_type(v))
-            except ValueError:
-                continue
             except StopIteration:
                 continue
 
@@ -256,54 +328,46 @@ def apply_conditional_formatting(sheet: Worksheet, chip_types: list[str], rules:
                 sheet.conditional_formatting.add(cell_range, cells_rule)
 
 
-def get_sheets_data(measurements: list[IVMeasurement]) -> dict[str, Union[pd.DataFrame, Any]]:
-    chip_names = sorted({measurement.chip.name for measurement in measurements})
-    chip_types = {measurement.chip.type for measurement in measurements}
-    voltages = sorted({measurement.voltage_input for measurement in measurements})
-    anode_df = pd.DataFrame(dtype='float64', index=chip_names, columns=voltages)
-    cathode_df = pd.DataFrame(dtype='float64', index=chip_names, columns=voltages)
-    has_uncorrected_current = False
-    with click.progressbar(measurements, label='Processing measurements...') as progress:
-        for measurement in progress:
-            measurement: IVMeasurement
-            cell_location = (measurement.chip.name, measurement.voltage_input)
-            if measurement.anode_current_corrected is None:
-                has_uncorrected_current = True
-                anode_df.loc[cell_location] = measurement.anode_current
-            else:
-                anode_df.loc[cell_location] = measurement.anode_current_corrected
-            cathode_df.loc[cell_location] = measurement.cathode_current
-    if has_uncorrected_current:
+def get_sheets_data(measurements: MeasurementTable) -> dict[str, Union[pd.DataFrame, Any]]:
+    if measurements.uncorrected.any():
         logger.warning('Some current measurements are not corrected by temperature.')
+    data = pd.DataFrame({
+        'chip': measurements.row_chip_names,
+        'voltage': measurements.voltages,
+        'anode': measurements.anode_values,
+        'cathode': measurements.cathode_currents,
+    }).drop_duplicates(['chip', 'voltage'], keep='last')
     return {
-        'anode': anode_df,
-        'cathode': cathode_df,
-        'chip_names': chip_names,
-        'chip_types': chip_types,
-        'voltages': voltages
+        'anode': to_chip_voltage_sheet(data, 'anode'),
+        'cathode': to_chip_voltage_sheet(data, 'cathode'),
+        'chip_names': sorted(measurements.chip_names),
+        'chip_types': set(measurements.chip_types),
+        'voltages': sorted(np.unique(measurements.voltages))
     }
 
 
-def get_sheets_cv_data(measurements: list[CVMeasurement]) -> dict[str, Union[pd.DataFrame, Any]]:
-    chip_names = sorted({measurement.chip.name for measurement in measurements})
-    chip_types = {measurement.chip.type for measurement in measurements}
-    voltages = sorted({measurement.voltage_input for measurement in measurements})
-    capacitance_df = pd.DataFrame(dtype='float64', index=chip_names, columns=voltages)
-    with click.progressbar(measurements, label='Processing measurements...') as progress:
-        for measurement in progress:
-            measurement: CVMeasurement
-            cell_location = (measurement.chip.name, measurement.voltage_input)
-            capacitance_df.loc[cell_location] = measurement.capacitance
+def get_sheets_cv_data(measurements: MeasurementTable) -> dict[str, Union[pd.DataFrame, Any]]:
+    data = pd.DataFrame({
+        'chip': measurements.row_chip_names,
+        'voltage': measurements.voltages,
+        'capacitance': measurements.capacitances,
+    }).drop_duplicates(['chip', 'voltage'], keep='last')
     return {
-        'capacitance': capacitance_df,
-        'chip_names': chip_names,
-        'chip_types': chip_types,
-        'voltages': voltages
+        'capacitance': to_chip_voltage_sheet(data, 'capacitance'),
+        'chip_names': sorted(measurements.chip_names),
+        'chip_types': set(measurements.chip_types),
+        'voltages': sorted(np.unique(measurements.voltages))
     }
 
 
+def to_chip_voltage_sheet(data: pd.DataFrame, values: str) -> pd.DataFrame:
+    return data.pivot(index='chip', columns='voltage', values=values) \
+        .rename_axis(index=None, columns=None) \
+        .astype('float64')
+
+
 def get_info(ctx: click.Context, wafer: Wafer, chip_state_ids: Iterable[str],
-             measurements: list[Union[IVMeasurement, CVMeasurement]]) -> pd.Series:
+             measurements: MeasurementTable) -> pd.Series:
     format_date = strftime("%A, %d %b %Y", localtime())
     if 'all' in chip_state_ids:
         chip_states_str = 'all'
@@ -311,15 +375,12 @@ def get_info(ctx: click.Context, wafer: Wafer, chip_state_ids: Iterable[str],
         chip_states_str = "; ".join(
             [state.name for state in ctx.obj['chip_states'] if str(state.id) in chip_state_ids])
 
-    first_measurement = min(measurements, key=lambda m: m.datetime)
-    last_measurement = max(measurements, key=lambda m: m.datetime)
-
     return pd.Series({
         'Wafer': wafer.name,
         'Summary generation date': format_date,
         'Chip state': chip_states_str,
-        "First measurement date": first_measurement.datetime,
-        "Last measurement date": last_measurement.datetime,
+        "First measurement date": measurements.timestamps.min().astype(datetime),
+        "Last measurement date": measurements.timestamps.max().astype(datetime),
     })
 
 
@@ -345,23 +406,17 @@ def plot_hist(ax: Axes, data: np.ndarray):
     ax.hist(data * 1e12, bins=15)
 
 
-T = TypeVar('T')
-
-
-def plot_heat_map(ax: Axes, measurements: list[Generic[T]], low, high,
-                  value_extractor: Callable[[T], float]):
-    xs = {measurement.chip.x_coordinate for measurement in measurements}
-    ys = {measurement.chip.y_coordinate for measurement in measurements}
+def plot_heat_map(ax: Axes, measurements: MeasurementTable, values: np.ndarray, low, high):
+    xs = measurements.x_coordinates
+    ys = measurements.y_coordinates
 
-    width = max(xs) - min(xs) + 1
-    height = max(ys) - min(ys) + 1
+    width = xs.max() - xs.min() + 1
+    height = ys.max() - ys.min() + 1
     grid = np.full((height, width), np.nan)
-    for cell in measurements:
-        grid[cell.chip.y_coordinate - min(ys)][cell.chip.x_coordinate - min(xs)] = value_extractor(
-            cell)
+    grid[ys - ys.min(), xs - xs.min()] = values
 
-    X = np.linspace(min(xs) - 0.5, max(xs) + 0.5, width + 1)
-    Y = np.linspace(min(ys) - 0.5, max(ys) + 0.5, height + 1)
+    X = np.linspace(xs.min() - 0.5, xs.max() + 0.5, width + 1)
+    Y = np.linspace(ys.min() - 0.5, ys.max() + 0.5, height + 1)
     mesh = ax.pcolormesh(X, Y, grid, cmap='hot', shading='flat', vmin=low, vmax=high)
     ax.xaxis.set_major_locator(MaxNLocator(integer=True, min_n_ticks=0))
     ax.yaxis.set_major_locator(MaxNLocator(integer=True, min_n_ticks=0))
@@ -370,33 +425,35 @@ def plot_heat_map(ax: Axes, measurements: list[Generic[T]], low, high,
     ax.figure.colorbar(mesh, ax=ax)
 
 
-def plot_data(values: list[Generic[T]], voltages: Iterable[Decimal],
-              outliers_coefficient: float, value_extractor: Callable[[T], float]) -> (
+def plot_data(measurements: MeasurementTable, voltages: Iterable[Decimal],
+              outliers_coefficient: float,
+              value_extractor: Callable[[MeasurementTable], np.ndarray]) -> (
         Figure, ndarray[Any, Axes]):
     fig, axes = plt.subplots(nrows=len(voltages), ncols=2,
                              figsize=(10, 5 * len(voltages)),
                              gridspec_kw=dict(left=0.08, right=0.95, bottom=0.05, top=0.95,
                                               wspace=0.3, hspace=0.35))
     axes = axes.reshape(-1, 2)
+    values = value_extractor(measurements)
 
     for i, voltage in enumerate(sorted(voltages)):
-        target_values = [value for value in values if value.voltage_input == voltage]
-        if len(target_values) == 0:
+        voltage_idx = measurements.voltage_keys == to_voltage_key(voltage)
+        if not voltage_idx.any():
             continue
-        data = np.array([value_extractor(value) for value in target_values])
+        target_measurements = measurements[voltage_idx]
+        target_values = values[voltage_idx]
 
-        outliers_idx = get_outliers_idx(data, outliers_coefficient)
+        outliers_idx = get_outliers_idx(target_values, outliers_coefficient)
         if outliers_idx.any():
-            outlier_chip_names = (outlier.chip.name for outlier in
-                                  np.array(target_values)[outliers_idx])
+            outlier_chip_names = target_measurements.row_chip_names[outliers_idx]
             logger.warn(
                 f'Outliers detected! {", ".join(outlier_chip_names)} are ignored on {voltage}V histogram and heat map color scale')
-            data = data[~outliers_idx]
+        data = target_values[~outliers_idx]
 
         axes[i][0].set_title(f"{voltage}V")
         plot_hist(axes[i][0], data)
 
         low, high = data.min(), data.max()
         axes[i][1].set_title(f"{voltage}V")
-        plot_heat_map(axes[i][1], target_values, low, high, value_extractor)
+        plot_heat_map(axes[i][1], target_measurements, target_values, low, high)
     return fig, axes
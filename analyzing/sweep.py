@@ -0,0 +1,228 @@
+from decimal import Decimal, InvalidOperation
+from time import strftime
+from typing import Any, Optional
+
+import click
+import numpy as np
+import pandas as pd
+from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from orm import Wafer, Chip, LatestIVMeasurement, LatestCVMeasurement
+from utils import logger, flatten_options, ThresholdTable, to_voltage_key, from_voltage_key
+from .region import RegionType, Region, REGION_HELP, filter_region
+from .stream import iter_query_chunks
+from .summary import check_file_exists
+from .thresholds import get_threshold_table, thresholds_version_option
+
+LIMITS_HELP = """Range of candidate thresholds in A (IV) or F (CV) for a chip type and voltage,
+TYPE:VOLTAGE:START:STOP (e.g. X:-10:-20e-12:-200e-12). Can be repeated. By default every threshold
+of the swept chip types is swept from a tenth to ten times its value."""
+
+
+class LimitsRange:
+    def __init__(self, chip_type: str, voltage: Decimal, start: float, stop: float):
+        self.chip_type = chip_type
+        self.voltage = voltage
+        self.start = start
+        self.stop = stop
+
+    def get_limits(self, points: int) -> np.ndarray:
+        # log spacing resolves leakage limits spanning decades, it needs a range of the same sign
+        if self.start * self.stop > 0:
+            return np.geomspace(self.start, self.stop, points)
+        return np.linspace(self.start, self.stop, points)
+
+
+class LimitsRangeType(click.ParamType):
+    name = 'limits'
+
+    def convert(self, value: Any, param: Optional[click.Parameter],
+                ctx: Optional[click.Context]) -> Any:
+        if not isinstance(value, str):
+            return value
+        try:
+            chip_type, voltage, start, stop = value.split(':')
+            return LimitsRange(chip_type.upper(), Decimal(voltage), float(start), float(stop))
+        except (ValueError, InvalidOperation):
+            self.fail(f"Invalid limits range {value}, expected TYPE:VOLTAGE:START:STOP.",
+                      param, ctx)
+
+
+@click.command(name='sweep-thresholds',
+               help="Make yield vs threshold curves (png and xlsx) for ranges of thresholds.")
+@click.pass_context
+@click.option("-m", "--measurements", "measurements_type", default='iv', show_default=True,
+              type=click.Choice(['iv', 'cv'], case_sensitive=False),
+              help="Type of measurements to analyze.")
+@click.option("-w", "--wafers", "wafer_names", type=str, multiple=True, required=True,
+              callback=flatten_options, help="Wafers to analyze.")
+@click.option("-s", "--chip-state", "chip_state_ids", help="State of the chips to analyze.",
+              default=['all'], show_default=True, multiple=True, callback=flatten_options)
+@click.option("-t", "--chips-type", "chip_types", multiple=True, callback=flatten_options,
+              help="Types of the chips to sweep default ranges for. All types with thresholds by "
+                   "default.")
+@click.option("-l", "--limits", "limits_ranges", type=LimitsRangeType(), multiple=True,
+              help=LIMITS_HELP)
+@click.option("-n", "--points", default=50, show_default=True, type=click.IntRange(min=2),
+              help="Number of candidate thresholds in every range.")
+@click.option("-o", "--output", "file_name",
+              default=lambda: f"thresholds-sweep-{strftime('%y%m%d-%H%M%S')}",
+              help="Output file names without extension.",
+              show_default="thresholds-sweep-{datetime}")
+@click.option("--region", type=RegionType(), help=REGION_HELP)
+@thresholds_version_option
+@click.option("--chunk-size", default=10000, show_default=True,
+              help="Number of rows fetched from database at once.")
+def sweep_thresholds(ctx: click.Context, measurements_type: str, wafer_names: set[str],
+                     chip_state_ids: tuple[str], chip_types: set[str],
+                     limits_ranges: tuple[LimitsRange], points: int, file_name: str,
+                     region: Optional[Region], thresholds_version: Optional[int],
+                     chunk_size: int):
+    session: Session = ctx.obj['session']
+    threshold_table = get_threshold_table(session, measurements_type, thresholds_version)
+    if measurements_type == 'iv':
+        model = LatestIVMeasurement
+        value_column = func.coalesce(func.nullif(model.anode_current_corrected, 0),
+                                     model.anode_current)
+        scale, unit = -1e12, 'pA'  # reverse currents are negative
+    else:
+        model = LatestCVMeasurement
+        value_column = model.capacitance
+        scale, unit = 1e12, 'pF'
+
+    if not limits_ranges:
+        limits_ranges = get_default_ranges(threshold_table, {t.upper() for t in chip_types})
+    sweeps = {(limits_range.chip_type, to_voltage_key(limits_range.voltage)):
+              limits_range.get_limits(points) for limits_range in limits_ranges}
+    if not sweeps:
+        logger.warn('No thresholds to sweep.')
+        return
+
+    wafers = session.query(Wafer).filter(Wafer.name.in_(wafer_names)).all()
+    not_found_wafers = wafer_names - {wafer.name for wafer in wafers}
+    if not_found_wafers:
+        logger.warning(f"Wafers not found: {', '.join(not_found_wafers)}")
+
+    query = session.query(Chip.wafer_id, Chip.type, model.chip_state_id, model.voltage_key,
+                          value_column.label('value')) \
+        .select_from(model) \
+        .join(model.chip) \
+        .filter(Chip.wafer_id.in_([wafer.id for wafer in wafers])) \
+        .filter(Chip.type.in_({chip_type for chip_type, _ in sweeps})) \
+        .filter(model.voltage_key.in_({voltage_key for _, voltage_key in sweeps}))
+    query = filter_region(query, region)
+    if 'all' not in chip_state_ids:
+        query = query.filter(model.chip_state_id.in_(chip_state_ids))
+
+    logger.info('Querying measurements from DB...')
+    chunks = [pd.DataFrame(chunk, columns=['wafer_id', 'type', 'chip_state_id', 'voltage_key',
+                                           'value'])
+              for chunk in iter_query_chunks(query, stream=True, chunk_size=chunk_size)]
+    if not chunks:
+        logger.warn('Chips for given filters are not found.')
+        return
+    data = pd.concat(chunks, ignore_index=True).dropna(subset=['value'])
+    data['value'] = data['value'].astype(float)
+
+    logger.info(f'Sweeping {sum(map(len, sweeps.values()))} thresholds...')
+    curves = get_yield_curves(data, sweeps, threshold_table.pass_above)
+    if curves.empty:
+        logger.warn('No measurements found for swept chip types and voltages.')
+        return
+    curves['wafer'] = curves['wafer_id'].map({wafer.id: wafer.name for wafer in wafers})
+    curves['chip'] = curves['chip_state_id'].map(
+        {state.id: state.name for state in ctx.obj['chip_states']})
+    curves['voltage'] = curves['voltage_key'].map(from_voltage_key)
+    curves['limit'] = curves['limit'] * scale
+    current_limits = threshold_table.lookup(curves['type'].to_numpy(),
+                                            curves['voltage_key'].to_numpy())
+    curves['current_limit'] = current_limits * scale
+
+    png_file_name = file_name + '.png'
+    check_file_exists(png_file_name)
+    fig = plot_yield_curves(curves, unit)
+    fig.savefig(png_file_name, dpi=300)
+    logger.info(f'Yield curves are plotted to {png_file_name}')
+
+    exel_file_name = file_name + '.xlsx'
+    check_file_exists(exel_file_name)
+    with pd.ExcelWriter(exel_file_name) as writer:
+        curves.pivot_table(index=['type', 'voltage', 'limit'], columns=['wafer', 'chip'],
+                           values='yield', sort=False) \
+            .rename_axis(index=['type', 'voltage, V', f'threshold, {unit}']) \
+            .to_excel(writer, sheet_name='Yield')
+        curves.drop_duplicates(['type', 'voltage', 'wafer', 'chip']) \
+            .pivot_table(index=['type', 'voltage'], columns=['wafer', 'chip'], values='chips',
+                         sort=False) \
+            .rename_axis(index=['type', 'voltage, V']) \
+            .to_excel(writer, sheet_name='Chips')
+    logger.info(f'Yield curves are saved to {exel_file_name}')
+
+
+def get_default_ranges(threshold_table: ThresholdTable, chip_types: set[str]) \
+        -> list[LimitsRange]:
+    return [LimitsRange(chip_type, from_voltage_key(voltage_key), limit / 10, limit * 10)
+            for chip_type, voltage_key, limit in threshold_table.entries()
+            if not chip_types or chip_type in chip_types]
+
+
+def get_yield_curves(data: pd.DataFrame, sweeps: dict[tuple[str, int], np.ndarray],
+                     pass_above: bool) -> pd.DataFrame:
+    """
+    Computes yield (%) of every wafer and chip state for every candidate threshold. Values of a
+    group are sorted once and the number of passing values for all thresholds is looked up in
+    the sorted values, so the cost hardly depends on the number of thresholds.
+    """
+    keys = ['type', 'voltage_key', 'wafer_id', 'chip_state_id']
+    data = data.sort_values(keys + ['value'], kind='stable')
+    values = data['value'].to_numpy()
+    groups = data.groupby(keys, sort=False).size()
+    ends = np.cumsum(groups.to_numpy())
+    curves = []
+    for (chip_type, voltage_key, wafer_id, chip_state_id), end, count in zip(
+            groups.index, ends, groups.to_numpy()):
+        limits = sweeps.get((chip_type, voltage_key))
+        if limits is None:
+            continue
+        group_values = values[end - count:end]
+        if pass_above:
+            passed = count - np.searchsorted(group_values, limits, side='right')
+        else:
+            passed = np.searchsorted(group_values, limits, side='left')
+        curves.append(pd.DataFrame({
+            'type': chip_type, 'voltage_key': voltage_key, 'wafer_id': wafer_id,
+            'chip_state_id': chip_state_id, 'limit': limits, 'yield': passed * 100.0 / count,
+            'chips': count,
+        }))
+    return pd.concat(curves, ignore_index=True) if curves else pd.DataFrame()
+
+
+def plot_yield_curves(curves: pd.DataFrame, unit: str) -> Figure:
+    sweeps = list(curves.groupby(['type', 'voltage'], sort=False))
+    ncols = min(len(sweeps), 3)
+    nrows = -(-len(sweeps) // ncols)
+    fig, axes = plt.subplots(nrows=nrows, ncols=ncols, figsize=(6 * ncols, 4.5 * nrows),
+                             squeeze=False)
+
+    for ax, ((chip_type, voltage), sweep_df) in zip(axes.flat, sweeps):
+        for (wafer, chip_state), line_df in sweep_df.groupby(['wafer', 'chip'], sort=False):
+            ax.plot(line_df['limit'], line_df['yield'], label=f"{wafer} ({chip_state})")
+        current_limit = sweep_df['current_limit'].iat[0]
+        if not np.isnan(current_limit):
+            ax.axvline(current_limit, color='grey', linestyle='--', label='Current threshold')
+        limits = sweep_df['limit']
+        if (limits > 0).all() and limits.max() / limits.min() > 10:
+            ax.set_xscale('log')
+        ax.set_title(f"{chip_type} {voltage}V")
+        ax.set_xlabel(f"Threshold [{unit}]")
+        ax.set_ylabel("Yield [%]")
+        ax.set_ylim(-5, 105)
+        ax.legend(loc='best', fontsize='small')
+
+    for ax in axes.flat[len(sweeps):]:
+        ax.set_visible(False)
+    fig.tight_layout()
+    return fig
@@ -0,0 +1,80 @@
+from typing import Optional
+
+import click
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from orm import Threshold
+from utils import logger, iv_threshold_table, cv_threshold_table, ThresholdTable, VOLTAGE_KEY_SCALE
+
+threshold_tables = {
+    'iv': iv_threshold_table,
+    'cv': cv_threshold_table,
+}
+
+
+def thresholds_version_option(command):
+    return click.option("--thresholds-version", "thresholds_version", type=int,
+                        help="Version of thresholds stored in database. "
+                             "Built-in thresholds are used by default.")(command)
+
+
+def get_threshold_table(session: Session, measurement_type: str, version: Optional[int]) \
+        -> ThresholdTable:
+    default_table = threshold_tables[measurement_type]
+    if version is None:
+        return default_table
+    rows = session.query(Threshold.chip_type, Threshold.voltage_key, Threshold.value) \
+        .filter(Threshold.version == version, Threshold.measurement_type == measurement_type) \
+        .all()
+    if not rows:
+        raise click.BadParameter(f'{measurement_type.upper()} thresholds version {version} '
+                                 f'is not found.', param_hint='--thresholds-version')
+    return ThresholdTable.from_entries(rows, default_table.pass_above, version)
+
+
+@click.command(name='list', help="List threshold versions stored in database.")
+@click.pass_context
+def list_thresholds(ctx: click.Context):
+    session: Session = ctx.obj['session']
+    versions = session.query(Threshold.version, Threshold.measurement_type,
+                             func.min(Threshold.record_created_at),
+                             func.count(Threshold.id)) \
+        .group_by(Threshold.version, Threshold.measurement_type) \
+        .order_by(Threshold.version, Threshold.measurement_type) \
+        .all()
+    for version, measurement_type, created_at, count in versions:
+        click.echo(f'{version:<8} {measurement_type:<3} {created_at!s:<20} {count} thresholds')
+
+
+@click.command(name='save', help="Save built-in thresholds to database as a new version.")
+@click.pass_context
+def save_thresholds(ctx: click.Context):
+    session: Session = ctx.obj['session']
+    version = (session.query(func.max(Threshold.version)).scalar() or 0) + 1
+    session.bulk_insert_mappings(Threshold, [
+        dict(version=version, measurement_type=measurement_type, chip_type=chip_type,
+             voltage_key=voltage_key, value=value)
+        for measurement_type, table in threshold_tables.items()
+        for chip_type, voltage_key, value in table.entries()
+    ])
+    session.commit()
+    logger.info(f'Thresholds are saved as version {version}')
+
+
+@click.command(name='show', help="Show thresholds.")
+@click.pass_context
+@click.option("-m", "--measurements", "measurement_type", default='iv', show_default=True,
+              type=click.Choice(['iv', 'cv'], case_sensitive=False),
+              help="Type of measurements.")
+@thresholds_version_option
+def show_thresholds(ctx: click.Context, measurement_type: str, thresholds_version: Optional[int]):
+    table = get_threshold_table(ctx.obj['session'], measurement_type, thresholds_version)
+    for chip_type, voltage_key, value in table.entries():
+        click.echo(f'{chip_type}  {voltage_key / VOLTAGE_KEY_SCALE:>8g} V  {value:.3e}')
+
+
+@click.group(name='thresholds', help="Manage thresholds versions stored in database",
+             commands=[list_thresholds, save_thresholds, show_thresholds])
+def thresholds():
+    pass
@@ -0,0 +1,190 @@
+from datetime import datetime, date
+from decimal import Decimal
+from itertools import groupby, chain
+from operator import attrgetter
+from time import strftime
+from typing import Union, Iterable, Optional
+
+import click
+import numpy as np
+import pandas as pd
+from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from orm import Wafer, Chip, LatestIVMeasurement, LatestCVMeasurement
+from utils import (
+    logger,
+    flatten_options,
+    IV_VOLTAGE_PRESETS,
+    VoltagesOption,
+    VOLTAGE_KEY_SCALE,
+    to_voltage_key,
+    ThresholdTable,
+)
+from .stream import iter_query_chunks
+from .thresholds import get_threshold_table, thresholds_version_option
+from .summary import date_formats, date_formats_help, check_file_exists
+
+CV_VOLTAGES = '-35,-5,0'
+
+
+@click.command(name='trend',
+               help="Make time series (png and xlsx) of median and yield of every wafer.")
+@click.pass_context
+@click.option("-m", "--measurements", "measurements_type", default='iv', show_default=True,
+              type=click.Choice(['iv', 'cv'], case_sensitive=False),
+              help="Type of measurements to analyze.")
+@click.option("-p", "--product", help="Product letter of the wafers batch id (e.g. P or S).")
+@click.option("-t", "--chips-type", "chip_types", multiple=True, callback=flatten_options,
+              help="Types of the chips to analyze.")
+@click.option("-o", "--output", "file_name",
+              default=lambda: f"trend-{strftime('%y%m%d-%H%M%S')}",
+              help="Output file names without extension.", show_default="trend-{datetime}")
+@click.option("-s", "--chip-state", "chip_state_ids", help="State of the chips to analyze.",
+              default=['all'], show_default=True, multiple=True, callback=flatten_options)
+@click.option("--before", type=click.DateTime(formats=date_formats),
+              help=f"Include wafers created before (exclusive) provided date and time. {date_formats_help}")
+@click.option("--after", type=click.DateTime(formats=date_formats),
+              help=f"Include wafers created after (inclusive) provided date and time. {date_formats_help}")
+@click.option("--voltages", "voltages", cls=VoltagesOption, presets=IV_VOLTAGE_PRESETS,
+              help=f"List of voltages to include in trend. "
+                   f"Defaults to sm preset for IV and {CV_VOLTAGES} for CV measurements.")
+@thresholds_version_option
+@click.option("--chunk-size", default=10000, show_default=True,
+              help="Number of rows fetched from database at once.")
+def trend(ctx: click.Context, measurements_type: str, product: Union[str, None],
+          chip_types: set[str], file_name: str, chip_state_ids: tuple[str],
+          before: Union[datetime, None], after: Union[datetime, None],
+          voltages: Optional[Iterable[Decimal]], thresholds_version: Optional[int],
+          chunk_size: int):
+    session: Session = ctx.obj['session']
+    threshold_table = get_threshold_table(session, measurements_type, thresholds_version)
+    if measurements_type == 'iv':
+        model = LatestIVMeasurement
+        value_column = func.coalesce(func.nullif(model.anode_current_corrected, 0),
+                                     model.anode_current)
+        default_voltages = IV_VOLTAGE_PRESETS['sm']
+        scale = -1e12  # pA, reverse currents are negative
+    else:
+        model = LatestCVMeasurement
+        value_column = model.capacitance
+        default_voltages = CV_VOLTAGES
+        scale = 1e12  # pF
+    if voltages is None:
+        voltages = map(Decimal, default_voltages.split(','))
+    voltages = sorted(set(voltages))
+
+    query = session.query(Wafer.id.label('wafer_id'), Wafer.name.label('wafer'),
+                          Wafer.record_created_at, Wafer.batch_id, Chip.type, model.chip_state_id,
+                          model.voltage_key, value_column.label('value')) \
+        .select_from(model) \
+        .join(model.chip) \
+        .join(Chip.wafer) \
+        .filter(model.voltage_key.in_([to_voltage_key(voltage) for voltage in voltages])) \
+        .order_by(Wafer.record_created_at, Wafer.id)
+
+    if product is not None:
+        query = query.filter(Wafer.batch_id.like(f'{product.upper()}%'))
+
+    if chip_types:
+        query = query.filter(Chip.type.in_({chip_type.upper() for chip_type in chip_types}))
+
+    if 'all' not in chip_state_ids:
+        query = query.filter(model.chip_state_id.in_(chip_state_ids))
+
+    if before is not None or after is not None:
+        after = after if after is not None else date.min
+        before = before if before is not None else date.max
+        query = query.filter(Wafer.record_created_at.between(after, before))
+
+    chip_state_names = {state.id: state.name for state in ctx.obj['chip_states']}
+    aggregates = []
+    logger.info('Streaming measurements from DB...')
+    rows = chain.from_iterable(iter_query_chunks(query, stream=True, chunk_size=chunk_size))
+    for _, wafer_rows in groupby(rows, key=attrgetter('wafer_id')):
+        wafer_aggregates = get_wafer_aggregates(list(wafer_rows), threshold_table, scale)
+        wafer_aggregates['chip'] = wafer_aggregates['chip_state_id'].map(chip_state_names)
+        aggregates.append(wafer_aggregates)
+        logger.debug(f'Wafer {wafer_aggregates["wafer"].iat[0]} is processed')
+
+    if not aggregates:
+        logger.warn('No measurements found.')
+        return
+
+    trend_df = pd.concat(aggregates, ignore_index=True)
+    logger.info(f'{len(aggregates)} wafers are processed')
+
+    png_file_name = file_name + '.png'
+    check_file_exists(png_file_name)
+    fig = plot_trend(trend_df, measurements_type)
+    fig.savefig(png_file_name, dpi=300)
+    logger.info(f'Trend is plotted to {png_file_name}')
+
+    exel_file_name = file_name + '.xlsx'
+    check_file_exists(exel_file_name)
+    index = ['record_created_at', 'batch_id', 'wafer', 'chip']
+    columns = ['voltage', 'type']
+    with pd.ExcelWriter(exel_file_name) as writer:
+        for sheet_name, values in (('Median', 'median'), ('Yield', 'yield'), ('Chips', 'chips')):
+            trend_df.pivot_table(index=index, columns=columns, values=values, sort=False) \
+                .rename_axis(index=['created at', 'batch', 'wafer', 'chip'],
+                             columns=['voltage, V', 'type']) \
+                .to_excel(writer, sheet_name=sheet_name)
+    logger.info(f'Trend data is saved to {exel_file_name}')
+
+
+def get_wafer_aggregates(rows: list, threshold_table: ThresholdTable, scale: float) \
+        -> pd.DataFrame:
+    """
+    Computes median (values multiplied by `scale`), yield (%) and number of chips of one wafer for
+    every chip state, voltage and chip type.
+    """
+    data = pd.DataFrame(rows, columns=rows[0]._fields)
+    data['voltage'] = data['voltage_key'] / VOLTAGE_KEY_SCALE
+    checked, passed = threshold_table.evaluate(data['type'].to_numpy(),
+                                               data['voltage_key'].to_numpy(),
+                                               data['value'].to_numpy(dtype=float))
+    data['yield'] = np.where(checked, passed * 100.0, np.nan)
+    data['value'] = data['value'] * scale
+
+    aggregates = data.groupby(['chip_state_id', 'voltage', 'type']) \
+        .agg(**{'median': ('value', 'median'), 'yield': ('yield', 'mean'),
+                'chips': ('value', 'size')}) \
+        .reset_index()
+    for column in ('wafer', 'record_created_at', 'batch_id'):
+        aggregates[column] = data[column].iat[0]
+    aggregates['batch_id'] = aggregates['batch_id'].fillna('')
+    return aggregates
+
+
+def plot_trend(trend_df: pd.DataFrame, measurements_type: str) -> Figure:
+    voltages = sorted(trend_df['voltage'].unique())
+    fig, axes = plt.subplots(nrows=len(voltages), ncols=2, sharex=True,
+                             figsize=(14, 5 * len(voltages)), squeeze=False,
+                             gridspec_kw=dict(left=0.08, right=0.85, bottom=0.05, top=0.95,
+                                              wspace=0.25, hspace=0.35))
+    median_label = "Leakage median [pA]" if measurements_type == 'iv' else "Capacitance median [pF]"
+
+    for [median_ax, yield_ax], voltage in zip(axes, voltages):
+        voltage_df = trend_df[trend_df['voltage'] == voltage]
+        for (chip_type, chip_state), line_df in voltage_df.groupby(['type', 'chip']):
+            label = f"{chip_type} ({chip_state})"
+            median_ax.plot(line_df['record_created_at'], line_df['median'], marker='o',
+                           label=label)
+            if line_df['yield'].notna().any():
+                yield_ax.plot(line_df['record_created_at'], line_df['yield'], marker='o',
+                              label=label)
+        median_ax.set_title(f"{voltage}V")
+        median_ax.set_ylabel(median_label)
+        yield_ax.set_title(f"{voltage}V")
+        yield_ax.set_ylabel("Yield [%]")
+        yield_ax.set_ylim(-5, 105)
+        yield_ax.legend(*median_ax.get_legend_handles_labels(), loc='upper left',
+                        bbox_to_anchor=(1.01, 1), fontsize='small')
+
+    for ax in axes[-1]:
+        ax.set_xlabel("Wafer creation date")
+        ax.tick_params(axis='x', labelrotation=30)
+    return fig
@@ -1,12 +1,11 @@
 import logging
 import os
-from typing import Union
+from typing import Optional, Union
 
 import click
 import keyring
 import pyvisa
 import sentry_sdk
-import yaml
 from pyvisa import Error
 from sqlalchemy import create_engine
 from sqlalchemy.exc import OperationalError
@@ -14,31 +13,69 @@ from sqlalchemy.orm import Session
 
 from orm import ChipState
 from utils import logger, get_db_url
+from .buffer import LocalBuffer, BufferSync
+from .common import CommandBatcher
+from .plan import ConfigError, load_plan
 from .iv import iv
 from .cv import cv
+from .station import station, load_station, StationInstrument
+from .wafer import wafer
+from .scheduler import worker
 
 
-@click.group(commands=[iv, cv])
+@click.group(commands=[iv, cv, station, wafer, worker])
 @click.pass_context
 @click.option("-c", "--config", "config_path", required=True, type=click.Path(exists=True),
-              help="Path to config file. See ./measure/configs/*.yaml")
+              help="Path to config file. See ./measure/*.yaml, station command takes "
+                   "./measure/station-*.yaml")
 @click.option("--log-level", default="INFO", help="Log level.", show_default=True,
               type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
                                 case_sensitive=False))
 @click.option("--db-url", help="Database URL.")
 @click.option('--simulate', is_flag=True, help="Simulate pyvisa instrument.", default=False)
+@click.option("--plan-cache", "plan_cache_dir", envvar='ELFYS_PLAN_CACHE',
+              default=os.path.join(click.get_app_dir('elfys'), 'plans'), show_default=True,
+              help="Directory of compiled config files, ELFYS_PLAN_CACHE environment variable by "
+                   "default.")
+@click.option("--buffer", "buffer_path", envvar='ELFYS_MEASURE_BUFFER',
+              type=click.Path(dir_okay=False),
+              help="Local SQLite file where measurements are saved first and uploaded to database "
+                   "in background, so measuring goes on while database is slow or unreachable. "
+                   "ELFYS_MEASURE_BUFFER environment variable by default.")
+@click.option("--temperature-interval", default=1.0, show_default=True,
+              type=click.FloatRange(min=0.05),
+              help="Seconds between samples of temperature sensors during IV measurements.")
 def measure(ctx: click.Context, config_path: str, log_level: str, db_url: Union[str, None],
-            simulate: bool):
+            simulate: bool, plan_cache_dir: str, buffer_path: Optional[str],
+            temperature_interval: float):
     logger.setLevel(log_level)
 
-    with click.open_file(config_path) as config_file:
-        configs = yaml.safe_load(config_file)
+    plan, station_instruments = None, None
+    try:
+        if ctx.invoked_subcommand == 'station':
+            station_instruments = load_station(config_path, plan_cache_dir)
+        else:
+            plan = load_plan(config_path, plan_cache_dir)
+    except ConfigError as e:
+        raise click.BadParameter(str(e), param_hint='--config')
 
     ctx.obj = {
         'simulate': simulate,
-        'configs': configs
+        'plan': plan,
+        'config_name': os.path.basename(config_path),
+        'station': station_instruments,
+        'buffer_path': buffer_path,
+        'temperature_interval': temperature_interval,
     }
 
+    buffer = None
+    if buffer_path is not None:
+        buffer = LocalBuffer(buffer_path)
+        ctx.call_on_close(buffer.close)
+        interrupted = buffer.delete_incomplete_batches()
+        if interrupted:
+            logger.warning(f'{interrupted} interrupted measurement batches are deleted from buffer')
+
     try:
         if db_url is None and not os.environ.get('DEV', False):
             db_url = get_db_url(username=keyring.get_password("ELFYS_DB", "USER"),
@@ -48,37 +85,65 @@ def measure(ctx: click.Context, config_path: str, log_level: str, db_url: Union[
         session = Session(bind=engine)
         ctx.with_resource(session)
         chip_states = session.query(ChipState).all()
+        if buffer is not None:
+            buffer.save_chip_states(chip_states)
 
     except OperationalError as e:
-        if 'Access denied' in str(e):
+        if buffer is not None and 'Access denied' not in str(e) and buffer.get_chip_states():
+            logger.warning(f"Database is unreachable, measurements are buffered in {buffer_path}: "
+                           f"{e}")
+            chip_states = buffer.get_chip_states()
+        elif 'Access denied' in str(e):
             logger.warn(
                 f"Access denied to database. Try again or run set-db command to set new credentials.")
+            ctx.exit()
         else:
             logger.error(f"Error connecting to database: {e}")
             sentry_sdk.capture_exception(e)
-        ctx.exit()
+            ctx.exit()
 
     active_command = measure.commands[ctx.invoked_subcommand]
-    chip_state_option = next((o for o in active_command.params if o.name == 'chip_state_id'))
-    chip_state_option.type = click.Choice([str(state.id) for state in chip_states])
-    chip_state_option.help = chip_state_option.help + "\n\n" + "\n".join(
-        ["{} - {};".format(state.id, state.name) for state in chip_states])
+    chip_state_option = next((o for o in active_command.params if o.name == 'chip_state_id'), None)
+    if chip_state_option is not None:  # chip states of worker jobs are given in database
+        chip_state_option.type = click.Choice([str(state.id) for state in chip_states])
+        chip_state_option.help = chip_state_option.help + "\n\n" + "\n".join(
+            ["{} - {};".format(state.id, state.name) for state in chip_states])
     ctx.obj['session'] = session
     ctx.obj['chip_states'] = chip_states
+    if buffer_path is not None:
+        ctx.obj['buffer_sync'] = BufferSync(buffer_path, engine).start()
+        ctx.call_on_close(ctx.obj['buffer_sync'].stop)
 
     try:
-        if simulate:
-            rm = pyvisa.ResourceManager('measure/simulation.yaml@sim')
-            instrument = rm.open_resource('GPIB0::9::INSTR',
-                                          write_termination='\n',
-                                          read_termination='\n')
+        if station_instruments is not None:
+            open_station_instruments(ctx, station_instruments, simulate)
         else:
-            pyvisa_config = configs['instruments']['pyvisa']
-            rm = pyvisa.ResourceManager()
-            instrument = rm.open_resource(pyvisa_config['resource'], **pyvisa_config['kwargs'])
-        ctx.with_resource(instrument)
+            if simulate:
+                rm = pyvisa.ResourceManager('measure/simulation.yaml@sim')
+                instrument = rm.open_resource('GPIB0::9::INSTR',
+                                              write_termination='\n',
+                                              read_termination='\n')
+            else:
+                rm = pyvisa.ResourceManager()
+                instrument = rm.open_resource(plan.pyvisa_resource, **dict(plan.pyvisa_kwargs))
+            ctx.with_resource(instrument)
+            ctx.obj['instrument'] = instrument
+            ctx.obj['batcher'] = CommandBatcher(instrument, **dict(plan.batch))
     except Error as e:
         logger.error(f"PYVISA error: {e}")
         ctx.exit()
 
-    ctx.obj['instrument'] = instrument
+
+def open_station_instruments(ctx: click.Context, station_instruments: tuple[StationInstrument],
+                             simulate: bool):
+    rm = pyvisa.ResourceManager('measure/simulation.yaml@sim' if simulate else '')
+    ctx.obj['instruments'], ctx.obj['batchers'] = {}, {}
+    for station_instrument in station_instruments:
+        kwargs = dict(station_instrument.plan.pyvisa_kwargs)
+        if simulate:
+            kwargs.update(write_termination='\n', read_termination='\n')
+        instrument = rm.open_resource(station_instrument.plan.pyvisa_resource, **kwargs)
+        ctx.with_resource(instrument)
+        ctx.obj['instruments'][station_instrument.name] = instrument
+        ctx.obj['batchers'][station_instrument.name] = CommandBatcher(
+            instrument, **dict(station_instrument.plan.batch))
@@ -0,0 +1,318 @@
+import ctypes
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+from typing import Any, Iterator, Optional
+
+import numpy as np
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from orm import Base, ChipState, MeasurementUpload
+from utils import logger
+from .common import get_or_create_chips
+
+BUFFER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS batch (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    uid TEXT NOT NULL UNIQUE,
+    wafer_name TEXT NOT NULL,
+    measured_at TEXT NOT NULL,
+    complete INTEGER NOT NULL DEFAULT 0,
+    owner_pid INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS batch_rows (
+    batch_id INTEGER NOT NULL REFERENCES batch (id) ON DELETE CASCADE,
+    table_name TEXT NOT NULL,
+    chip_name TEXT NOT NULL,
+    rows TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chip_state (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+"""
+BATCH_COLUMNS = {'owner_pid': 'INTEGER', 'attempts': 'INTEGER NOT NULL DEFAULT 0', 'error': 'TEXT'}
+MAX_UPLOAD_ATTEMPTS = 5  # then a batch is quarantined in the buffer
+
+
+def encode_value(value: Any) -> Any:
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    raise TypeError(f'{type(value).__name__} values can not be buffered')
+
+
+def decode_mapping(mapping: dict[str, Any]) -> dict[str, Any]:
+    if 'datetime' in mapping:
+        mapping['datetime'] = datetime.fromisoformat(mapping['datetime'])
+    return mapping
+
+
+def is_process_running(pid: int) -> bool:
+    if os.name == 'nt':
+        # os.kill would terminate the process on Windows
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return ctypes.get_last_error() == 5  # ERROR_ACCESS_DENIED, process of another user
+        try:
+            exit_code = ctypes.c_ulong()
+            kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+            return exit_code.value == 259  # STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class LocalBuffer:
+    """
+    SQLite file on the measurement station where results are appended before they are uploaded
+    to the database. One instance is used by one thread at a time, the file can be shared by
+    processes: every batch records the process measuring it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = FULL')
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.executescript(BUFFER_SCHEMA)
+        with self.connection:  # buffers created by older versions
+            existing = {row[1] for row in self.connection.execute('PRAGMA table_info(batch)')}
+            for name, definition in BATCH_COLUMNS.items():
+                if name not in existing:
+                    self.connection.execute(f'ALTER TABLE batch ADD COLUMN {name} {definition}')
+
+    def close(self):
+        self.connection.close()
+
+    def begin_batch(self, wafer_name: str) -> int:
+        with self.connection:
+            return self.connection.execute(
+                'INSERT INTO batch (uid, wafer_name, measured_at, owner_pid) VALUES (?, ?, ?, ?)',
+                (str(uuid.uuid4()), wafer_name, datetime.now().isoformat(sep=' '), os.getpid())) \
+                .lastrowid
+
+    def append(self, batch_id: int, table_name: str, chip_name: str, rows: list[dict]):
+        # every append is one transaction, so one fsync per measurement program
+        with self.connection:
+            self.connection.execute(
+                'INSERT INTO batch_rows (batch_id, table_name, chip_name, rows) '
+                'VALUES (?, ?, ?, ?)',
+                (batch_id, table_name, chip_name, json.dumps(rows, default=encode_value)))
+
+    def complete_batch(self, batch_id: int):
+        with self.connection:
+            self.connection.execute('UPDATE batch SET complete = 1 WHERE id = ?', (batch_id,))
+
+    def delete_batch(self, batch_id: int):
+        with self.connection:
+            self.connection.execute('DELETE FROM batch WHERE id = ?', (batch_id,))
+
+    def delete_incomplete_batches(self) -> int:
+        """
+        Deletes batches of measurements which were interrupted by a crash, i.e. their process is
+        not running. Called before the process starts its own batches.
+        """
+        interrupted = [(batch_id,) for batch_id, owner_pid in self.connection.execute(
+            'SELECT id, owner_pid FROM batch WHERE complete = 0')
+            if owner_pid is None or owner_pid == os.getpid() or not is_process_running(owner_pid)]
+        with self.connection:
+            self.connection.executemany('DELETE FROM batch WHERE id = ?', interrupted)
+        return len(interrupted)
+
+    def iter_complete_batches(self) -> Iterator[tuple[int, str, str, str]]:
+        return iter(self.connection.execute(
+            'SELECT id, uid, wafer_name, measured_at FROM batch '
+            'WHERE complete = 1 AND attempts < ? ORDER BY id', (MAX_UPLOAD_ATTEMPTS,)).fetchall())
+
+    def record_failure(self, batch_id: int, error: str) -> int:
+        """Returns the number of failed uploads of the batch."""
+        with self.connection:
+            self.connection.execute('UPDATE batch SET attempts = attempts + 1, error = ? '
+                                    'WHERE id = ?', (error, batch_id))
+            return self.connection.execute('SELECT attempts FROM batch WHERE id = ?',
+                                           (batch_id,)).fetchone()[0]
+
+    def get_rows(self, batch_id: int) -> list[tuple[str, str, list[dict]]]:
+        return [(table_name, chip_name, json.loads(rows, object_hook=decode_mapping))
+                for table_name, chip_name, rows in
+                self.connection.execute('SELECT table_name, chip_name, rows FROM batch_rows '
+                                        'WHERE batch_id = ? ORDER BY rowid', (batch_id,))]
+
+    def count_pending(self) -> int:
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM batch WHERE complete = 1 AND attempts < ?',
+            (MAX_UPLOAD_ATTEMPTS,)).fetchone()[0]
+
+    def count_quarantined(self) -> int:
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM batch WHERE complete = 1 AND attempts >= ?',
+            (MAX_UPLOAD_ATTEMPTS,)).fetchone()[0]
+
+    def save_chip_states(self, chip_states: list[ChipState]):
+        with self.connection:
+            self.connection.execute('DELETE FROM chip_state')
+            self.connection.executemany('INSERT INTO chip_state (id, name) VALUES (?, ?)',
+                                        [(state.id, state.name) for state in chip_states])
+
+    def get_chip_states(self) -> list[ChipState]:
+        return [ChipState(id=state_id, name=name) for state_id, name in
+                self.connection.execute('SELECT id, name FROM chip_state ORDER BY id')]
+
+
+class BufferWriter:
+    """
+    Same interface as MeasurementWriter, but results are appended to the local buffer. A batch is
+    uploaded only after the measurement completes, aborted batches are deleted. Rows are stamped
+    with the time they are put, otherwise they would get the time of the upload.
+    """
+
+    def __init__(self, path: str, wafer_name: str, on_complete: Optional[threading.Event] = None):
+        self.path = path
+        self.wafer_name = wafer_name
+        self.on_complete = on_complete
+        self.buffer: Optional[LocalBuffer] = None
+        self.batch_id: Optional[int] = None
+        self.lock = threading.Lock()  # instruments of a station share the writer
+
+    def __enter__(self) -> 'BufferWriter':
+        self.buffer = LocalBuffer(self.path)
+        self.batch_id = self.buffer.begin_batch(self.wafer_name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.buffer.complete_batch(self.batch_id)
+                if self.on_complete is not None:
+                    self.on_complete.set()
+            else:
+                self.buffer.delete_batch(self.batch_id)
+        finally:
+            self.buffer.close()
+
+    def put(self, model: Any, chip_name: str, mappings: list[dict[str, Any]]):
+        measured_at = datetime.now()
+        with self.lock:
+            self.buffer.append(self.batch_id, model.__tablename__, chip_name,
+                               [{'datetime': measured_at, **mapping} for mapping in mappings])
+
+
+def upload_buffer(buffer: LocalBuffer, engine: Engine) -> int:
+    """
+    Uploads complete batches in order, each in one transaction recorded by its uid, so a batch
+    uploaded before a crash is skipped and not inserted twice. A batch which fails for another
+    reason than an unreachable database is skipped and quarantined in the buffer after
+    MAX_UPLOAD_ATTEMPTS, so it does not block the following ones. Returns the number of batches.
+    """
+    models = {mapper.local_table.name: mapper.class_ for mapper in Base.registry.mappers}
+    uploaded = 0
+    for batch_id, uid, wafer_name, measured_at in buffer.iter_complete_batches():
+        rows = buffer.get_rows(batch_id)
+        if not rows:
+            buffer.delete_batch(batch_id)
+            continue
+        try:
+            with Session(bind=engine) as session:
+                if session.query(MeasurementUpload.id).filter(MeasurementUpload.uid == uid) \
+                        .first() is None:
+                    chips = get_or_create_chips(session, wafer_name,
+                                                list({chip_name for _, chip_name, _ in rows}))
+                    for table_name, chip_name, mappings in rows:
+                        session.bulk_insert_mappings(
+                            models[table_name],
+                            [dict(mapping, chip_id=chips[chip_name].id) for mapping in mappings])
+                    session.add(MeasurementUpload(
+                        uid=uid, wafer_id=next(iter(chips.values())).wafer_id,
+                        rows=sum(len(mappings) for _, _, mappings in rows),
+                        measured_at=datetime.fromisoformat(measured_at)))
+                    session.commit()
+        except OperationalError:
+            raise  # the database is unreachable, every batch waits for it
+        except Exception as e:
+            attempts = buffer.record_failure(batch_id, repr(e))
+            if attempts >= MAX_UPLOAD_ATTEMPTS:
+                logger.error(f'Batch {uid} is quarantined in {buffer.path} after {attempts} '
+                             f'failed uploads: {e!r}')
+            else:
+                logger.warning(f'Batch {uid} is not uploaded, attempt {attempts} of '
+                               f'{MAX_UPLOAD_ATTEMPTS}: {e!r}')
+            continue
+        buffer.delete_batch(batch_id)
+        uploaded += 1
+    return uploaded
+
+
+class BufferSync:
+    """Uploads the buffer in a background thread, retrying with backoff while the database fails."""
+
+    def __init__(self, path: str, engine: Engine, interval: float = 5, max_interval: float = 300):
+        self.path = path
+        self.engine = engine
+        self.interval = interval
+        self.max_interval = max_interval
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.failing = False
+        self.thread = threading.Thread(target=self.work, name='buffer-sync', daemon=True)
+
+    def start(self) -> 'BufferSync':
+        self.thread.start()
+        return self
+
+    def sync(self, buffer: LocalBuffer) -> bool:
+        try:
+            uploaded = upload_buffer(buffer, self.engine)
+        except Exception as e:  # the thread keeps retrying whatever fails
+            if not self.failing:
+                logger.warning(f'Buffered measurements are not uploaded, retrying: {e}')
+            self.failing = True
+            return False
+        if uploaded:
+            logger.info(f'{uploaded} buffered batches are uploaded to database')
+        if self.failing:
+            logger.info('Uploading of buffered measurements is resumed')
+        self.failing = False
+        return True
+
+    def work(self):
+        buffer = LocalBuffer(self.path)
+        interval = self.interval
+        try:
+            while not self.stopped.is_set():
+                interval = self.interval if self.sync(buffer) \
+                    else min(interval * 2, self.max_interval)
+                self.wake.wait(interval)
+                self.wake.clear()
+            if not self.failing:
+                self.sync(buffer)
+            pending = buffer.count_pending()
+            if pending:
+                logger.warning(f'{pending} measurement batches wait in {self.path} for upload')
+            quarantined = buffer.count_quarantined()
+            if quarantined:
+                logger.error(f'{quarantined} measurement batches are quarantined in {self.path}, '
+                             f'their errors are kept in the batch table')
+        finally:
+            buffer.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+        self.thread.join()
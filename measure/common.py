@@ -1,17 +1,118 @@
-from jsonpath_ng import parse
+import hashlib
+from contextlib import contextmanager
+from time import perf_counter, monotonic
+from typing import NamedTuple, Optional
+
+import numpy as np
 from pyvisa.resources import GPIBInstrument
 from sqlalchemy.orm import Session, joinedload
 
 from orm import Wafer, Chip
 from utils import logger
+from .plan import MeasureCommand, SetupCommand, MeasurementProgram
 
 
-def set_configs(instrument: GPIBInstrument, commands: list[str]):
-    for command in commands:
-        instrument.write(command)
+class InvalidMeasurementError(RuntimeError):
+    """Measured values are out of limits of the program validation."""
+
+
+class CommandBatcher:
+    """
+    Sends setup commands of measurement programs in as few messages as possible. SCPI commands are
+    joined with ';', TSP commands are defined once per session as functions called by name. A
+    command given as {command: ..., batch: false} is sent alone.
+    """
+
+    def __init__(self, instrument: GPIBInstrument, language: Optional[str] = None,
+                 max_length: int = 250):
+        if language not in (None, 'scpi', 'tsp'):
+            raise ValueError(f'Invalid batch language {language}')
+        self.instrument = instrument
+        self.language = language
+        self.max_length = max_length
+        self.functions: dict[str, str] = {}  # TSP function name: its definition
+
+    def get_messages(self, commands: tuple[SetupCommand, ...]) -> list[str]:
+        messages = []
+        batch: list[str] = []
+        for command in commands:
+            if command.batch:
+                batch.append(command.command)
+            else:
+                messages.extend(self.join(batch))
+                messages.append(command.command)
+                batch = []
+        messages.extend(self.join(batch))
+        return messages
+
+    def join(self, commands: list[str]) -> list[str]:
+        if self.language is None:
+            return commands
+        if self.language == 'scpi':
+            # a header after ';' is relative to the previous one unless it starts with ':'
+            commands = [command if command.startswith((':', '*')) else ':' + command
+                        for command in commands]
+        # leaves room for definition and call of the TSP function
+        max_length = self.max_length - (64 if self.language == 'tsp' else 0)
+        chunks: list[list[str]] = []
+        length = 0
+        for command in commands:
+            if not chunks or length + len(command) + 1 > max_length:
+                chunks.append([])
+                length = 0
+            chunks[-1].append(command)
+            length += len(command) + 1
+        if self.language == 'scpi':
+            return [';'.join(chunk) for chunk in chunks]
+        return [self.call(' '.join(chunk)) for chunk in chunks]
+
+    def call(self, body: str) -> str:
+        name = 'elfys_' + hashlib.sha1(body.encode()).hexdigest()[:10]
+        if name in self.functions:
+            return f'{name}()'
+        self.functions[name] = f'function {name}() {body} end'
+        return f'{self.functions[name]} {name}()'
+
+    def send(self, name: str, commands: tuple[SetupCommand, ...]):
+        started_at = perf_counter()
+        messages = self.get_messages(commands)
+        for message in messages:
+            self.instrument.write(message)
+        if self.language is not None and messages:
+            elapsed = perf_counter() - started_at
+            saved = (len(commands) - len(messages)) * elapsed / len(messages)
+            logger.info(f'{name}: {len(commands)} setup commands are sent in {len(messages)} '
+                        f'messages ({elapsed:.3f} s), ~{saved:.3f} s saved')
+
 
+class InstrumentTiming:
+    """Seconds an instrument spent in every stage of its measurement programs."""
 
-def execute_command(instrument: GPIBInstrument, command: str, command_type: str):
+    def __init__(self):
+        self.stages: dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        started_at = perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + perf_counter() - started_at
+
+    @property
+    def total(self) -> float:
+        return sum(self.stages.values())
+
+    def __str__(self):
+        return ', '.join(f'{name} {seconds:.3f} s' for name, seconds in self.stages.items())
+
+
+def set_configs(instrument: GPIBInstrument, program: MeasurementProgram,
+                batcher: Optional[CommandBatcher] = None):
+    (batcher or CommandBatcher(instrument)).send(program.name, program.setup)
+
+
+def execute_command(instrument: GPIBInstrument, command: str, command_type: str, **kwargs):
     if command_type == 'query':
         return instrument.query(command)
     elif command_type == 'write':
@@ -20,6 +121,12 @@ def execute_command(instrument: GPIBInstrument, command: str, command_type: str)
         return list(instrument.query_ascii_values(command))
     elif command_type == 'query_csv_values':
         return [float(value) for value in instrument.query(command).split(',')]
+    elif command_type == 'query_binary_values':
+        # block of IEEE 754 doubles (FORM:DATA REAL,64 or format.data = format.REAL64) in the
+        # normal (big endian) byte order, decoded without formatting values as text
+        kwargs = {'datatype': 'd', 'is_big_endian': True, **kwargs}
+        return instrument.query_binary_values(command, container=np.ndarray, **kwargs) \
+            .astype(float)
     else:
         raise ValueError(f'Invalid command type {command_type}')
 
@@ -37,36 +144,35 @@ def get_or_create_chips(session: Session, wafer_name: str, chip_names: list[str]
         wafer.chips.extend(new_chips)
 
     session.add(wafer)
-    session.commit()
+    session.flush()
     return {chip.name: chip for chip in wafer.chips if chip.name in chip_names}
 
 
-def get_raw_measurements(instrument: GPIBInstrument, commands: dict) -> dict[str, list]:
+def get_raw_measurements(instrument: GPIBInstrument, commands: tuple[MeasureCommand, ...]) \
+        -> dict[str, list]:
     measurements: dict[str, list] = dict()
     for command in commands:
-        value = execute_command(instrument, command['command'], command['type'])
-        if 'name' in command:
-            measurements[command['name']] = value
+        kwargs = dict(command.kwargs)
+        if isinstance(kwargs.get('data_points'), str):
+            # blocks with '#0' header don't report their length, it is measured by another command
+            kwargs['data_points'] = int(measurements[kwargs['data_points']][0])
+        value = execute_command(instrument, command.command, command.type, **kwargs)
+        if command.name is not None:
+            measurements[command.name] = value
     return measurements
 
 
-def validate_raw_measurements(measurements: dict[str, list],
-                              configs: dict[str, dict[dict]]) -> bool:
-    for value_name, config in configs.items():
-        for validator_name, rules in config.items():
-            path = parse(value_name)
-            for ctx in path.find(measurements):
-                value = ctx.value
-                if rules.get('abs'):
-                    value = abs(value)
-                if validator_name == 'min':
-                    if value < rules['value']:
-                        logger.warning(rules['message'])
-                        return False
-                elif validator_name == 'max':
-                    if value > rules['value']:
-                        logger.warning(rules['message'])
-                        return False
-                else:
-                    raise ValueError(f'Unknown validator {validator_name}')
-    return True
+class Sweep(NamedTuple):
+    measurements: dict[str, list]
+    started_at: float  # monotonic() before the measure commands
+    finished_at: float  # and after them
+
+    def get_timestamps(self, points: int) -> np.ndarray:
+        # instruments don't report times of points, they are spread evenly over the measurement
+        return np.linspace(self.started_at, self.finished_at, points)
+
+
+def measure_sweep(instrument: GPIBInstrument, commands: tuple[MeasureCommand, ...]) -> Sweep:
+    started_at = monotonic()
+    measurements = get_raw_measurements(instrument, commands)
+    return Sweep(measurements, started_at, monotonic())
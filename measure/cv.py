@@ -1,13 +1,15 @@
 import pprint
 
 import click
+import numpy as np
 from pyvisa.resources import GPIBInstrument
-from sqlalchemy.orm import Session
 
 from orm import CVMeasurement
-from utils import logger, validate_chip_names, validate_wafer_name
-from .common import set_configs, get_or_create_chips, get_raw_measurements, \
-    validate_raw_measurements
+from utils import logger, validate_chip_names, validate_wafer_name, MeasurementTable
+from .common import set_configs, get_raw_measurements, CommandBatcher, InstrumentTiming, \
+    InvalidMeasurementError
+from .writer import get_writer, Writer
+from .plan import MeasurementPlan, ChipColumn
 
 
 @click.command(name='cv', help='Measure CV data of the current chip.')
@@ -23,62 +25,56 @@ from .common import set_configs, get_or_create_chips, get_raw_measurements, \
 def cv(ctx: click.Context, chip_names: list[str], wafer_name: str, chip_state_id: str,
        automatic_mode: bool):
     instrument: GPIBInstrument = ctx.obj['instrument']
-    session: Session = ctx.obj['session']
-    configs: dict = ctx.obj['configs']
+    plan: MeasurementPlan = ctx.obj['plan']
 
-    if len(configs['chips']) != len(chip_names):
+    if len(plan.chips) != len(chip_names):
         if len(chip_names) > 0:
             logger.warning(
-                f"Number of chip names does not match number of chips in config file. {len(configs['chips'])} chip names expected")
-        for i in range(len(configs['chips']) - len(chip_names)):
+                f"Number of chip names does not match number of chips in config file. {len(plan.chips)} chip names expected")
+        for i in range(len(plan.chips) - len(chip_names)):
             chip_name = click.prompt(f"Input chip name {i + 1}", type=str)
             chip_names.extend(validate_chip_names(ctx, ..., [chip_name]))
 
-    chips_dict = get_or_create_chips(session, wafer_name, chip_names)
+    # results are written while the instrument runs the next program
+    timing = InstrumentTiming()
+    with get_writer(ctx, wafer_name, chip_names) as writer:
+        run_cv_programs(instrument, plan, ctx.obj['batcher'], writer, chip_names,
+                        int(chip_state_id), automatic_mode, timing)
+    logger.debug(f'Timing: {timing}')
+    logger.info('Measurements saved')
+
 
-    for measurement_config in configs['measurements']:
-        logger.info(f'Executing measurement {measurement_config["name"]}')
-        set_configs(instrument, measurement_config['instrument'])
-        raw_measurements = get_raw_measurements(instrument, configs['measure'])
+def run_cv_programs(instrument: GPIBInstrument, plan: MeasurementPlan, batcher: CommandBatcher,
+                    writer: Writer, chip_names: list[str], chip_state_id: int,
+                    automatic_mode: bool, timing: InstrumentTiming, log_prefix: str = ''):
+    for program in plan.programs:
+        logger.info(f'{log_prefix}Executing measurement {program.name}')
+        with timing.stage('setup'):
+            set_configs(instrument, program, batcher)
+        with timing.stage('readout'):
+            raw_measurements = get_raw_measurements(instrument, plan.measure)
 
-        if measurement_config['program'].get('validation'):
-            validation_config = measurement_config['program']['validation']
-            if not validate_raw_measurements(raw_measurements, validation_config):
+        if program.validator is not None:
+            if not program.validator.validate(raw_measurements):
                 if automatic_mode:
-                    raise RuntimeError('Measurement is invalid')
+                    raise InvalidMeasurementError(f'{log_prefix}Measurement is invalid')
                 logger.info('\n' + pprint.pformat(raw_measurements, compact=True, indent=4))
                 click.confirm("Do you want to save these measurements?", abort=True, default=True)
 
-        for chip_name, chip_config in zip(chip_names, configs['chips'], strict=True):
-            chip_id = chips_dict[chip_name].id
-            measurements_kwargs = dict(
-                chip_state_id=int(chip_state_id),
-                chip_id=chip_id,
-                **measurement_config['program']['measurements_kwargs'],
-            )
-            measurements = create_measurements(raw_measurements, chip_config, **measurements_kwargs)
-            session.add_all(measurements)
-    session.commit()
-    logger.info('Measurements saved')
-
+        with timing.stage('saving'):
+            for chip_name, chip_columns in zip(chip_names, plan.chips, strict=True):
+                measurements = create_measurements(raw_measurements, chip_name, chip_columns)
+                writer.put(CVMeasurement, chip_name, measurements.to_mappings(
+                    chip_state_id=chip_state_id, **dict(program.measurements_kwargs)))
 
-def create_measurements(raw_measurements: dict[str, list], chip_config: dict, **kwargs) \
-        -> list[CVMeasurement]:
-    print(raw_measurements)
-    raw_measurements.get('voltage')
-    kwarg_keys = list(chip_config.keys())
 
-    grouped_numbers = []
-    for key in kwarg_keys:
-        s = slice(*chip_config[key].get('slice', [None]))
-        p = chip_config[key].get('prop', None)
-        grouped_numbers.append(raw_measurements[p][s])
-    measurements = []
+def create_measurements(raw_measurements: dict[str, list], chip_name: str,
+                        chip_columns: tuple[ChipColumn, ...]) -> MeasurementTable:
+    columns = {column.key: np.asarray(raw_measurements[column.prop], dtype=float)[column.slice]
+               for column in chip_columns}
+    if len({len(values) for values in columns.values()}) > 1:
+        raise ValueError(f'Measured columns of chip {chip_name} have different lengths')
 
-    for data in zip(*grouped_numbers, strict=True):
-        measurement_kwargs = dict(zip(kwarg_keys, data, strict=True))
-        measurements.append(CVMeasurement(
-            **measurement_kwargs,
-            **kwargs
-        ))
-    return measurements
+    voltages = columns.pop('voltage_input')
+    return MeasurementTable.from_arrays(chip_names=[chip_name] * len(voltages),
+                                        voltage_input=voltages, **columns)
@@ -1,17 +1,18 @@
 import pprint
-from time import sleep
+from typing import Optional, Union
 
 import click
 import numpy as np
 from pyvisa.resources import GPIBInstrument
-from scipy.optimize import curve_fit
-from sqlalchemy.orm import Session
-from yoctopuce.yocto_temperature import YAPI, YRefParam, YTemperature
 
 from orm import IVMeasurement
-from utils import logger, validate_chip_names, validate_wafer_name
-from .common import set_configs, get_or_create_chips, get_raw_measurements, \
-    validate_raw_measurements
+from utils import logger, validate_chip_names, validate_wafer_name, MeasurementTable
+from .common import set_configs, measure_sweep, CommandBatcher, InstrumentTiming, \
+    InvalidMeasurementError, Sweep
+from .settling import get_settled_measurements
+from .temperature import TemperatureSampler, get_temperature_sampler
+from .writer import get_writer, Writer
+from .plan import MeasurementPlan, ChipColumn
 
 
 @click.command(name='iv', help='Measure IV data of the current chip.')
@@ -27,117 +28,89 @@ from .common import set_configs, get_or_create_chips, get_raw_measurements, \
 def iv(ctx: click.Context, chip_names: list[str], wafer_name: str, chip_state_id: str,
        automatic_mode: bool):
     instrument: GPIBInstrument = ctx.obj['instrument']
-    session: Session = ctx.obj['session']
-    configs: dict = ctx.obj['configs']
-    if ctx.obj['simulate']:
-        temperature = np.random.rand() * 100
-    else:
-        temperature = get_temperature(configs['instruments']['temperature_resource'])
-
-    if len(configs['chips']) != len(chip_names):
+    plan: MeasurementPlan = ctx.obj['plan']
+    sampler = get_temperature_sampler(ctx, [plan.temperature_resource])
+
+    if len(plan.chips) != len(chip_names):
         if len(chip_names) > 0:
             logger.warning(
-                f"Number of chip names does not match number of chips in config file. {len(configs['chips'])} chip names expected")
-        for i in range(len(configs['chips']) - len(chip_names)):
+                f"Number of chip names does not match number of chips in config file. {len(plan.chips)} chip names expected")
+        for i in range(len(plan.chips) - len(chip_names)):
             chip_name = click.prompt(f"Input chip name {i + 1}", type=str)
             chip_names.extend(validate_chip_names(ctx, ..., [chip_name]))
 
-    chips_dict = get_or_create_chips(session, wafer_name, chip_names)
-
-    for measurement_config in configs['measurements']:
-        logger.info(f'Executing measurement {measurement_config["name"]}')
-        set_configs(instrument, measurement_config['instrument'])
+    # results are written while the instrument runs the next program
+    timing = InstrumentTiming()
+    with get_writer(ctx, wafer_name, chip_names) as writer:
+        run_iv_programs(instrument, plan, ctx.obj['batcher'], writer, chip_names,
+                        int(chip_state_id), sampler, automatic_mode, timing)
+    logger.debug(f'Timing: {timing}')
+    logger.info('Measurements saved')
 
-        if measurement_config['program'].get('minimum'):
-            raw_measurements = get_minimal_measurements(instrument, configs['measure'])
-        else:
-            raw_measurements = get_raw_measurements(instrument, configs['measure'])
 
-        if measurement_config['program'].get('validation'):
-            validation_config = measurement_config['program']['validation']
-            if not validate_raw_measurements(raw_measurements, validation_config):
+def run_iv_programs(instrument: GPIBInstrument, plan: MeasurementPlan, batcher: CommandBatcher,
+                    writer: Writer, chip_names: list[str], chip_state_id: int,
+                    sampler: TemperatureSampler, automatic_mode: bool, timing: InstrumentTiming,
+                    log_prefix: str = ''):
+    for program in plan.programs:
+        logger.info(f'{log_prefix}Executing measurement {program.name}')
+        with timing.stage('setup'):
+            set_configs(instrument, program, batcher)
+
+        with timing.stage('readout'):
+            if program.minimum is not None:
+                sweep, full_sweeps, spot_sweeps = get_settled_measurements(
+                    instrument, plan.measure, program.minimum, batcher)
+                logger.info(f"{log_prefix}{', '.join(chip_names)} settled after {full_sweeps} "
+                            f"full and {spot_sweeps} spot check sweeps")
+            else:
+                sweep = measure_sweep(instrument, plan.measure)
+            raw_measurements = sweep.measurements
+
+        if program.validator is not None:
+            if not program.validator.validate(raw_measurements):
                 if automatic_mode:
-                    raise RuntimeError('Measurement is invalid')
+                    raise InvalidMeasurementError(f'{log_prefix}Measurement is invalid')
                 logger.info('\n' + pprint.pformat(raw_measurements, compact=True, indent=4))
                 click.confirm("Do you want to save these measurements?", abort=True, default=True)
 
-        for chip_name, chip_config in zip(chip_names, configs['chips'], strict=True):
-            chip_id = chips_dict[chip_name].id
-            measurements_kwargs = dict(
-                chip_state_id=int(chip_state_id),
-                chip_id=chip_id,
-                **measurement_config['program']['measurements_kwargs'],
-            )
-            measurements = create_measurements(raw_measurements, temperature, chip_config,
-                                               **measurements_kwargs)
-            session.add_all(measurements)
-    session.commit()
-    logger.info('Measurements saved')
-
-
-def create_measurements(raw_measurements: dict[str, list], temperature: float, chip_config: dict,
-                        **kwargs) -> list[IVMeasurement]:
-    kwarg_keys = list(chip_config.keys())
-    raw_numbers = zip(*[raw_measurements[chip_config[key]] for key in kwarg_keys], strict=True)
-    measurements = []
-
-    for data in raw_numbers:
-        measurement_kwargs = dict(zip(kwarg_keys, data))
-
-        if 'anode_current' in measurement_kwargs:
-            anode_current = measurement_kwargs['anode_current']
-            anode_current_corrected = compute_corrected_current(temperature, anode_current)
-            measurement_kwargs['anode_current_corrected'] = anode_current_corrected
-
-        measurements.append(IVMeasurement(
-            temperature=temperature,
-            **measurement_kwargs,
-            **kwargs
-        ))
-    return measurements
-
-
-def get_minimal_measurements(instrument: GPIBInstrument, configs: dict):
-    def linear(x, a, b):
-        return a + b * x
-
-    prev_measurements: dict[str, list] = dict()
-    while True:
-        raw_measurements = get_raw_measurements(instrument, configs)
-        xdata = raw_measurements['voltage_input']
-        if 'anode_current' in raw_measurements:
-            ydata = raw_measurements['anode_current']
-        elif 'cathode_current' in raw_measurements:
-            ydata = raw_measurements['cathode_current']
-        else:
-            raise ValueError('No current measurement found')
-        popt, pcov = curve_fit(f=linear, xdata=xdata, ydata=ydata, p0=[0, 0],
-                               bounds=(-np.inf, np.inf))
-        offset = abs(popt[0])
-        if prev_measurements and offset >= prev_measurements['offset']:
-            prev_measurements.pop('offset')
-            return prev_measurements
-        prev_measurements = dict(offset=offset, **raw_measurements)
-        sleep(0.5)
-
-
-def compute_corrected_current(temp: float, current: float):
+        with timing.stage('saving'):
+            for chip_name, chip_columns in zip(chip_names, plan.chips, strict=True):
+                temperatures = get_point_temperatures(sampler, plan.temperature_resource, sweep,
+                                                      chip_columns)
+                measurements = create_measurements(raw_measurements, temperatures, chip_name,
+                                                   chip_columns)
+                writer.put(IVMeasurement, chip_name, measurements.to_mappings(
+                    chip_state_id=chip_state_id, **dict(program.measurements_kwargs)))
+
+
+def get_point_temperatures(sampler: TemperatureSampler, sensor_id: Optional[str], sweep: Sweep,
+                           chip_columns: tuple[ChipColumn, ...]) -> np.ndarray:
+    """Temperatures at the times the voltages of a chip were measured."""
+    voltage_column = next(column for column in chip_columns if column.key == 'voltage_input')
+    points = len(sweep.measurements[voltage_column.prop])
+    return sampler.get_temperatures(sensor_id, sweep.get_timestamps(points))[voltage_column.slice]
+
+
+def create_measurements(raw_measurements: dict[str, list], temperatures: np.ndarray,
+                        chip_name: str, chip_columns: tuple[ChipColumn, ...]) -> MeasurementTable:
+    columns = {column.key: np.asarray(raw_measurements[column.prop], dtype=float)[column.slice]
+               for column in chip_columns}
+    if len({len(values) for values in columns.values()} | {len(temperatures)}) > 1:
+        raise ValueError(f'Measured columns of chip {chip_name} have different lengths')
+
+    voltages = columns.pop('voltage_input')
+    if 'anode_current' in columns:
+        columns['anode_current_corrected'] = compute_corrected_current(temperatures,
+                                                                       columns['anode_current'])
+    return MeasurementTable.from_arrays(
+        chip_names=[chip_name] * len(voltages),
+        voltage_input=voltages,
+        temperature=temperatures,
+        **columns,
+    )
+
+
+def compute_corrected_current(temp: Union[float, np.ndarray], current: Union[float, np.ndarray]):
     target_temperature = 25
     return 1.15 ** (target_temperature - temp) * current
-
-
-def get_temperature(sensor_id) -> float:
-    try:
-        errmsg = YRefParam()
-        if YAPI.RegisterHub("usb", errmsg) != YAPI.SUCCESS:
-            raise RuntimeError("RegisterHub (temperature sensor) error: " + errmsg.value)
-
-        # TODO: does it work with simple 'temperature' instead of sensor_id?
-        sensor: YTemperature = YTemperature.FindTemperature(sensor_id)
-        if not (sensor.isOnline()):
-            raise RuntimeError('Temperature sensor is not connected')
-
-        temperature = sensor.get_currentValue()
-    finally:
-        YAPI.FreeAPI()
-    return temperature
@@ -0,0 +1,258 @@
+import hashlib
+import os
+import pickle
+from typing import Any, NamedTuple, Optional, Union
+
+import numpy as np
+import yaml
+from jsonpath_ng import parse, JSONPath
+from jsonpath_ng.exceptions import JSONPathError
+from jsonpath_ng.jsonpath import Child, Fields, Index, Slice
+
+from utils import logger
+
+COMMAND_TYPES = {'query', 'write', 'query_ascii_values', 'query_csv_values',
+                 'query_binary_values'}
+VALIDATOR_KINDS = {'min', 'max'}
+BATCH_LANGUAGES = {'scpi', 'tsp'}
+
+
+class ConfigError(ValueError):
+    pass
+
+
+class MeasureCommand(NamedTuple):
+    command: str
+    type: str
+    name: Optional[str]
+    kwargs: tuple[tuple[str, Any], ...]
+
+
+class SetupCommand(NamedTuple):
+    command: str
+    batch: bool
+
+
+class ChipColumn(NamedTuple):
+    key: str
+    prop: str
+    slice: slice
+
+
+class ValidationRule(NamedTuple):
+    path: str
+    expression: JSONPath
+    name: Optional[str]  # measured value of a plain `name[index]` path, indexed without jsonpath
+    index: Union[int, slice, None]
+    kind: str
+    limit: float
+    abs: bool
+    message: str
+
+    def get_values(self, measurements: dict[str, Any]) -> np.ndarray:
+        if self.name is None:
+            values = {name: value.tolist() if isinstance(value, np.ndarray) else value
+                      for name, value in measurements.items()}
+            return np.asarray([match.value for match in self.expression.find(values)], dtype=float)
+        values = np.asarray(measurements.get(self.name, []), dtype=float)
+        if isinstance(self.index, slice):
+            return values[self.index]
+        if not -len(values) <= self.index < len(values):
+            return np.empty(0)  # like jsonpath, missing values are not validated
+        return values[[self.index]]
+
+
+class Validator:
+    """Rules of a measurement program checked with one comparison of all their values."""
+
+    def __init__(self, rules: tuple[ValidationRule, ...]):
+        self.rules = rules
+        self.limits = np.array([rule.limit for rule in rules], dtype=float)
+        self.is_min = np.array([rule.kind == 'min' for rule in rules])
+        self.is_abs = np.array([rule.abs for rule in rules])
+
+    def validate(self, measurements: dict[str, Any]) -> bool:
+        values = [rule.get_values(measurements) for rule in self.rules]
+        rule_indices = np.repeat(np.arange(len(self.rules)), [len(value) for value in values])
+        values = np.concatenate(values) if values else np.empty(0)
+        values = np.where(self.is_abs[rule_indices], np.abs(values), values)
+        limits = self.limits[rule_indices]
+        failed = np.where(self.is_min[rule_indices], values < limits, values > limits)
+        if failed.any():
+            logger.warning(self.rules[rule_indices[np.argmax(failed)]].message)
+            return False
+        return True
+
+
+class SpotCheck(NamedTuple):
+    """Short sweep between full ones, `restore` returns the instrument to the program sweep."""
+    setup: tuple[SetupCommand, ...]
+    restore: tuple[SetupCommand, ...]
+
+
+class SettlingConfig(NamedTuple):
+    rtol: float  # of the offset, for the predicted decrease of further sweeps
+    atol: float  # offset which needs no more sweeps
+    max_sweeps: int
+    interval: float  # seconds between sweeps
+    spot_check: Optional[SpotCheck]
+
+
+class MeasurementProgram(NamedTuple):
+    name: str
+    setup: tuple[SetupCommand, ...]
+    minimum: Optional[SettlingConfig]
+    validator: Optional[Validator]
+    measurements_kwargs: tuple[tuple[str, Any], ...]
+
+
+class MeasurementPlan(NamedTuple):
+    """Config file compiled and validated before any instrument is touched."""
+    config_hash: str
+    temperature_resource: Optional[str]
+    pyvisa_resource: Optional[str]
+    pyvisa_kwargs: tuple[tuple[str, Any], ...]
+    batch: tuple[tuple[str, Any], ...]
+    measure: tuple[MeasureCommand, ...]
+    chips: tuple[tuple[ChipColumn, ...], ...]
+    programs: tuple[MeasurementProgram, ...]
+
+
+def compile_rule(path: str, kind: str, rules: dict, measured_names: set[str]) \
+        -> ValidationRule:
+    if kind not in VALIDATOR_KINDS:
+        raise ConfigError(f'Unknown validator {kind} of {path}')
+    try:
+        expression = parse(path)
+    except JSONPathError as e:
+        raise ConfigError(f'Invalid validation path {path}: {e}')
+    name, index = None, None
+    if isinstance(expression, Child) and isinstance(expression.left, Fields) \
+            and len(expression.left.fields) == 1:
+        if isinstance(expression.right, Index) and len(expression.right.indices) == 1:
+            name, index = expression.left.fields[0], expression.right.indices[0]
+        elif isinstance(expression.right, Slice):
+            name = expression.left.fields[0]
+            index = slice(expression.right.start, expression.right.end, expression.right.step)
+    if name is not None and name not in measured_names:
+        raise ConfigError(f'Validation path {path} refers to a value which is not measured')
+    try:
+        return ValidationRule(path, expression, name, index, kind, float(rules['value']),
+                              bool(rules.get('abs', False)), rules['message'])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ConfigError(f'Invalid {kind} validator of {path}: {e!r}')
+
+
+def compile_setup(commands: list) -> tuple[SetupCommand, ...]:
+    return tuple(SetupCommand(command['command'], command.get('batch', True))
+                 if isinstance(command, dict) else SetupCommand(command, True)
+                 for command in commands)
+
+
+def compile_settling(minimum: Union[bool, dict, None]) -> Optional[SettlingConfig]:
+    if not minimum:
+        return None
+    minimum = {} if minimum is True else minimum
+    spot_check = minimum.get('spot_check')
+    if spot_check is not None:
+        spot_check = SpotCheck(compile_setup(spot_check['setup']),
+                               compile_setup(spot_check['restore']))
+    try:
+        settling = SettlingConfig(float(minimum.get('rtol', 0.05)), float(minimum.get('atol', 0)),
+                                  int(minimum.get('max_sweeps', 10)),
+                                  float(minimum.get('interval', 0.5)), spot_check)
+    except (TypeError, ValueError) as e:
+        raise ConfigError(f'Invalid minimum: {e}')
+    if settling.max_sweeps < 2:
+        raise ConfigError('Minimum needs at least 2 sweeps')
+    return settling
+
+
+def compile_plan(configs: dict, config_hash: str) -> MeasurementPlan:
+    try:
+        instruments = configs.get('instruments', {})
+        pyvisa_config = instruments.get('pyvisa', {})
+        batch = instruments.get('batch', {})
+        if batch.get('language') not in BATCH_LANGUAGES | {None}:
+            raise ConfigError(f"Invalid batch language {batch['language']}")
+
+        measure = []
+        for command in configs['measure']:
+            if command['type'] not in COMMAND_TYPES:
+                raise ConfigError(f"Invalid command type {command['type']} of {command['command']}")
+            measure.append(MeasureCommand(command['command'], command['type'], command.get('name'),
+                                          tuple(command.get('kwargs', {}).items())))
+        measured_names = {command.name for command in measure if command.name is not None}
+
+        chips = []
+        for chip_config in configs['chips']:
+            columns = []
+            for key, column_config in chip_config.items():
+                if isinstance(column_config, str):
+                    column_config = {'prop': column_config}
+                if column_config.get('prop') not in measured_names:
+                    raise ConfigError(f"Column {key} refers to {column_config.get('prop')} which "
+                                      f"is not measured")
+                columns.append(ChipColumn(key, column_config['prop'],
+                                          slice(*column_config.get('slice', [None]))))
+            if 'voltage_input' not in chip_config:
+                raise ConfigError('Chip has no voltage_input column')
+            chips.append(tuple(columns))
+
+        programs = []
+        for measurement_config in configs['measurements']:
+            program = measurement_config['program']
+            setup = compile_setup(measurement_config['instrument'])
+            rules = tuple(compile_rule(path, kind, rules, measured_names)
+                          for path, validators in program.get('validation', {}).items()
+                          for kind, rules in validators.items())
+            programs.append(MeasurementProgram(
+                measurement_config['name'], setup, compile_settling(program.get('minimum')),
+                Validator(rules) if rules else None,
+                tuple(program.get('measurements_kwargs', {}).items())))
+    except KeyError as e:
+        raise ConfigError(f'Missing key {e} in config')
+    except (AttributeError, TypeError) as e:
+        raise ConfigError(f'Invalid config structure: {e}')
+
+    return MeasurementPlan(config_hash, instruments.get('temperature_resource'),
+                           pyvisa_config.get('resource'),
+                           tuple(pyvisa_config.get('kwargs', {}).items()),
+                           tuple(batch.items()), tuple(measure), tuple(chips), tuple(programs))
+
+
+def get_source_hash() -> bytes:
+    """Hash of this module, so plans pickled by another version of the code are not loaded."""
+    with open(__file__, 'rb') as file:
+        return hashlib.sha256(file.read()).digest()
+
+
+def load_plan(config_path: str, cache_dir: Optional[str] = None) -> MeasurementPlan:
+    """Compiles a config file, plans are cached in `cache_dir` by hash of the config and code."""
+    with open(config_path, 'rb') as file:
+        content = file.read()
+    config_hash = hashlib.sha256(content).hexdigest()
+    cache_path = os.path.join(
+        cache_dir, f'{hashlib.sha256(get_source_hash() + content).hexdigest()}.pickle') \
+        if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as file:
+                return pickle.load(file)
+        except Exception as e:  # a stale or broken cache is a miss
+            logger.warning(f'Cached plan {cache_path} is ignored: {e}')
+
+    try:
+        configs = yaml.safe_load(content)
+    except yaml.YAMLError as e:
+        raise ConfigError(f'Invalid YAML: {e}')
+    plan = compile_plan(configs, config_hash)
+    if cache_path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_path + '.part', 'wb') as file:
+                pickle.dump(plan, file)
+            os.replace(cache_path + '.part', cache_path)
+        except OSError as e:
+            logger.warning(f'Plan is not cached: {e}')
+    return plan
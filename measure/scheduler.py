@@ -0,0 +1,213 @@
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+from time import perf_counter, sleep
+from typing import Optional
+
+import click
+from pyvisa.resources import GPIBInstrument
+from sqlalchemy import func
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from orm import MeasurementJob
+from utils import logger
+from .plan import MeasurementPlan
+from .wafer import open_queue, run_wafer_job, confirm_chips_option
+
+
+class JobScheduler:
+    """
+    Claims jobs of the measurement_job table for a station. Candidates are selected with
+    SELECT ... FOR UPDATE SKIP LOCKED, so stations polling at once get different jobs, and claimed
+    by an update conditional on the job status, which also keeps databases without SKIP LOCKED
+    (SQLite) from giving a job to two stations. A running job is leased by its station while it
+    sends heartbeats, jobs of stations which stopped sending them are queued again.
+    """
+
+    def __init__(self, engine: Engine, station: str, config: str, lease_seconds: float = 300):
+        self.engine = engine
+        self.station = station
+        self.config = config
+        self.lease_seconds = lease_seconds
+
+    @staticmethod
+    def get_now(session: Session) -> datetime:
+        # time of the database, clocks of stations may differ
+        return session.query(func.current_timestamp()).scalar()
+
+    def release_stale(self) -> int:
+        with Session(bind=self.engine) as session:
+            expired_at = self.get_now(session) - timedelta(seconds=self.lease_seconds)
+            jobs = session.query(MeasurementJob) \
+                .filter(MeasurementJob.status == 'running',
+                        MeasurementJob.heartbeat_at < expired_at) \
+                .with_for_update(skip_locked=True) \
+                .all()
+            for job in jobs:
+                logger.warning(f'Lease of job {job.id} by {job.station} expired, the job is '
+                               f'queued again')
+                job.status = 'queued'
+                job.error = f'Lease of {job.station} expired'
+                job.station = None
+            session.commit()
+            return len(jobs)
+
+    def claim(self) -> Optional[tuple[MeasurementJob, timedelta]]:
+        """Returns the job with the highest priority and how long it waited in the queue."""
+        with Session(bind=self.engine, expire_on_commit=False) as session:
+            while True:
+                job = session.query(MeasurementJob) \
+                    .filter(MeasurementJob.status == 'queued',
+                            MeasurementJob.config == self.config) \
+                    .order_by(MeasurementJob.priority.desc(), MeasurementJob.id) \
+                    .with_for_update(skip_locked=True) \
+                    .first()
+                if job is None:
+                    session.rollback()
+                    return None
+                now = self.get_now(session)
+                claimed = session.query(MeasurementJob) \
+                    .filter(MeasurementJob.id == job.id, MeasurementJob.status == 'queued') \
+                    .update({MeasurementJob.status: 'running',
+                             MeasurementJob.station: self.station,
+                             MeasurementJob.claimed_at: now,
+                             MeasurementJob.heartbeat_at: now,
+                             MeasurementJob.attempts: MeasurementJob.attempts + 1},
+                            synchronize_session=False)
+                session.commit()
+                if claimed:
+                    return job, now - job.created_at
+                # another station claimed the job between select and update
+
+    def update(self, job_id: int, values: dict) -> bool:
+        """Updates a job leased by the station, returns False if the lease is lost."""
+        with Session(bind=self.engine) as session:
+            updated = session.query(MeasurementJob) \
+                .filter(MeasurementJob.id == job_id, MeasurementJob.status == 'running',
+                        MeasurementJob.station == self.station) \
+                .update(values, synchronize_session=False)
+            session.commit()
+            return bool(updated)
+
+    def heartbeat(self, job_id: int) -> bool:
+        return self.update(job_id, {MeasurementJob.heartbeat_at: func.current_timestamp()})
+
+    def finish(self, job_id: int, status: str, error: Optional[str] = None) -> bool:
+        return self.update(job_id, {MeasurementJob.status: status,
+                                    MeasurementJob.error: error,
+                                    MeasurementJob.finished_at: func.current_timestamp()})
+
+    def release(self, job_id: int, error: str) -> bool:
+        return self.update(job_id, {MeasurementJob.status: 'queued',
+                                    MeasurementJob.station: None,
+                                    MeasurementJob.error: error})
+
+
+class Heartbeat:
+    """Renews the lease of a job in a background thread while the station measures it."""
+
+    def __init__(self, scheduler: JobScheduler, job_id: int, interval: float):
+        self.scheduler = scheduler
+        self.job_id = job_id
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.work, name='job-heartbeat', daemon=True)
+
+    def __enter__(self) -> 'Heartbeat':
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+
+    def work(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if not self.scheduler.heartbeat(self.job_id):
+                    logger.warning(f'Lease of job {self.job_id} is lost, another station may '
+                                   f'measure it')
+            except SQLAlchemyError as e:
+                logger.warning(f'Heartbeat of job {self.job_id} failed: {e}')
+
+
+@click.command(name='worker', help='Measure jobs of the config queued in database, see `jobs` '
+                                   'command of analyzing. Jobs are claimed by priority.')
+@click.pass_context
+@click.option("--station", "station_name", envvar='ELFYS_STATION', default=socket.gethostname(),
+              show_default=True, help="Name of the station in the job queue, ELFYS_STATION "
+                                      "environment variable by default.")
+@click.option("-q", "--queue", "queue_path", envvar='ELFYS_MEASURE_QUEUE',
+              type=click.Path(dir_okay=False),
+              default=os.path.join(click.get_app_dir('elfys'), 'queue.db'), show_default=True,
+              help="SQLite file where chips of claimed jobs are tracked, ELFYS_MEASURE_QUEUE "
+                   "environment variable by default.")
+@click.option("-r", "--retries", default=2, show_default=True, type=click.IntRange(min=0),
+              help="Retries of invalid measurements before chips are deferred to the end of "
+                   "the job.")
+@click.option("--poll", "poll_interval", default=10.0, show_default=True,
+              type=click.FloatRange(min=0), help="Seconds between polls of an empty queue.")
+@click.option("--lease", "lease_seconds", default=300.0, show_default=True,
+              type=click.FloatRange(min=1),
+              help="Seconds without heartbeat after which a running job is queued again.")
+@click.option("--exit-when-empty", is_flag=True, help="Exit when no jobs are queued.")
+@confirm_chips_option
+def worker(ctx: click.Context, station_name: str, queue_path: str, retries: int,
+           poll_interval: float, lease_seconds: float, exit_when_empty: bool,
+           confirm_chips: bool):
+    instrument: GPIBInstrument = ctx.obj['instrument']
+    plan: MeasurementPlan = ctx.obj['plan']
+    engine: Engine = ctx.obj['session'].get_bind()
+    scheduler = JobScheduler(engine, station_name, ctx.obj['config_name'], lease_seconds)
+    queue = open_queue(ctx, queue_path)
+    counts = {'done': 0, 'failed': 0}
+    idle_time = 0.0
+    logger.info(f'Station {station_name} waits for jobs of {ctx.obj["config_name"]}')
+
+    while True:
+        idle_since = perf_counter()
+        scheduler.release_stale()
+        claimed = scheduler.claim()
+        while claimed is None and not exit_when_empty:
+            sleep(poll_interval)
+            scheduler.release_stale()
+            claimed = scheduler.claim()
+        idle_time += perf_counter() - idle_since
+        if claimed is None:
+            break
+        job, waited = claimed
+        logger.info(f'Job {job.id} of wafer {job.wafer_name} (priority {job.priority}) is '
+                    f'claimed, it waited {waited} in queue')
+
+        chip_names = job.get_chip_names()
+        if len(chip_names) % len(plan.chips):
+            scheduler.finish(job.id, 'failed', f'Chips are measured in groups of '
+                                               f'{len(plan.chips)}, job has {len(chip_names)}')
+            counts['failed'] += 1
+            continue
+        # chips of a job are tracked by the job, so a job claimed again skips chips which are done
+        local_job_id, _ = queue.get_job(job.wafer_name, job.chip_state_id, job.measurement_type,
+                                        f'{plan.config_hash}/{job.id}')
+        queue.add_chips(local_job_id, chip_names, len(plan.chips))
+        try:
+            with Heartbeat(scheduler, job.id, lease_seconds / 4):
+                deferred = run_wafer_job(ctx, instrument, plan, job.measurement_type, queue,
+                                         local_job_id, job.wafer_name, job.chip_state_id,
+                                         retries, confirm_chips)
+        except BaseException as e:
+            scheduler.release(job.id, f'{type(e).__name__}: {e}')
+            logger.error(f'Job {job.id} is queued again: {e!r}')
+            raise
+
+        status = 'failed' if deferred else 'done'
+        error = f"Measurements of {', '.join(deferred)} are invalid" if deferred else None
+        if not scheduler.finish(job.id, status, error):
+            logger.warning(f'Job {job.id} was released by another station before it finished')
+        counts[status] += 1
+        logger.info(f'Job {job.id} {status}')
+
+    logger.info(f"Station {station_name}: {counts['done']} jobs done, {counts['failed']} failed, "
+                f"idle {timedelta(seconds=round(idle_time))}")
@@ -0,0 +1,102 @@
+from time import sleep
+from typing import Optional
+
+import numpy as np
+from pyvisa.resources import GPIBInstrument
+
+from .common import CommandBatcher, Sweep, measure_sweep
+from .plan import MeasureCommand, SettlingConfig, SetupCommand
+
+
+def get_offset(raw_measurements: dict[str, list]) -> float:
+    """Absolute current at 0 V of the least squares line of the sweep."""
+    voltages = np.asarray(raw_measurements['voltage_input'], dtype=float)
+    if 'anode_current' in raw_measurements:
+        currents = np.asarray(raw_measurements['anode_current'], dtype=float)
+    elif 'cathode_current' in raw_measurements:
+        currents = np.asarray(raw_measurements['cathode_current'], dtype=float)
+    else:
+        raise ValueError('No current measurement found')
+    voltage_deviations = voltages - voltages.mean()
+    variance = np.dot(voltage_deviations, voltage_deviations)
+    slope = np.dot(voltage_deviations, currents - currents.mean()) / variance if variance else 0
+    return abs(currents.mean() - slope * voltages.mean())
+
+
+class SettlingDetector:
+    """
+    Offsets of consecutive sweeps of a chip which settles after the contact. The offset decays
+    about geometrically, so the decrease left after the last sweep is predicted from the last two
+    decreases and sweeping stops once it is within `rtol` of the offset.
+    """
+
+    def __init__(self, config: SettlingConfig):
+        self.config = config
+        self.offsets: list[float] = []
+
+    def add(self, offset: float):
+        self.offsets.append(offset)
+
+    def is_settled(self) -> bool:
+        offsets = self.offsets
+        if offsets[-1] <= self.config.atol or len(offsets) >= self.config.max_sweeps:
+            return True
+        if len(offsets) < 2:
+            return False
+        decrease = offsets[-2] - offsets[-1]
+        if decrease <= 0:
+            return True  # the offset does not decrease anymore
+        if len(offsets) == 2:
+            return decrease <= self.config.rtol * offsets[-1]
+        previous_decrease = offsets[-3] - offsets[-2]
+        if decrease >= previous_decrease:
+            return False  # not decaying yet
+        ratio = decrease / previous_decrease
+        return decrease * ratio / (1 - ratio) <= self.config.rtol * offsets[-1]
+
+
+def send_setup(instrument: GPIBInstrument, batcher: CommandBatcher,
+               commands: tuple[SetupCommand, ...]):
+    for message in batcher.get_messages(commands):
+        instrument.write(message)
+
+
+def get_settled_measurements(instrument: GPIBInstrument, commands: tuple[MeasureCommand, ...],
+                             config: SettlingConfig, batcher: CommandBatcher) \
+        -> tuple[Sweep, int, int]:
+    """
+    Sweeps until the offset settles and returns the full sweep with the lowest offset with the
+    numbers of full and spot check sweeps. With a spot check, the offset is followed by short
+    sweeps and one full sweep is taken after it settles. Offsets of short sweeps are not
+    comparable to the full sweep ones, so they are detected as a separate series.
+    """
+    detector = SettlingDetector(config)
+    best: Optional[tuple[float, Sweep]] = None
+    full_sweeps, spot_sweeps = 0, 0
+    spot_check = config.spot_check
+
+    def sweep(full: bool) -> float:
+        nonlocal best, full_sweeps, spot_sweeps
+        measured = measure_sweep(instrument, commands)
+        offset = get_offset(measured.measurements)
+        if full:
+            full_sweeps += 1
+            if best is None or offset < best[0]:
+                best = offset, measured
+        else:
+            spot_sweeps += 1
+        return offset
+
+    detector.add(sweep(True))
+    if spot_check is not None and not detector.is_settled():
+        send_setup(instrument, batcher, spot_check.setup)
+        detector = SettlingDetector(config)
+        sleep(config.interval)
+        detector.add(sweep(False))
+    while not detector.is_settled():
+        sleep(config.interval)
+        detector.add(sweep(spot_check is None))
+    if spot_sweeps:
+        send_setup(instrument, batcher, spot_check.restore)
+        sweep(True)
+    return best[1], full_sweeps, spot_sweeps
@@ -0,0 +1,148 @@
+import os
+import threading
+from typing import Any, NamedTuple, Optional
+
+import click
+import yaml
+from pyvisa.resources import GPIBInstrument
+
+from utils import logger, validate_chip_names, validate_wafer_name
+from .common import CommandBatcher, InstrumentTiming
+from .cv import run_cv_programs
+from .iv import run_iv_programs
+from .plan import ConfigError, MeasurementPlan, load_plan
+from .temperature import get_temperature_sampler
+from .writer import get_writer
+
+MEASUREMENT_TYPES = {'iv', 'cv'}
+
+
+class StationInstrument(NamedTuple):
+    name: str
+    measurements_type: str
+    plan: MeasurementPlan
+
+
+def load_station(config_path: str, cache_dir: Optional[str] = None) \
+        -> tuple[StationInstrument, ...]:
+    """Compiles configs of the instruments listed in a station config, see station-*.yaml."""
+    try:
+        with open(config_path) as file:
+            configs = yaml.safe_load(file)
+        instruments = []
+        for instrument_config in configs['station']:
+            if instrument_config['type'] not in MEASUREMENT_TYPES:
+                raise ConfigError(f"Invalid measurements type {instrument_config['type']} of "
+                                  f"{instrument_config['name']}")
+            path = os.path.join(os.path.dirname(config_path), instrument_config['config'])
+            try:
+                plan = load_plan(path, cache_dir)
+            except ConfigError as e:
+                raise ConfigError(f"{instrument_config['config']}: {e}")
+            instruments.append(StationInstrument(instrument_config['name'],
+                                                 instrument_config['type'], plan))
+    except yaml.YAMLError as e:
+        raise ConfigError(f'Invalid YAML: {e}')
+    except OSError as e:
+        raise ConfigError(str(e))
+    except KeyError as e:
+        raise ConfigError(f'Missing key {e} in station config')
+    except (AttributeError, TypeError) as e:
+        raise ConfigError(f'Invalid station config structure: {e}')
+
+    names = [instrument.name for instrument in instruments]
+    if len(set(names)) != len(names):
+        raise ConfigError('Names of station instruments must be unique')
+    resources = [instrument.plan.pyvisa_resource for instrument in instruments]
+    if len(set(resources)) != len(resources):
+        raise ConfigError('Every station instrument must have its own pyvisa resource')
+    return tuple(instruments)
+
+
+def parse_station_chips(ctx: click.Context, instruments: tuple[StationInstrument, ...],
+                        values: tuple[str]) -> dict[str, list[str]]:
+    chips = {instrument.name: [] for instrument in instruments}
+    for value in values:
+        name, _, chip_names = value.partition(':')
+        if name not in chips or not chip_names:
+            raise click.BadParameter(f'{value} is not INSTRUMENT:CHIP[,CHIP...] of instruments '
+                                     f'{", ".join(chips)}', param_hint='--chip-name')
+        chips[name].extend(validate_chip_names(ctx, ..., chip_names.split(',')))
+    for instrument in instruments:
+        for i in range(len(instrument.plan.chips) - len(chips[instrument.name])):
+            chip_name = click.prompt(f"Input chip name {i + 1} of {instrument.name}", type=str)
+            chips[instrument.name].extend(validate_chip_names(ctx, ..., [chip_name]))
+        if len(chips[instrument.name]) != len(instrument.plan.chips):
+            raise click.BadParameter(f'{len(instrument.plan.chips)} chip names of '
+                                     f'{instrument.name} expected', param_hint='--chip-name')
+    all_chips = [chip_name for chip_names in chips.values() for chip_name in chip_names]
+    if len(set(all_chips)) != len(all_chips):
+        raise click.BadParameter('A chip can be measured by one instrument only',
+                                 param_hint='--chip-name')
+    return chips
+
+
+class PendingResults:
+    """Results of one instrument, passed to the shared writer only if all its programs pass."""
+
+    def __init__(self):
+        self.items: list[tuple[Any, str, list[dict]]] = []
+
+    def put(self, model: Any, chip_name: str, mappings: list[dict[str, Any]]):
+        self.items.append((model, chip_name, mappings))
+
+
+@click.command(name='station', help='Measure chips with all instruments of a station config '
+                                    'concurrently. Invalid measurements are not saved.')
+@click.pass_context
+@click.option("-n", "--chip-name", "chip_names", multiple=True,
+              help="Chips measured by an instrument, INSTRUMENT:CHIP[,CHIP...]. Can be repeated.")
+@click.option("-w", "--wafer", "wafer_name", prompt=f"Input wafer name",
+              callback=validate_wafer_name, help="Wafer name.")
+@click.option("-s", "--chip-state", "chip_state_id", prompt="Input chip state",
+              help="State of the chips.")
+def station(ctx: click.Context, chip_names: tuple[str], wafer_name: str, chip_state_id: str):
+    instruments: tuple[StationInstrument, ...] = ctx.obj['station']
+    resources: dict[str, GPIBInstrument] = ctx.obj['instruments']
+    batchers: dict[str, CommandBatcher] = ctx.obj['batchers']
+    chips = parse_station_chips(ctx, instruments, chip_names)
+    # one sampler reads the sensors of all instruments, the hub is not shared between threads
+    sensor_ids = [instrument.plan.temperature_resource for instrument in instruments
+                  if instrument.measurements_type == 'iv']
+    sampler = get_temperature_sampler(ctx, sensor_ids) if sensor_ids else None
+    timings = {instrument.name: InstrumentTiming() for instrument in instruments}
+    errors: dict[str, Exception] = {}
+
+    def work(instrument: StationInstrument, writer):
+        name = instrument.name
+        results = PendingResults()
+        try:
+            if instrument.measurements_type == 'iv':
+                run_iv_programs(resources[name], instrument.plan, batchers[name], results,
+                                chips[name], int(chip_state_id), sampler, True,
+                                timings[name], f'{name}: ')
+            else:
+                run_cv_programs(resources[name], instrument.plan, batchers[name], results,
+                                chips[name], int(chip_state_id), True, timings[name], f'{name}: ')
+            with timings[name].stage('saving'):
+                for item in results.items:
+                    writer.put(*item)
+        except Exception as e:
+            logger.error(f'{name}: {e}')
+            errors[name] = e
+
+    all_chips = [chip_name for instrument in instruments for chip_name in chips[instrument.name]]
+    with get_writer(ctx, wafer_name, all_chips) as writer:
+        threads = [threading.Thread(target=work, args=(instrument, writer),
+                                    name=f'measure-{instrument.name}')
+                   for instrument in instruments]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    for name, timing in timings.items():
+        logger.info(f'{name}: {timing.total:.3f} s ({timing})')
+    if errors:
+        raise click.ClickException(f"Measurements of {', '.join(errors)} are not saved")
+    logger.info('Measurements saved')
@@ -0,0 +1,117 @@
+import threading
+from time import monotonic
+from typing import Optional
+
+import click
+import numpy as np
+from yoctopuce.yocto_temperature import YAPI, YRefParam, YTemperature
+
+from utils import logger
+
+
+class TemperatureSampler:
+    """
+    Reads temperature sensors in a background thread into a ring buffer of `capacity` samples, so
+    the Yoctopuce hub is registered once per command and every point of a sweep gets the
+    temperature interpolated at the time it was measured. Points measured after the last sample
+    get its value. Simulated sensors drift slowly from a random temperature.
+    """
+
+    def __init__(self, sensor_ids: list[Optional[str]], interval: float = 1.0,
+                 capacity: int = 3600, simulate: bool = False):
+        self.sensor_ids = list(dict.fromkeys(sensor_ids))
+        self.interval = interval
+        self.capacity = capacity
+        self.simulate = simulate
+        self.times = np.full(capacity, np.nan)
+        self.values = np.full((capacity, len(self.sensor_ids)), np.nan)
+        self.count = 0
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
+        self.error: Optional[Exception] = None
+        self.thread = threading.Thread(target=self.work, name='temperature-sampler', daemon=True)
+
+    def start(self) -> 'TemperatureSampler':
+        self.thread.start()
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def open_sensors(self) -> list[YTemperature]:
+        errmsg = YRefParam()
+        if YAPI.RegisterHub("usb", errmsg) != YAPI.SUCCESS:
+            raise RuntimeError("RegisterHub (temperature sensor) error: " + errmsg.value)
+        sensors = [YTemperature.FindTemperature(sensor_id) for sensor_id in self.sensor_ids]
+        if not all(sensor.isOnline() for sensor in sensors):
+            raise RuntimeError('Temperature sensor is not connected')
+        return sensors
+
+    def work(self):
+        rng = np.random.default_rng()
+        try:
+            try:
+                if self.simulate:
+                    simulated = 20 + rng.random(len(self.sensor_ids)) * 10
+                else:
+                    sensors = self.open_sensors()
+            except Exception as e:
+                self.error = e
+                self.ready.set()
+                return
+
+            failing = False
+            while True:
+                try:
+                    if self.simulate:
+                        simulated += rng.normal(0, 0.01, len(simulated))
+                        values = simulated
+                    else:
+                        values = [sensor.get_currentValue() for sensor in sensors]
+                    self.append(monotonic(), values)
+                    failing = False
+                except Exception as e:
+                    if not failing:
+                        logger.warning(f'Temperature is not sampled, retrying: {e}')
+                    failing = True
+                self.ready.set()
+                if self.stopped.wait(self.interval):
+                    break
+        finally:
+            if not self.simulate:
+                YAPI.FreeAPI()
+
+    def append(self, timestamp: float, values):
+        with self.lock:
+            index = self.count % self.capacity
+            self.times[index] = timestamp
+            self.values[index] = values
+            self.count += 1
+
+    def get_temperatures(self, sensor_id: Optional[str], timestamps: np.ndarray) -> np.ndarray:
+        """Temperatures of the sensor at `monotonic()` timestamps."""
+        column = self.sensor_ids.index(sensor_id)
+        with self.lock:
+            start = self.count % self.capacity if self.count > self.capacity else 0
+            count = min(self.count, self.capacity)
+            times = np.roll(self.times, -start)[:count]
+            values = np.roll(self.values[:, column], -start)[:count]
+        if not count:
+            raise RuntimeError('Temperature is not sampled')
+        return np.interp(timestamps, times, values)
+
+
+def get_temperature_sampler(ctx: click.Context, sensor_ids: list[Optional[str]]) \
+        -> TemperatureSampler:
+    """Sampler of the command, started on the first call and stopped when the command exits."""
+    if ctx.obj.get('temperature_sampler') is None:
+        sampler = TemperatureSampler(sensor_ids, ctx.obj['temperature_interval'],
+                                     simulate=ctx.obj['simulate']).start()
+        ctx.call_on_close(sampler.stop)
+        ctx.obj['temperature_sampler'] = sampler
+    return ctx.obj['temperature_sampler']
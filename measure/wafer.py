@@ -0,0 +1,257 @@
+import os
+import sqlite3
+from collections import deque
+from datetime import datetime, timedelta
+from time import perf_counter
+from typing import Optional
+
+import click
+from pyvisa.resources import GPIBInstrument
+
+from utils import logger, validate_chip_names, validate_wafer_name, read_wafer_map
+from .common import InstrumentTiming, InvalidMeasurementError
+from .cv import run_cv_programs
+from .iv import run_iv_programs
+from .plan import MeasurementPlan
+from .temperature import get_temperature_sampler
+from .writer import get_writer
+
+QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS job (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    wafer_name TEXT NOT NULL,
+    chip_state_id INTEGER NOT NULL,
+    measurements_type TEXT NOT NULL,
+    config_hash TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    UNIQUE (wafer_name, chip_state_id, measurements_type, config_hash)
+);
+CREATE TABLE IF NOT EXISTS job_chip (
+    job_id INTEGER NOT NULL REFERENCES job (id) ON DELETE CASCADE,
+    chip_name TEXT NOT NULL,
+    group_index INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    seconds REAL,
+    finished_at TEXT,
+    PRIMARY KEY (job_id, chip_name)
+);
+"""
+CHIP_STATUSES = ('pending', 'done', 'deferred')
+
+confirm_chips_option = click.option(
+    "--confirm/--no-confirm", "confirm_chips", default=True, show_default=True,
+    help="Wait for confirmation that chips of a group are in place before measuring them. "
+         "--no-confirm is only for setups where chips are placed automatically, e.g. by a prober.")
+
+
+class WaferQueue:
+    """
+    SQLite file with chips of wafer jobs and their statuses. A job is a wafer measured in a chip
+    state with one config, so a restarted job skips chips which are done.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = FULL')
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.executescript(QUEUE_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def get_job(self, wafer_name: str, chip_state_id: int, measurements_type: str,
+                config_hash: str) -> tuple[int, bool]:
+        """Returns id of the job and whether it is created."""
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT OR IGNORE INTO job (wafer_name, chip_state_id, measurements_type, '
+                'config_hash, created_at) VALUES (?, ?, ?, ?, ?)',
+                (wafer_name, chip_state_id, measurements_type, config_hash,
+                 datetime.now().isoformat(sep=' ')))
+            if cursor.rowcount:
+                return cursor.lastrowid, True
+            return self.connection.execute(
+                'SELECT id FROM job WHERE wafer_name = ? AND chip_state_id = ? AND '
+                'measurements_type = ? AND config_hash = ?',
+                (wafer_name, chip_state_id, measurements_type, config_hash)).fetchone()[0], False
+
+    def add_chips(self, job_id: int, chip_names: list[str], group_size: int) -> int:
+        """Adds new chips in groups measured together, returns the number of added chips."""
+        with self.connection:
+            existing = {chip_name for chip_name, in self.connection.execute(
+                'SELECT chip_name FROM job_chip WHERE job_id = ?', (job_id,))}
+            new_chip_names = [chip_name for chip_name in dict.fromkeys(chip_names)
+                              if chip_name not in existing]
+            first_group = self.connection.execute(
+                'SELECT COALESCE(MAX(group_index) + 1, 0) FROM job_chip WHERE job_id = ?',
+                (job_id,)).fetchone()[0]
+            self.connection.executemany(
+                'INSERT INTO job_chip (job_id, chip_name, group_index) VALUES (?, ?, ?)',
+                [(job_id, chip_name, first_group + i // group_size)
+                 for i, chip_name in enumerate(new_chip_names)])
+        return len(new_chip_names)
+
+    def get_groups(self, job_id: int, status: str) -> list[list[str]]:
+        groups: dict[int, list[str]] = {}
+        for group_index, chip_name in self.connection.execute(
+                'SELECT group_index, chip_name FROM job_chip WHERE job_id = ? AND status = ? '
+                'ORDER BY group_index, rowid', (job_id, status)):
+            groups.setdefault(group_index, []).append(chip_name)
+        return list(groups.values())
+
+    def record_attempt(self, job_id: int, chip_names: list[str], error: Optional[str] = None):
+        with self.connection:
+            self.connection.executemany(
+                'UPDATE job_chip SET attempts = attempts + 1, error = ? '
+                'WHERE job_id = ? AND chip_name = ?',
+                [(error, job_id, chip_name) for chip_name in chip_names])
+
+    def set_status(self, job_id: int, chip_names: list[str], status: str,
+                   seconds: Optional[float] = None):
+        with self.connection:
+            self.connection.executemany(
+                'UPDATE job_chip SET status = ?, seconds = ?, finished_at = ? '
+                'WHERE job_id = ? AND chip_name = ?',
+                [(status, seconds, datetime.now().isoformat(sep=' '), job_id, chip_name)
+                 for chip_name in chip_names])
+
+    def count_chips(self, job_id: int) -> dict[str, int]:
+        counts = dict.fromkeys(CHIP_STATUSES, 0)
+        counts.update(self.connection.execute(
+            'SELECT status, COUNT(*) FROM job_chip WHERE job_id = ? GROUP BY status', (job_id,)))
+        return counts
+
+
+def open_queue(ctx: click.Context, path: str) -> WaferQueue:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    queue = WaferQueue(path)
+    ctx.call_on_close(queue.close)
+    return queue
+
+
+class JobProgress:
+    """Throughput of the current run and estimated time of the remaining chips."""
+
+    def __init__(self):
+        self.started_at = perf_counter()
+        self.chips_count = 0
+
+    def update(self, chips_count: int, remaining: int) -> str:
+        self.chips_count += chips_count
+        elapsed = perf_counter() - self.started_at
+        seconds_per_chip = elapsed / self.chips_count
+        eta = timedelta(seconds=round(seconds_per_chip * remaining))
+        return f'{3600 / seconds_per_chip:.1f} chips/h, {remaining} chips remain, ETA {eta}'
+
+
+@click.command(name='wafer', help='Measure chips of a wafer in groups of the config chips. '
+                                  'Progress is kept in a queue file, so an interrupted job is '
+                                  'resumed by running the same command again.')
+@click.pass_context
+@click.option("-t", "--type", "measurements_type", type=click.Choice(['iv', 'cv']), default='iv',
+              show_default=True, help="Type of measurements of the config.")
+@click.option("-n", "--chip-name", "chip_names", help="Chip name. Can be repeated.",
+              callback=validate_chip_names, multiple=True, default=[])
+@click.option("-m", "--wafer-map", "wafer_map_path", type=click.Path(exists=True, dir_okay=False),
+              help="Text file with chip names in measurement order, separated by commas or "
+                   "whitespace.")
+@click.option("-w", "--wafer", "wafer_name", prompt=f"Input wafer name",
+              callback=validate_wafer_name, help="Wafer name.")
+@click.option("-s", "--chip-state", "chip_state_id", prompt="Input chip state",
+              help="State of the chips.")
+@click.option("-q", "--queue", "queue_path", envvar='ELFYS_MEASURE_QUEUE',
+              type=click.Path(dir_okay=False),
+              default=os.path.join(click.get_app_dir('elfys'), 'queue.db'), show_default=True,
+              help="SQLite file of the job queue, ELFYS_MEASURE_QUEUE environment variable by "
+                   "default.")
+@click.option("-r", "--retries", default=2, show_default=True, type=click.IntRange(min=0),
+              help="Retries of invalid measurements before chips are deferred to the end of "
+                   "the job.")
+@confirm_chips_option
+def wafer(ctx: click.Context, measurements_type: str, chip_names: list[str],
+          wafer_map_path: Optional[str], wafer_name: str, chip_state_id: str, queue_path: str,
+          retries: int, confirm_chips: bool):
+    instrument: GPIBInstrument = ctx.obj['instrument']
+    plan: MeasurementPlan = ctx.obj['plan']
+    if wafer_map_path is not None:
+        chip_names = chip_names + validate_chip_names(ctx, ..., read_wafer_map(wafer_map_path))
+    if len(chip_names) % len(plan.chips):
+        raise click.BadParameter(f'Chips are measured in groups of {len(plan.chips)}, '
+                                 f'{len(chip_names)} chip names given', param_hint='--chip-name')
+
+    queue = open_queue(ctx, queue_path)
+    job_id, created = queue.get_job(wafer_name, int(chip_state_id), measurements_type,
+                                    plan.config_hash)
+    added = queue.add_chips(job_id, chip_names, len(plan.chips))
+    counts = queue.count_chips(job_id)
+    logger.info(f"Job {job_id} of wafer {wafer_name} is {'created' if created else 'resumed'}: "
+                f"{added} chips added, {counts['done']} done, {counts['pending']} pending, "
+                f"{counts['deferred']} deferred")
+
+    deferred = run_wafer_job(ctx, instrument, plan, measurements_type, queue, job_id, wafer_name,
+                             int(chip_state_id), retries, confirm_chips)
+    counts = queue.count_chips(job_id)
+    logger.info(f"Job {job_id}: {counts['done']} chips done, {counts['deferred']} deferred")
+    if deferred:
+        raise click.ClickException(f"Measurements of {', '.join(deferred)} are invalid, "
+                                   f"run the job again to retry them")
+
+
+def run_wafer_job(ctx: click.Context, instrument: GPIBInstrument, plan: MeasurementPlan,
+                  measurements_type: str, queue: WaferQueue, job_id: int, wafer_name: str,
+                  chip_state_id: int, retries: int, confirm_chips: bool) -> list[str]:
+    """Measures pending and deferred chips of a job, returns chips which are still deferred."""
+    # deferred groups are measured once more after the pending ones, last chance is marked True
+    groups = deque([(group, False) for group in queue.get_groups(job_id, 'pending')] +
+                   [(group, True) for group in queue.get_groups(job_id, 'deferred')])
+    if not groups:
+        logger.info('No chips to measure')
+        return []
+    progress = JobProgress()
+    while groups:
+        group, last_chance = groups.popleft()
+        if confirm_chips:
+            click.confirm(f"Are chips {', '.join(group)} in place?", default=True, abort=True)
+        if measure_group(ctx, instrument, plan, measurements_type, queue, job_id, group,
+                         wafer_name, chip_state_id, retries):
+            status = 'done'
+        else:
+            status = 'deferred'
+            if not last_chance:
+                groups.append((group, True))
+        remaining = sum(len(chip_names) for chip_names, _ in groups)
+        logger.info(f"{', '.join(group)} {status}, {progress.update(len(group), remaining)}")
+
+    return [chip_name for group in queue.get_groups(job_id, 'deferred') for chip_name in group]
+
+
+def measure_group(ctx: click.Context, instrument: GPIBInstrument, plan: MeasurementPlan,
+                  measurements_type: str, queue: WaferQueue, job_id: int, chip_names: list[str],
+                  wafer_name: str, chip_state_id: int, retries: int) -> bool:
+    """Measures chips until the measurements are valid, returns False when retries run out."""
+    for attempt in range(retries + 1):
+        started_at = perf_counter()
+        timing = InstrumentTiming()
+        try:
+            with get_writer(ctx, wafer_name, chip_names) as writer:
+                if measurements_type == 'iv':
+                    sampler = get_temperature_sampler(ctx, [plan.temperature_resource])
+                    run_iv_programs(instrument, plan, ctx.obj['batcher'], writer, chip_names,
+                                    chip_state_id, sampler, True, timing)
+                else:
+                    run_cv_programs(instrument, plan, ctx.obj['batcher'], writer, chip_names,
+                                    chip_state_id, True, timing)
+        except InvalidMeasurementError as e:
+            queue.record_attempt(job_id, chip_names, str(e))
+            logger.warning(f"{', '.join(chip_names)}: {e}, attempt {attempt + 1} of {retries + 1}")
+            continue
+        queue.record_attempt(job_id, chip_names)
+        queue.set_status(job_id, chip_names, 'done', perf_counter() - started_at)
+        logger.debug(f'Timing: {timing}')
+        return True
+    queue.set_status(job_id, chip_names, 'deferred')
+    return False
@@ -0,0 +1,101 @@
+import queue
+import threading
+from time import perf_counter
+from typing import Any, Union
+
+import click
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from utils import logger
+from .buffer import BufferWriter
+from .common import get_or_create_chips
+
+
+class MeasurementWriter:
+    """
+    Inserts measurements in a thread with its own connection, so the instrument runs the next
+    program while results of the previous one are sent to the database. At most `max_pending`
+    batches wait for the writer, then `put` blocks until the writer catches up. Chips and
+    measurements are committed in one transaction on a successful exit, like the sequential code
+    did.
+    """
+
+    def __init__(self, engine: Engine, wafer_name: str, chip_names: list[str],
+                 max_pending: int = 2):
+        self.engine = engine
+        self.wafer_name = wafer_name
+        self.chip_names = chip_names
+        self.pending: queue.Queue = queue.Queue(maxsize=max_pending)
+        self.errors: list[Exception] = []
+        self.rows_count = 0
+        self.blocked_time = 0.0
+        self.commit = True
+        self.thread = threading.Thread(target=self.work, name='measurement-writer', daemon=True)
+
+    def __enter__(self) -> 'MeasurementWriter':
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(commit=exc_type is None)
+
+    def work(self):
+        with Session(bind=self.engine) as session:
+            try:
+                chips = get_or_create_chips(session, self.wafer_name, self.chip_names)
+            except Exception as e:
+                self.errors.append(e)
+            while True:
+                batch = self.pending.get()
+                if batch is None:
+                    break
+                if self.errors:
+                    continue  # drains the queue, so the producer is not blocked
+                model, chip_name, mappings = batch
+                try:
+                    session.bulk_insert_mappings(
+                        model, [dict(mapping, chip_id=chips[chip_name].id) for mapping in mappings])
+                    self.rows_count += len(mappings)
+                except Exception as e:
+                    self.errors.append(e)
+            try:
+                if self.commit and not self.errors:
+                    session.commit()
+                else:
+                    session.rollback()
+            except Exception as e:
+                self.errors.append(e)
+
+    def raise_error(self):
+        if self.errors:
+            raise RuntimeError('Measurements are not saved') from self.errors[0]
+
+    def put(self, model: Any, chip_name: str, mappings: list[dict[str, Any]]):
+        started_at = perf_counter()
+        while True:
+            self.raise_error()
+            try:
+                self.pending.put((model, chip_name, mappings), timeout=1)
+                break
+            except queue.Full:
+                continue
+        self.blocked_time += perf_counter() - started_at
+
+    def close(self, commit: bool = True):
+        self.commit = commit
+        self.pending.put(None)
+        self.thread.join()
+        if commit:
+            self.raise_error()
+            logger.debug(f'{self.rows_count} rows are written, measurement waited '
+                         f'{self.blocked_time:.3f} s for the database')
+
+
+Writer = Union[MeasurementWriter, BufferWriter]
+
+
+def get_writer(ctx: click.Context, wafer_name: str, chip_names: list[str]) -> Writer:
+    if ctx.obj['buffer_path'] is not None:
+        return BufferWriter(ctx.obj['buffer_path'], wafer_name, ctx.obj['buffer_sync'].wake)
+    return MeasurementWriter(ctx.obj['session'].get_bind(), wafer_name, chip_names)
@@ -1,3 +1,4 @@
+from .archive_partition import ArchivePartition
 from .base import Base
 from .carrier import Carrier
 from .chip import Chip
@@ -8,4 +9,9 @@ from .eqe_measurement import EqeMeasurement
 from .eqe_session import EqeSession
 from .instrument import Instrument
 from .iv_measurement import IVMeasurement
+from .latest_cv_measurement import LatestCVMeasurement
+from .latest_iv_measurement import LatestIVMeasurement
+from .measurement_job import MeasurementJob
+from .measurement_upload import MeasurementUpload
+from .threshold import Threshold
 from .wafer import Wafer
@@ -0,0 +1,31 @@
+from sqlalchemy import Column, Integer, VARCHAR, DATETIME, ForeignKey, UniqueConstraint, func
+from sqlalchemy.orm import relationship
+
+from .base import Base
+
+
+class ArchivePartition(Base):
+    __tablename__ = 'archive_partition'
+    __table_args__ = (
+        UniqueConstraint('wafer_id', 'measurement_type', name='unique_archive_partition'),
+    )
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    wafer_id = Column(
+        Integer,
+        ForeignKey('wafer.id',
+                   name='archive_partition__wafer',
+                   ondelete='RESTRICT',
+                   onupdate='CASCADE'
+                   ),
+        nullable=False,
+    )
+    wafer = relationship("Wafer")
+    measurement_type = Column(VARCHAR(length=2), nullable=False, comment="iv or cv")
+    path = Column(VARCHAR(length=255), nullable=False, comment="Parquet file with measurements")
+    rows = Column(Integer, nullable=False)
+    archived_at = Column(DATETIME, server_default=func.current_timestamp(), nullable=False)
+
+    def __repr__(self):
+        return "<ArchivePartition(wafer_id='%d', type='%s', path='%s')>" % (
+            self.wafer_id, self.measurement_type, self.path)
@@ -1,5 +1,6 @@
 import pandas as pd
-from sqlalchemy import Column, Integer, CHAR, VARCHAR, ForeignKey, Computed, UniqueConstraint
+from sqlalchemy import Column, Integer, SmallInteger, CHAR, VARCHAR, ForeignKey, Computed, \
+    UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 
 from .base import Base
@@ -9,6 +10,8 @@ class Chip(Base):
     __tablename__ = 'chip'
     __table_args__ = (
         UniqueConstraint('name', 'wafer_id', name='unique_chip'),
+        Index('ix_chip_wafer_id_type_coordinates', 'wafer_id', 'type', 'x_coordinate',
+              'y_coordinate'),
     )
 
     chip_sizes = {
@@ -33,19 +36,15 @@ class Chip(Base):
     )
     wafer = relationship("Wafer", back_populates='chips')
     name = Column(VARCHAR(length=20), nullable=False)
-    type = Column(CHAR(length=1), Computed("'(SUBSTR(`name`,1,1))'", persisted=False))
+    type = Column(CHAR(length=1), Computed("SUBSTR(`name`,1,1)", persisted=True))
+    x_coordinate = Column(SmallInteger,
+                          Computed("CAST(SUBSTR(`name`,2,2) AS UNSIGNED)", persisted=True))
+    y_coordinate = Column(SmallInteger,
+                          Computed("CAST(SUBSTR(`name`,4,2) AS UNSIGNED)", persisted=True))
     iv_measurements = relationship("IVMeasurement", back_populates='chip')
     cv_measurements = relationship("CVMeasurement", back_populates='chip')
     eqe_conditions = relationship("EqeConditions", back_populates='chip')
 
-    @property
-    def x_coordinate(self):
-        return int(self.name[1:3])
-
-    @property
-    def y_coordinate(self):
-        return int(self.name[3:5])
-
     @property
     def area(self):
         return Chip.get_area(self.type)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, Float, DECIMAL, ForeignKey, DATETIME, func
+from sqlalchemy import Column, Integer, Float, DECIMAL, ForeignKey, DATETIME, func, Index
 from sqlalchemy.orm import relationship
 
 from .base import Base
@@ -6,6 +6,10 @@ from .base import Base
 
 class CVMeasurement(Base):
     __tablename__ = 'cv_data'
+    __table_args__ = (
+        Index('ix_cv_data_chip_state_voltage_key_datetime',
+              'chip_id', 'chip_state_id', 'voltage_key', 'datetime'),
+    )
 
     id = Column(Integer, primary_key=True, nullable=False)
     chip_id = Column(
@@ -29,6 +33,7 @@ class CVMeasurement(Base):
     )
     chip_state = relationship("ChipState")
     voltage_input = Column(DECIMAL(precision=10, scale=5), nullable=False)
+    voltage_key = Column(Integer, nullable=False)  # canonical voltage in microvolts
     capacitance = Column(Float, nullable=False)
     datetime = Column(DATETIME, server_default=func.current_timestamp(), nullable=False, )
 
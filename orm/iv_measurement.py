@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, Float, VARCHAR, DECIMAL, ForeignKey, DATETIME, func
+from sqlalchemy import Column, Integer, Float, VARCHAR, DECIMAL, ForeignKey, DATETIME, func, Index
 from sqlalchemy.orm import relationship
 
 from .base import Base
@@ -6,6 +6,10 @@ from .base import Base
 
 class IVMeasurement(Base):
     __tablename__ = 'iv_data'
+    __table_args__ = (
+        Index('ix_iv_data_chip_state_voltage_key_datetime',
+              'chip_id', 'chip_state_id', 'voltage_key', 'datetime'),
+    )
 
     id = Column(Integer, primary_key=True, nullable=False)
     chip_id = Column(
@@ -31,6 +35,7 @@ class IVMeasurement(Base):
     int_time = Column(VARCHAR(length=20))
     temperature = Column(Float)
     voltage_input = Column(DECIMAL(precision=10, scale=5), nullable=False)
+    voltage_key = Column(Integer, nullable=False)  # canonical voltage in microvolts
     anode_current = Column(Float, nullable=False)
     cathode_current = Column(Float, nullable=True)
     anode_current_corrected = Column(Float)
@@ -0,0 +1,27 @@
+from sqlalchemy import Column, Integer, Float, DECIMAL, DATETIME
+from sqlalchemy.orm import relationship
+
+from .base import Base
+
+
+class LatestCVMeasurement(Base):
+    """Read-only view with the newest cv_data row of every chip, chip state and voltage."""
+    __tablename__ = 'cv_data_latest'
+    __table_args__ = {'info': {'is_view': True}}
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    chip_id = Column(Integer, nullable=False)
+    chip = relationship("Chip", primaryjoin="foreign(LatestCVMeasurement.chip_id) == Chip.id",
+                        viewonly=True)
+    chip_state_id = Column(Integer, nullable=False)
+    chip_state = relationship("ChipState",
+                              primaryjoin="foreign(LatestCVMeasurement.chip_state_id) == ChipState.id",
+                              viewonly=True)
+    voltage_input = Column(DECIMAL(precision=10, scale=5), nullable=False)
+    voltage_key = Column(Integer, nullable=False)
+    capacitance = Column(Float, nullable=False)
+    datetime = Column(DATETIME, nullable=False)
+
+    def __repr__(self):
+        return "<LatestCVMeasurement(id='%d', chip='%s', capacitance='%.3e')>" % (
+            self.id, self.chip, self.capacitance)
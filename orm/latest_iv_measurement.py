@@ -0,0 +1,31 @@
+from sqlalchemy import Column, Integer, Float, VARCHAR, DECIMAL, DATETIME
+from sqlalchemy.orm import relationship
+
+from .base import Base
+
+
+class LatestIVMeasurement(Base):
+    """Read-only view with the newest iv_data row of every chip, chip state and voltage."""
+    __tablename__ = 'iv_data_latest'
+    __table_args__ = {'info': {'is_view': True}}
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    chip_id = Column(Integer, nullable=False)
+    chip = relationship("Chip", primaryjoin="foreign(LatestIVMeasurement.chip_id) == Chip.id",
+                        viewonly=True)
+    chip_state_id = Column(Integer, nullable=False)
+    chip_state = relationship("ChipState",
+                              primaryjoin="foreign(LatestIVMeasurement.chip_state_id) == ChipState.id",
+                              viewonly=True)
+    int_time = Column(VARCHAR(length=20))
+    temperature = Column(Float)
+    voltage_input = Column(DECIMAL(precision=10, scale=5), nullable=False)
+    voltage_key = Column(Integer, nullable=False)
+    anode_current = Column(Float, nullable=False)
+    cathode_current = Column(Float, nullable=True)
+    anode_current_corrected = Column(Float)
+    datetime = Column(DATETIME, nullable=False)
+
+    def __repr__(self):
+        return "<LatestIVMeasurement(chip='%s', voltage_input='%s', id='%d')>" % (
+            self.chip.name, self.voltage_input, self.id)
@@ -0,0 +1,45 @@
+from sqlalchemy import Column, Integer, VARCHAR, TEXT, DATETIME, ForeignKey, Index, func
+from sqlalchemy.orm import relationship
+
+from .base import Base
+
+
+class MeasurementJob(Base):
+    __tablename__ = 'measurement_job'
+    __table_args__ = (
+        Index('ix_measurement_job_status_config_priority', 'status', 'config', 'priority'),
+    )
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    wafer_name = Column(VARCHAR(length=20), nullable=False)
+    chip_names = Column(TEXT, nullable=False, comment="Comma separated chip names")
+    chip_state_id = Column(
+        Integer,
+        ForeignKey('chip_state.id',
+                   name='measurement_job__chip_state',
+                   ondelete='RESTRICT',
+                   onupdate='CASCADE'
+                   ),
+        nullable=False,
+    )
+    chip_state = relationship("ChipState")
+    measurement_type = Column(VARCHAR(length=2), nullable=False, comment="iv or cv")
+    config = Column(VARCHAR(length=100), nullable=False,
+                    comment="File name of the measure config, e.g. single-innopoli.yaml")
+    priority = Column(Integer, server_default='0', nullable=False, comment="Higher runs first")
+    status = Column(VARCHAR(length=10), server_default='queued', nullable=False,
+                    comment="queued, running, done, failed or cancelled")
+    station = Column(VARCHAR(length=100), comment="Station which claimed the job")
+    attempts = Column(Integer, server_default='0', nullable=False)
+    error = Column(TEXT)
+    created_at = Column(DATETIME, server_default=func.current_timestamp(), nullable=False)
+    claimed_at = Column(DATETIME)
+    heartbeat_at = Column(DATETIME, comment="Lease of the station, renewed while it measures")
+    finished_at = Column(DATETIME)
+
+    def get_chip_names(self) -> list[str]:
+        return self.chip_names.split(',')
+
+    def __repr__(self):
+        return "<MeasurementJob(id='%d', wafer_name='%s', status='%s')>" % (
+            self.id, self.wafer_name, self.status)
@@ -0,0 +1,29 @@
+from sqlalchemy import Column, Integer, VARCHAR, DATETIME, ForeignKey, func
+from sqlalchemy.orm import relationship
+
+from .base import Base
+
+
+class MeasurementUpload(Base):
+    __tablename__ = 'measurement_upload'
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    uid = Column(VARCHAR(length=36), nullable=False, unique=True,
+                 comment="Id of the batch in the local buffer of a measurement station")
+    wafer_id = Column(
+        Integer,
+        ForeignKey('wafer.id',
+                   name='measurement_upload__wafer',
+                   ondelete='CASCADE',
+                   onupdate='CASCADE'
+                   ),
+        nullable=False,
+    )
+    wafer = relationship("Wafer")
+    rows = Column(Integer, nullable=False)
+    measured_at = Column(DATETIME, nullable=False)
+    uploaded_at = Column(DATETIME, server_default=func.current_timestamp(), nullable=False)
+
+    def __repr__(self):
+        return "<MeasurementUpload(uid='%s', wafer_id='%d', rows='%d')>" % (
+            self.uid, self.wafer_id, self.rows)
@@ -0,0 +1,23 @@
+from sqlalchemy import Column, Integer, CHAR, VARCHAR, Float, DATETIME, UniqueConstraint, func
+
+from .base import Base
+
+
+class Threshold(Base):
+    __tablename__ = 'threshold'
+    __table_args__ = (
+        UniqueConstraint('version', 'measurement_type', 'chip_type', 'voltage_key',
+                         name='unique_threshold'),
+    )
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    version = Column(Integer, nullable=False)
+    measurement_type = Column(VARCHAR(length=2), nullable=False, comment="iv or cv")
+    chip_type = Column(CHAR(length=1), nullable=False)
+    voltage_key = Column(Integer, nullable=False)  # canonical voltage in microvolts
+    value = Column(Float, nullable=False)
+    record_created_at = Column(DATETIME, server_default=func.current_timestamp(), nullable=False)
+
+    def __repr__(self):
+        return "<Threshold(version='%d', type='%s', chip_type='%s', voltage_key='%d')>" % (
+            self.version, self.measurement_type, self.chip_type, self.voltage_key)
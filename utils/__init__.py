@@ -3,6 +3,24 @@ from .decorators import *
 from .flatten_options import flatten_options
 from .get_db_url import get_db_url
 from .logger import logger
+from .measurement_table import MeasurementTable
+from .query_plan import QueryPlanChecker, SMALL_TABLES
+from .threshold_table import ThresholdTable, iv_threshold_table, cv_threshold_table
 from .thresholds import iv_thresholds, cv_thresholds
 from .validators import *
+from .voltage_grid import (
+    VOLTAGE_KEY_SCALE,
+    to_voltage_key,
+    to_voltage_keys,
+    snap_voltage_keys,
+    from_voltage_key,
+)
 from .voltages_option import VoltagesOption, IV_VOLTAGE_PRESETS
+from .wafer_map import read_wafer_map
+from .wafer_bundle import (
+    WaferBundle,
+    WaferBundleWriter,
+    BUNDLE_TABLES,
+    get_arrow_schema,
+    rows_to_arrow,
+)
@@ -0,0 +1,155 @@
+from typing import Iterable, Sequence, Any, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from .voltage_grid import VOLTAGE_KEY_SCALE, snap_voltage_keys
+
+
+class MeasurementTable:
+    """
+    Measurements stored column by column in contiguous numpy arrays. Chip names are dictionary
+    encoded: `chip_names` holds every name once and `chip_codes` points to it for each row.
+    """
+    # row attribute: (array attribute, dtype, missing value)
+    columns = {
+        'chip_id': ('chip_ids', np.int32, -1),
+        'wafer_id': ('wafer_ids', np.int32, -1),
+        'chip_state_id': ('chip_state_ids', np.int16, -1),
+        'voltage_input': ('measured_voltages', np.float64, np.nan),
+        'anode_current': ('anode_currents', np.float64, np.nan),
+        'cathode_current': ('cathode_currents', np.float64, np.nan),
+        'anode_current_corrected': ('anode_currents_corrected', np.float64, np.nan),
+        'capacitance': ('capacitances', np.float64, np.nan),
+        'temperature': ('temperatures', np.float64, np.nan),
+    }
+    __slots__ = ('chip_names', 'chip_codes', 'voltage_keys', 'timestamps',
+                 *(array_name for array_name, _, _ in columns.values()))
+
+    def __init__(self, chip_names: Sequence[str], chip_codes: np.ndarray, voltage_keys: np.ndarray,
+                 timestamps: Optional[np.ndarray] = None, **arrays: np.ndarray):
+        self.chip_names = list(chip_names)
+        self.chip_codes = np.asarray(chip_codes, dtype=np.int32)
+        self.voltage_keys = np.asarray(voltage_keys, dtype=np.int64)
+        size = len(self.voltage_keys)
+        self.timestamps = np.full(size, 'NaT', dtype='datetime64[s]') if timestamps is None \
+            else np.asarray(timestamps, dtype='datetime64[s]')
+        for array_name, dtype, missing in self.columns.values():
+            array = arrays.pop(array_name, None)
+            setattr(self, array_name, np.full(size, missing, dtype=dtype) if array is None
+                    else np.asarray(array, dtype=dtype))
+        if arrays:
+            raise TypeError(f"Unknown measurement columns: {', '.join(arrays)}")
+
+    @classmethod
+    def from_chunks(cls, chunks: Iterable[Sequence[Any]]) -> 'MeasurementTable':
+        """
+        Builds a table from chunks of query rows. Rows must have `chip_name` and `voltage_key` or
+        `voltage_input` fields, other fields named as IVMeasurement/CVMeasurement columns are
+        optional.
+        Every chunk is converted to arrays as soon as it arrives.
+        """
+        codes_by_name: dict[str, int] = {}
+        parts: dict[str, list[np.ndarray]] = {}
+        for chunk in chunks:
+            if not len(chunk):
+                continue
+            values = dict(zip(chunk[0]._fields, zip(*chunk)))
+            parts.setdefault('chip_codes', []).append(np.fromiter(
+                (codes_by_name.setdefault(name, len(codes_by_name))
+                 for name in values.pop('chip_name')), dtype=np.int32))
+            if 'voltage_key' in values:
+                voltage_keys = np.array(values.pop('voltage_key'), dtype=np.int64)
+            else:
+                voltage_keys = snap_voltage_keys(values['voltage_input'])
+            parts.setdefault('voltage_keys', []).append(voltage_keys)
+            if 'datetime' in values:
+                parts.setdefault('timestamps', []).append(
+                    np.array(values.pop('datetime'), dtype='datetime64[s]'))
+            for name, column_values in values.items():
+                if name in cls.columns:
+                    array_name, dtype, missing = cls.columns[name]
+                    parts.setdefault(array_name, []).append(np.array(
+                        [missing if value is None else value for value in column_values],
+                        dtype=dtype))
+
+        if not parts:
+            return cls(chip_names=[], chip_codes=[], voltage_keys=[])
+        return cls(chip_names=list(codes_by_name),
+                   **{name: np.concatenate(arrays) for name, arrays in parts.items()})
+
+    @classmethod
+    def from_arrays(cls, chip_names: Sequence[str], voltage_input: Sequence,
+                    **columns: Union[Sequence, np.ndarray]) -> 'MeasurementTable':
+        """
+        Builds a table from per-row chip names, measured voltages and columns named as row
+        attributes. Measured voltages are kept and keyed by the canonical voltage grid.
+        """
+        names, codes = np.unique(np.asarray(chip_names, dtype=str), return_inverse=True)
+        timestamps = columns.pop('datetime', None)
+        arrays = {cls.columns[name][0]: values for name, values in columns.items()}
+        return cls(chip_names=names.tolist(), chip_codes=codes,
+                   voltage_keys=snap_voltage_keys(voltage_input), timestamps=timestamps,
+                   measured_voltages=voltage_input, **arrays)
+
+    def __len__(self) -> int:
+        return len(self.voltage_keys)
+
+    def __getitem__(self, index: Union[np.ndarray, slice]) -> 'MeasurementTable':
+        return MeasurementTable(
+            chip_names=self.chip_names, chip_codes=self.chip_codes[index],
+            voltage_keys=self.voltage_keys[index], timestamps=self.timestamps[index],
+            **{array_name: getattr(self, array_name)[index]
+               for array_name, _, _ in self.columns.values()})
+
+    @property
+    def voltages(self) -> np.ndarray:
+        return self.voltage_keys / VOLTAGE_KEY_SCALE
+
+    @property
+    def row_chip_names(self) -> np.ndarray:
+        return np.asarray(self.chip_names, dtype=object)[self.chip_codes]
+
+    @property
+    def chip_types(self) -> np.ndarray:
+        return np.array([name[0] for name in self.chip_names], dtype=object)[self.chip_codes]
+
+    @property
+    def x_coordinates(self) -> np.ndarray:
+        return np.array([int(name[1:3]) for name in self.chip_names], dtype=int)[self.chip_codes]
+
+    @property
+    def y_coordinates(self) -> np.ndarray:
+        return np.array([int(name[3:5]) for name in self.chip_names], dtype=int)[self.chip_codes]
+
+    @property
+    def uncorrected(self) -> np.ndarray:
+        """Rows without temperature correction."""
+        return np.isnan(self.anode_currents_corrected)
+
+    @property
+    def anode_values(self) -> np.ndarray:
+        """Temperature corrected anode currents with raw currents where correction is missing."""
+        return np.where(self.uncorrected, self.anode_currents, self.anode_currents_corrected)
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame({
+            'chip_name': pd.Categorical.from_codes(self.chip_codes, categories=self.chip_names)
+            if self.chip_names else pd.Categorical([]),
+            'voltage_key': self.voltage_keys,
+            'datetime': self.timestamps,
+            **{name: getattr(self, array_name)
+               for name, (array_name, _, _) in self.columns.items()},
+        })
+
+    def to_mappings(self, **constants: Any) -> list[dict[str, Any]]:
+        """Rows as dicts of non-missing column values (e.g. for Session.bulk_insert_mappings)."""
+        frame = self.to_frame().drop(columns='chip_name')
+        if np.isnat(self.timestamps).all():
+            frame = frame.drop(columns='datetime')
+        frame = frame.astype(object).where(frame.notna(), None)
+        for name, (_, dtype, missing) in self.columns.items():
+            if dtype is not np.float64 and (frame[name] == missing).all():
+                frame = frame.drop(columns=name)
+        return [{**constants, **{key: value for key, value in row.items() if value is not None}}
+                for row in frame.to_dict('records')]
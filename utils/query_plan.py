@@ -0,0 +1,71 @@
+import re
+from typing import Any, Iterable
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .logger import logger
+
+# tables small enough to be scanned as a whole
+SMALL_TABLES = {'chip_state', 'wafer', 'carrier', 'instrument', 'eqe_session'}
+ALIAS_PATTERN = re.compile(r'`?(\w+)`?\s+AS\s+`?(\w+)`?', re.IGNORECASE)
+
+
+class QueryPlanChecker:
+    """
+    Captures EXPLAIN output of every SELECT statement executed by the engine and collects
+    statements that scan a whole table. Supports MySQL and SQLite.
+    Plans name tables by their aliases, which are resolved from the statement. Aliases that can't
+    be resolved (e.g. the ones inside view definitions) count as scans of large tables.
+    """
+
+    def __init__(self, engine: Engine, tables: Iterable[str], allowed_tables: Iterable[str] = ()):
+        self.engine = engine
+        self.tables = set(tables)
+        self.allowed_tables = set(allowed_tables) | SMALL_TABLES
+        self.plans: list[tuple[str, list[tuple]]] = []
+        self.full_scans: list[tuple[str, str]] = []
+        event.listen(engine, 'before_cursor_execute', self.explain)
+
+    def close(self):
+        event.remove(self.engine, 'before_cursor_execute', self.explain)
+
+    def explain(self, conn, cursor, statement: str, parameters: Any, context, executemany: bool):
+        if executemany or not statement.lstrip().upper().startswith('SELECT'):
+            return
+        prefix = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' else 'EXPLAIN '
+        explain_cursor = conn.connection.cursor()
+        try:
+            explain_cursor.execute(prefix + statement, parameters)
+            plan = [tuple(row) for row in explain_cursor.fetchall()]
+            columns = [column[0] for column in explain_cursor.description]
+        finally:
+            explain_cursor.close()
+
+        self.plans.append((statement, plan))
+        aliases = {alias: table for table, alias in ALIAS_PATTERN.findall(statement)
+                   if table in self.tables}
+        for name in self.get_scanned_tables(conn.dialect.name, columns, plan):
+            table = aliases.get(name, name)
+            if table not in self.allowed_tables and not table.startswith('<'):
+                self.full_scans.append((table if table == name else f'{table} ({name})',
+                                        statement))
+
+    @staticmethod
+    def get_scanned_tables(dialect_name: str, columns: list[str], plan: list[tuple]) -> list[str]:
+        if dialect_name == 'sqlite':
+            details = (row[columns.index('detail')] for row in plan)
+            matches = (re.match(r'SCAN (?:TABLE )?(?!CONSTANT ROW|SUBQUERY)(\w+)', detail)
+                       for detail in details)
+            return [match[1] for match in matches if match]
+        # 'index' is a scan of the whole index, derived tables are named like <derived2>
+        return [row[columns.index('table')] for row in plan
+                if row[columns.index('type')] in ('ALL', 'index')]
+
+    def report(self) -> bool:
+        """Logs captured plans and full table scans. Returns True if there are no full scans."""
+        for statement, plan in self.plans:
+            logger.info('\n'.join([' '.join(statement.split()), *map(str, plan)]))
+        for table, statement in self.full_scans:
+            logger.error(f"Full scan of table {table} in: {' '.join(statement.split())}")
+        return not self.full_scans
@@ -0,0 +1,106 @@
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+import pandas as pd
+
+from .thresholds import iv_thresholds, cv_thresholds
+from .voltage_grid import VOLTAGE_KEY_SCALE, to_voltage_key
+
+
+class ThresholdTable:
+    """
+    Thresholds compiled into a dense chip type x voltage key matrix with NaN where a chip type has
+    no threshold. IV values pass above their thresholds (reverse currents are negative), CV values
+    pass below them.
+    """
+
+    def __init__(self, chip_types: Iterable[str], voltage_keys: Iterable[int], limits: np.ndarray,
+                 pass_above: bool, version: Optional[int] = None):
+        self.chip_types = pd.Index(list(chip_types))
+        self.voltage_keys = np.asarray(list(voltage_keys), dtype=np.int64)
+        self.limits = np.asarray(limits, dtype=float)
+        self.pass_above = pass_above
+        self.version = version
+        if len(self.voltage_keys) > 64:
+            raise ValueError('At most 64 threshold voltages fit into chip pass bitmaps')
+        if np.any(np.diff(self.voltage_keys) <= 0):
+            raise ValueError('Threshold voltage keys must be sorted and unique')
+
+    @classmethod
+    def from_entries(cls, entries: Iterable[tuple[str, int, float]], pass_above: bool,
+                     version: Optional[int] = None) -> 'ThresholdTable':
+        """Compiles (chip type, voltage key, threshold) entries."""
+        entries = list(entries)
+        chip_types = sorted({chip_type for chip_type, _, _ in entries})
+        voltage_keys = sorted({voltage_key for _, voltage_key, _ in entries})
+        limits = np.full((len(chip_types), len(voltage_keys)), np.nan)
+        for chip_type, voltage_key, limit in entries:
+            limits[chip_types.index(chip_type), voltage_keys.index(voltage_key)] = limit
+        return cls(chip_types, voltage_keys, limits, pass_above, version)
+
+    @classmethod
+    def from_dict(cls, thresholds: dict[str, dict[str, float]], pass_above: bool) \
+            -> 'ThresholdTable':
+        return cls.from_entries(
+            ((chip_type, to_voltage_key(voltage), limit)
+             for chip_type, type_thresholds in thresholds.items()
+             for voltage, limit in type_thresholds.items()),
+            pass_above)
+
+    def entries(self, chip_type: Optional[str] = None) -> Iterator[tuple[str, int, float]]:
+        chip_types = self.chip_types if chip_type is None else \
+            self.chip_types.intersection([chip_type])
+        for chip_type in chip_types:
+            row = self.limits[self.chip_types.get_loc(chip_type)]
+            for voltage_key, limit in zip(self.voltage_keys, row):
+                if not np.isnan(limit):
+                    yield chip_type, int(voltage_key), float(limit)
+
+    @property
+    def voltages(self) -> np.ndarray:
+        return self.voltage_keys / VOLTAGE_KEY_SCALE
+
+    def get_voltage_indices(self, voltage_keys: np.ndarray) -> np.ndarray:
+        """Column of every voltage key in the matrix, -1 for voltages without thresholds."""
+        voltage_keys = np.asarray(voltage_keys, dtype=np.int64)
+        indices = np.searchsorted(self.voltage_keys, voltage_keys)
+        found = indices < len(self.voltage_keys)
+        found[found] = self.voltage_keys[indices[found]] == voltage_keys[found]
+        return np.where(found, indices, -1)
+
+    def lookup(self, chip_types: np.ndarray, voltage_keys: np.ndarray) -> np.ndarray:
+        type_indices = self.chip_types.get_indexer(np.asarray(chip_types))
+        voltage_indices = self.get_voltage_indices(voltage_keys)
+        found = (type_indices >= 0) & (voltage_indices >= 0)
+        limits = np.full(len(found), np.nan)
+        limits[found] = self.limits[type_indices[found], voltage_indices[found]]
+        return limits
+
+    def evaluate(self, chip_types: np.ndarray, voltage_keys: np.ndarray, values: np.ndarray) \
+            -> tuple[np.ndarray, np.ndarray]:
+        """Returns masks of the values that have a threshold and of the values that pass it."""
+        limits = self.lookup(chip_types, voltage_keys)
+        checked = ~np.isnan(limits)
+        with np.errstate(invalid='ignore'):
+            passed = values > limits if self.pass_above else values < limits
+        return checked, checked & passed
+
+    def get_chip_bitmaps(self, chip_codes: np.ndarray, chips_count: int, chip_types: np.ndarray,
+                         voltage_keys: np.ndarray, values: np.ndarray) \
+            -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns bitmaps of checked and passed threshold voltages of every chip, where bit i stands
+        for the i-th voltage of the table. A chip passes if `checked & ~passed` is zero.
+        """
+        checked, passed = self.evaluate(chip_types, voltage_keys, values)
+        bits = np.left_shift(np.uint64(1),
+                             self.get_voltage_indices(voltage_keys).clip(0).astype(np.uint64))
+        checked_bits = np.zeros(chips_count, dtype=np.uint64)
+        passed_bits = np.zeros(chips_count, dtype=np.uint64)
+        np.bitwise_or.at(checked_bits, chip_codes[checked], bits[checked])
+        np.bitwise_or.at(passed_bits, chip_codes[passed], bits[passed])
+        return checked_bits, passed_bits
+
+
+iv_threshold_table = ThresholdTable.from_dict(iv_thresholds, pass_above=True)
+cv_threshold_table = ThresholdTable.from_dict(cv_thresholds, pass_above=False)
@@ -0,0 +1,35 @@
+from decimal import Decimal
+from typing import Iterable, Union
+
+import numpy as np
+
+VOLTAGE_KEY_SCALE = 1_000_000  # voltage keys are integer microvolts
+VOLTAGE_GRID_STEP = 1_000  # canonical voltages are multiples of 1 mV
+VOLTAGE_GRID_TOLERANCE = 200  # readbacks within 0.2 mV from the grid are snapped to it
+VOLTAGE_KEY_RESOLUTION = 10  # off-grid voltages keep the precision of voltage_input column
+
+
+def to_voltage_keys(voltages: Union[Iterable, np.ndarray]) -> np.ndarray:
+    return np.rint(np.asarray(list(voltages) if not isinstance(voltages, np.ndarray) else voltages,
+                              dtype=float) * VOLTAGE_KEY_SCALE).astype(np.int64)
+
+
+def to_voltage_key(voltage) -> int:
+    return int(to_voltage_keys([voltage])[0])
+
+
+def snap_voltage_keys(voltages: Union[Iterable, np.ndarray]) -> np.ndarray:
+    """
+    Converts measured voltages to canonical voltage keys: voltages close to the grid are snapped to
+    it, so instrument readbacks like -0.0099998 and -0.01 get the same key.
+    """
+    keys = to_voltage_keys(voltages)
+    snapped = np.rint(keys / VOLTAGE_GRID_STEP).astype(np.int64) * VOLTAGE_GRID_STEP
+    off_grid = np.rint(keys / VOLTAGE_KEY_RESOLUTION).astype(np.int64) * VOLTAGE_KEY_RESOLUTION
+    return np.where(np.abs(keys - snapped) <= VOLTAGE_GRID_TOLERANCE, snapped, off_grid)
+
+
+def from_voltage_key(voltage_key: int) -> Decimal:
+    """Voltage of a key without trailing zeros, e.g. Decimal('-10') or Decimal('-0.01')."""
+    voltage = Decimal(int(voltage_key)).scaleb(-6).normalize()
+    return voltage.quantize(Decimal(1)) if voltage == voltage.to_integral_value() else voltage
@@ -23,6 +23,8 @@ class VoltagesOption(click.Option):
         super().__init__(param_decls, *args, **kwargs)
 
     def type_cast_value(self, ctx, value):
+        if value is None:
+            return None
         if value in self.presets:
             value = self.presets[value]
 
@@ -0,0 +1,109 @@
+import json
+import os
+from typing import Iterable, Iterator, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import Column, types
+
+BUNDLE_FORMAT_VERSION = 1
+BUNDLE_MANIFEST_FILE = 'manifest.json'
+# referenced tables go first, so that import can remap ids in one pass
+BUNDLE_TABLES = ['chip_state', 'instrument', 'carrier', 'eqe_session', 'wafer', 'chip',
+                 'iv_data', 'cv_data', 'eqe_conditions', 'eqe_data']
+
+
+def get_arrow_type(column: Column) -> pa.DataType:
+    column_type = column.type
+    if isinstance(column_type, types.Numeric) and not isinstance(column_type, types.Float):
+        return pa.decimal128(column_type.precision, column_type.scale)
+    if isinstance(column_type, types.Float):
+        return pa.float64()
+    if isinstance(column_type, types.Integer):
+        return pa.int64()
+    if isinstance(column_type, types.DateTime):
+        return pa.timestamp('us')
+    if isinstance(column_type, types.Date):
+        return pa.date32()
+    return pa.string()
+
+
+def get_arrow_schema(columns: Iterable[Column]) -> pa.Schema:
+    return pa.schema([pa.field(column.name, get_arrow_type(column), nullable=column.nullable)
+                      for column in columns])
+
+
+def rows_to_arrow(rows: list[tuple], schema: pa.Schema) -> pa.Table:
+    columns = list(zip(*rows))
+    return pa.Table.from_arrays(
+        [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+        schema=schema)
+
+
+class WaferBundleWriter:
+    """Writes tables of a bundle row group by row group, so only one page of rows is in memory."""
+
+    def __init__(self, directory: str, compression: str = 'zstd'):
+        self.directory = directory
+        self.compression = compression
+        self.writers: dict[str, pq.ParquetWriter] = {}
+        self.rows: dict[str, int] = {}
+        os.makedirs(directory)
+
+    def write(self, table_name: str, schema: pa.Schema, rows: list[tuple]):
+        if table_name not in self.writers:
+            self.writers[table_name] = pq.ParquetWriter(
+                os.path.join(self.directory, f'{table_name}.parquet'), schema,
+                compression=self.compression)
+            self.rows[table_name] = 0
+        if rows:
+            self.writers[table_name].write_table(rows_to_arrow(rows, schema))
+            self.rows[table_name] += len(rows)
+
+    def close(self, wafers: list[str]):
+        for writer in self.writers.values():
+            writer.close()
+        with open(os.path.join(self.directory, BUNDLE_MANIFEST_FILE), 'w') as file:
+            json.dump({'format_version': BUNDLE_FORMAT_VERSION, 'wafers': wafers,
+                       'tables': self.rows}, file, indent=2)
+
+
+class WaferBundle:
+    """
+    Read access to a bundle made by `export wafer`. Tables are memory-mapped, so analysis code
+    can read columns of large bundles without copying them.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, BUNDLE_MANIFEST_FILE)) as file:
+            self.manifest = json.load(file)
+        if self.manifest['format_version'] != BUNDLE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported bundle format version {self.manifest['format_version']}")
+
+    @property
+    def wafers(self) -> list[str]:
+        return self.manifest['wafers']
+
+    @property
+    def tables(self) -> dict[str, int]:
+        return self.manifest['tables']
+
+    def get_path(self, table_name: str) -> str:
+        return os.path.join(self.directory, f'{table_name}.parquet')
+
+    def read(self, table_name: str, columns: Optional[list[str]] = None) -> pa.Table:
+        return pq.read_table(self.get_path(table_name), columns=columns, memory_map=True)
+
+    def iter_batches(self, table_name: str, batch_size: int = 65536,
+                     columns: Optional[list[str]] = None) -> Iterator[pa.RecordBatch]:
+        return pq.ParquetFile(self.get_path(table_name), memory_map=True) \
+            .iter_batches(batch_size=batch_size, columns=columns)
+
+    def read_measurements(self, table_name: str, columns: Optional[list[str]] = None) \
+            -> pa.Table:
+        """Measurements joined with wafer id and name of their chips."""
+        measurements = self.read(table_name, columns)
+        chips = self.read('chip', ['id', 'wafer_id', 'name']) \
+            .rename_columns(['chip_id', 'wafer_id', 'chip_name'])
+        return measurements.join(chips, 'chip_id')
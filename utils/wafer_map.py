@@ -0,0 +1,8 @@
+import re
+
+
+def read_wafer_map(path: str) -> list[str]:
+    """Chip names of a text file separated by commas or whitespace, `#` starts a comment."""
+    with open(path) as file:
+        return [chip_name for line in file
+                for chip_name in re.split(r'[\s,;]+', line.split('#', 1)[0]) if chip_name]